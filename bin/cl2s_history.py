@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+
+cl2s_history.py
+
+Show how many Jobs left their slots each day, by reason (exit, evict, hold or
+remove), as recorded in the CL2S job history by the Job Exit Hook
+(job_exit.py). The history is kept in the database in one table per day: with
+-archive, the days older than [History] keep_days are first moved to gzipped,
+tab separated files in [History] archive_dir and their tables dropped. Run it
+from cron to keep the database small.
+
+
+
+Usage
+    cl2s_history.py [-verbose] [-archive] [-keep DAYS] [-dir DIRECTORY]
+
+Options
+-verbose
+    Verbose output.
+-archive
+    Archive the old days first.
+-keep DAYS
+    Number of days (including today) to leave in the database when archiving.
+    Defaults to [History] keep_days.
+-dir DIRECTORY
+    Where to write the archive files. Defaults to [History] archive_dir.
+"""
+import logging
+
+from cl2s import config
+from cl2s import history
+from cl2s import logutils
+
+
+
+
+
+def cl2s_history(archive=False, keep=None, directory=None, verbose=False):
+    """
+    Print the number of Jobs recorded in the history each day, archiving the
+    days older than `keep` days to `directory` first if `archive`.
+
+    Return the exit code: 0 if success >0 otherwise.
+    """
+    # Determine the log level.
+    if(verbose):
+        logutils.logger.setLevel(logging.DEBUG)
+
+    if(archive):
+        if(keep is None):
+            keep = config.HISTORY_KEEP_DAYS
+        if(directory is None):
+            directory = config.HISTORY_ARCHIVE_DIR
+        try:
+            paths = history.archive(directory, keep)
+        except ValueError, e:
+            logutils.logger.critical('Cannot archive the history: %s' % (e))
+            return(1)
+        for path in paths:
+            logutils.logger.debug('Archived %s' % (path))
+
+    reasons = ('exit', 'evict', 'hold', 'remove')
+    print('%-10s %10s %10s %10s %10s' % (('DAY', ) +
+                                         tuple([r.upper() for r in reasons])))
+    for (day, counts) in history.counts():
+        print('%-10s %10d %10d %10d %10d' % ((day.isoformat(), ) +
+                                             tuple([counts.get(r, 0)
+                                                    for r in reasons])))
+    return(0)
+
+
+
+
+
+if(__name__ == '__main__'):
+    import argparse
+    import sys
+
+
+
+    # Parse command line inputs and flags.
+    parser = argparse.ArgumentParser(description='Show CL2S job history.')
+    parser.add_argument('-verbose', '--verbose', '-v',
+                        action='store_true',
+                        default=False,
+                        dest='verbose',
+                        help='Verbose output.')
+    parser.add_argument('-archive', '--archive', '-a',
+                        action='store_true',
+                        default=False,
+                        dest='archive',
+                        help='Archive the old days of history.')
+    parser.add_argument('-keep', '--keep', '-k',
+                        type=int,
+                        default=None,
+                        dest='keep',
+                        help='Days of history to keep in the database.')
+    parser.add_argument('-dir', '--dir', '-d',
+                        default=None,
+                        dest='directory',
+                        help='Archive directory.')
+    args = parser.parse_args()
+
+    # Run!
+    sys.exit(cl2s_history(archive=args.archive,
+                          keep=args.keep,
+                          directory=args.directory,
+                          verbose=args.verbose))
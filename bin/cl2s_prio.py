@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+
+cl2s_prio.py
+
+Replacement for condor_prio which changes the priority of jobs in the CL2S job
+queue. Jobs with higher priority are handed out first; jobs with the same
+priority are handed out in submission order. Jobs get the priority given by
+their JobPrio ClassAd attribute (0 by default) when they are submitted.
+
+All the selected jobs are reprioritized at once, with a single statement, no
+matter how many they are.
+
+
+
+Usage
+    cl2s_prio.py [-verbose] (-p priority | -delta value)
+                 (-all | -dataset name ... | job id ...)
+
+Options
+-verbose
+    Verbose output.
+-p priority
+    Set the priority of the selected jobs to priority.
+-delta value
+    Change the priority of the selected jobs by value (which can be negative).
+-dataset name
+    Select the jobs for dataset name. Can be given more than once.
+-all
+    Select all the jobs in the queue.
+job id
+    Select the job with this CL2S_JOB_ID. Can be combined with -dataset, in
+    which case only the jobs matching both are selected.
+"""
+import logging
+
+from cl2s import logutils
+from cl2s import JobQueue
+
+
+
+
+
+def cl2s_prio(priority=None, delta=None, job_ids=None, datasets=None,
+              verbose=False):
+    """
+    Set the priority of the selected jobs to `priority` or change it by
+    `delta`. Jobs are selected by id (`job_ids`) and/or dataset (`datasets`);
+    all of them are if neither is given.
+
+    Return the exit code: 0 if success >0 otherwise.
+    """
+    # Determine the log level.
+    if(verbose):
+        logutils.logger.setLevel(logging.DEBUG)
+
+    n = JobQueue.reprioritize(priority=priority,
+                              delta=delta,
+                              job_ids=job_ids or None,
+                              datasets=datasets or None)
+    print('%d job(s) reprioritized.' % (n))
+    return(0)
+
+
+
+
+
+if(__name__ == '__main__'):
+    import argparse
+    import sys
+
+
+
+    # Parse command line inputs and flags.
+    parser = argparse.ArgumentParser(description='Reprioritize CL2S jobs.')
+    parser.add_argument('-verbose', '--verbose', '-v',
+                        action='store_true',
+                        default=False,
+                        dest='verbose',
+                        help='Verbose output.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-p', '-priority', '--priority',
+                       type=int,
+                       default=None,
+                       dest='priority',
+                       help='New priority.')
+    group.add_argument('-delta', '--delta', '-d',
+                       type=int,
+                       default=None,
+                       dest='delta',
+                       help='Priority change (can be negative).')
+    parser.add_argument('-dataset', '--dataset',
+                        action='append',
+                        default=[],
+                        dest='datasets',
+                        help='Only the jobs for this dataset.')
+    parser.add_argument('-all', '--all', '-a',
+                        action='store_true',
+                        default=False,
+                        dest='all',
+                        help='All the jobs in the queue.')
+    parser.add_argument('job_ids',
+                        nargs='*',
+                        help='Ids of the jobs to reprioritize.')
+    args = parser.parse_args()
+
+    # Refuse to touch the whole queue unless explicitly told to.
+    if(not args.all and not args.job_ids and not args.datasets):
+        parser.error('select jobs with -all, -dataset or job ids.')
+    if(args.all and (args.job_ids or args.datasets)):
+        parser.error('-all cannot be combined with -dataset or job ids.')
+
+    # Run!
+    sys.exit(cl2s_prio(priority=args.priority,
+                       delta=args.delta,
+                       job_ids=args.job_ids,
+                       datasets=args.datasets,
+                       verbose=args.verbose))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+
+cl2s_q.py
+
+Replacement for condor_q -totals which shows the number of idle and claimed
+jobs in the CL2S job queue: all of them or just those of the given owners or
+datasets. Numbers come from counters kept up to date along with the queue:
+asking for them costs the same no matter how many jobs are queued.
+
+
+
+Usage
+    cl2s_q.py [-verbose] [-reconcile] [-owner name ...] [-dataset name ...]
+
+Options
+-verbose
+    Verbose output.
+-reconcile
+    Rebuild the counters from the queue itself first (jobqueue-init.py does
+    that when upgrading a queue that predates them; harmless otherwise).
+-owner name
+    Show the jobs of owner name. Can be given more than once.
+-dataset name
+    Show the jobs for dataset name. Can be given more than once.
+"""
+import logging
+
+from cl2s import logutils
+from cl2s import JobQueue
+
+
+
+
+
+def cl2s_q(owners=[], datasets=[], reconcile=False, verbose=False):
+    """
+    Print the number of idle and claimed jobs of each of `owners`, for each of
+    `datasets` and in the whole queue, rebuilding the counters first if so
+    asked.
+
+    Return the exit code: 0 if success >0 otherwise.
+    """
+    # Determine the log level.
+    if(verbose):
+        logutils.logger.setLevel(logging.DEBUG)
+
+    if(reconcile):
+        JobQueue.reconcile_counters()
+
+    lines = [('Owner %s' % (owner), JobQueue.counts(owner=owner))
+             for owner in owners]
+    lines += [('Dataset %s' % (dataset), JobQueue.counts(dataset=dataset))
+              for dataset in datasets]
+    lines.append(('Total', JobQueue.counts()))
+    for (what, (idle, claimed)) in lines:
+        print('%s: %d jobs; %d idle, %d claimed' % (what, idle + claimed,
+                                                    idle, claimed))
+    return(0)
+
+
+
+
+
+if(__name__ == '__main__'):
+    import argparse
+    import sys
+
+
+
+    # Parse command line inputs and flags.
+    parser = argparse.ArgumentParser(description='Count CL2S jobs.')
+    parser.add_argument('-verbose', '--verbose', '-v',
+                        action='store_true',
+                        default=False,
+                        dest='verbose',
+                        help='Verbose output.')
+    parser.add_argument('-reconcile', '--reconcile', '-r',
+                        action='store_true',
+                        default=False,
+                        dest='reconcile',
+                        help='Rebuild the counters from the queue.')
+    parser.add_argument('-owner', '--owner',
+                        action='append',
+                        default=[],
+                        dest='owners',
+                        help='Show the jobs of this owner.')
+    parser.add_argument('-dataset', '--dataset',
+                        action='append',
+                        default=[],
+                        dest='datasets',
+                        help='Show the jobs for this dataset.')
+    args = parser.parse_args()
+
+    # Run!
+    sys.exit(cl2s_q(owners=args.owners,
+                    datasets=args.datasets,
+                    reconcile=args.reconcile,
+                    verbose=args.verbose))
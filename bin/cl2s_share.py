@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+
+cl2s_share.py
+
+Show the fair-share state of the CL2S job queue: for each job owner, the number
+of idle and claimed jobs, the recent usage (number of jobs handed out, halving
+every [FairShare] half_life seconds) and the corresponding share of the recent
+usage of all owners. The owner to be served next is listed first.
+
+
+
+Usage
+    cl2s_share.py [-verbose] [-reconcile] [-decay]
+
+Options
+-verbose
+    Verbose output.
+-reconcile
+    Recompute the idle and claimed job counts of each owner from the queue
+    first (jobqueue-init.py does that when upgrading a queue that predates
+    fair-share; harmless otherwise).
+-decay
+    Decay the recent usage of each owner first. The CL2S daemon does that
+    periodically: use this from cron on clusters that do not run it.
+"""
+import logging
+
+from cl2s import logutils
+from cl2s import JobQueue
+
+
+
+
+
+def cl2s_share(reconcile=False, decay=False, verbose=False):
+    """
+    Print the fair-share state of the job queue, reconciling the counters and
+    decaying usage first if so asked.
+
+    Return the exit code: 0 if success >0 otherwise.
+    """
+    # Determine the log level.
+    if(verbose):
+        logutils.logger.setLevel(logging.DEBUG)
+
+    if(reconcile):
+        JobQueue.reconcile_counters()
+    if(decay):
+        JobQueue.decay_usage()
+
+    print('%-24s %10s %10s %14s %8s' % ('OWNER', 'IDLE', 'CLAIMED',
+                                        'RECENT USAGE', 'SHARE'))
+    for share in JobQueue.shares():
+        print('%-24s %10d %10d %14.2f %7.1f%%' % (share['owner'] or '-',
+                                                  share['idle'],
+                                                  share['claimed'],
+                                                  share['recent_usage'],
+                                                  share['share'] * 100.))
+    return(0)
+
+
+
+
+
+if(__name__ == '__main__'):
+    import argparse
+    import sys
+
+
+
+    # Parse command line inputs and flags.
+    parser = argparse.ArgumentParser(description='Show CL2S fair-share.')
+    parser.add_argument('-verbose', '--verbose', '-v',
+                        action='store_true',
+                        default=False,
+                        dest='verbose',
+                        help='Verbose output.')
+    parser.add_argument('-reconcile', '--reconcile', '-r',
+                        action='store_true',
+                        default=False,
+                        dest='reconcile',
+                        help='Recompute the job counts from the queue.')
+    parser.add_argument('-decay', '--decay', '-d',
+                        action='store_true',
+                        default=False,
+                        dest='decay',
+                        help='Decay recent usage.')
+    args = parser.parse_args()
+
+    # Run!
+    sys.exit(cl2s_share(reconcile=args.reconcile,
+                        decay=args.decay,
+                        verbose=args.verbose))
@@ -7,6 +7,11 @@ Replacement for condor_submit which uses CL2S to schedule jobs on a Condor
 cluster with very low latency. cl2s_submit.py creates entries for the input 
 job/submit description file in the CL2S job queue.
 
+Submit description files can use the usual condor_submit macros ($(Cluster), 
+$(Process), $(Step), $(ItemIndex) and any macro they define themselves) and
+queue statements (Queue N and Queue ... in/from/matching ...), one per file: 
+see macros.py in the cl2s package for the details.
+
 
 
 Usage
@@ -33,7 +38,8 @@ import logging
 from cl2s import ClassAd
 from cl2s import logutils
 from cl2s import JobQueue
-from cl2s import Job
+from cl2s import JobTemplate
+from cl2s import macros
 
 
 
@@ -51,8 +57,14 @@ def cl2s_submit(ad, verbose=False):
     if(verbose):
         logutils.logger.setLevel(logging.DEBUG)
     
-    # Parse the raw ad. Remember that the parsing code stores the raw ClassAd 
-    # attributes both as they are and as lowercase and uppercase.
+    # Parse the raw ad. Remember that ClassAd attribute names are 
+    # case-insensitive. The queue statement might have a list of items in it
+    # and is dealt with separately.
+    try:
+        (ad, queue) = macros.split_queue(ad)
+    except ValueError, e:
+        logutils.logger.critical('Cannot parse the queue statement: %s' % (e))
+        return(1)
     classAd = ClassAd.ClassAd(ad)
     logutils.logger.debug('Parsed input ClassAd:\n%s' % (classAd))
     
@@ -85,18 +97,17 @@ def cl2s_submit(ad, verbose=False):
                                  % (classAd.jobuniverse))
         return(3)
     
-    # See if we need to split a cluster job. In that case, remember to replace 
-    # $(Process) with range(classAd.CL2S_INSTANCES)
-    num_instances = classAd.CL2S_INSTANCES
-    
-    # Now set classAd.CL2S_INSTANCES to 1
+    # Split the cluster into its jobs: the ad is turned into a template once
+    # and its instances, with their macros expanded, are generated while
+    # push_cluster() queues them in large chunks.
     print('Submitting job(s).')
-    classAd.CL2S_INSTANCES = 1
-    new_ad_text = str(classAd)
-    for i in range(num_instances):
-        # Replace $(Process) with i, create a JOb instance and queue it.
-        JobQueue.push(Job.Job(new_ad_text.replace('$(Process)', str(i))))
-    print('%d job(s) submitted to cluster -1.' % (num_instances))
+    try:
+        template = JobTemplate.JobTemplate(classAd, queue=queue)
+    except (ValueError, IOError), e:
+        logutils.logger.critical('Cannot expand the job cluster: %s' % (e))
+        return(4)
+    n = JobQueue.push_cluster(template)
+    print('%d job(s) submitted to cluster %s.' % (n, template.cluster_id))
     return
             
 
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+
+cl2s_submit_dag.py
+
+Replacement for condor_submit_dag which runs a DAG of Jobs through the CL2S job
+queue. The DAG is stored in the CL2S database and its root nodes are queued
+right away; every other node is queued by the Job Exit Hook (job_exit.py) as 
+soon as the last of its parents exits successfully. Nodes whose parents failed
+are never queued.
+
+
+
+Usage
+    cl2s_submit_dag.py [-verbose] DAG file
+
+Options
+-verbose
+    Verbose output.
+DAG file
+    The pathname to the DAG input file. The submit description files of the
+    nodes are relative to the directory it is in.
+"""
+import logging
+import os
+
+from cl2s import Dag
+from cl2s import logutils
+
+
+
+
+
+def cl2s_submit_dag(dag_file, verbose=False):
+    """
+    Submit the DAG described in the file `dag_file` to CL2S.
+    
+    Return the exit code: 0 if success >0 otherwise.
+    """
+    # Determine the log level.
+    if(verbose):
+        logutils.logger.setLevel(logging.DEBUG)
+    
+    f = open(dag_file)
+    try:
+        dag_text = f.read()
+    finally:
+        f.close()
+    try:
+        dag = Dag.DAG(dag_text, os.path.dirname(os.path.abspath(dag_file)))
+        dag.load()
+    except (ValueError, IOError, NotImplementedError), e:
+        logutils.logger.critical('Cannot parse %s: %s' % (dag_file, e))
+        return(1)
+    
+    Dag.submit(dag)
+    print('DAG %s submitted: %d node(s), %d queued.' % (dag.dag_id, 
+                                                        len(dag.nodes),
+                                                        len(dag.roots)))
+    return(0)
+
+
+
+
+
+if(__name__ == '__main__'):
+    import argparse
+    import sys
+    
+    
+    
+    # Parse command line inputs and flags.
+    parser = argparse.ArgumentParser(description='Submit DAGs to CL2S.')
+    parser.add_argument('-verbose', '--verbose', '-v',
+                        action='store_true',
+                        default=False,
+                        dest='verbose',
+                        help='Verbose output.')
+    parser.add_argument('dag_file',
+                        help='DAG input file')
+    args = parser.parse_args()
+    
+    # Run!
+    sys.exit(cl2s_submit_dag(dag_file=args.dag_file, verbose=args.verbose))
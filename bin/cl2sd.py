@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+cl2sd.py
+
+Node-local CL2S daemon. Holds a warm connection to the job queue database and
+serves the Job Fetch and Reply Fetch hooks (fetch_job.py and reply_fetch.py) 
+over a Unix domain socket. Run one per compute node. The hooks fall back to 
+accessing the database directly when the daemon is not running.
+
+
+
+Usage
+    cl2sd.py [-verbose] [-socket path] [-prefetch n]
+
+Options
+-verbose
+    Verbose output.
+-socket path
+    The Unix domain socket to listen on. Defaults to the Daemon/socket setting
+    in cl2src.
+-prefetch n
+    Claim n jobs at a time and hand them out to the slots of this node. 
+    Defaults to the Daemon/prefetch setting in cl2src.
+"""
+import logging
+import signal
+import sys
+
+from cl2s import config
+from cl2s import fetchd
+from cl2s import logutils
+
+
+
+
+
+if(__name__ == '__main__'):
+    import argparse
+    
+    
+    
+    # Parse command line inputs and flags.
+    parser = argparse.ArgumentParser(description='Run the CL2S node daemon.')
+    parser.add_argument('-verbose', '--verbose', '-v',
+                        action='store_true',
+                        default=False,
+                        dest='verbose',
+                        help='Verbose output.')
+    parser.add_argument('-socket', '--socket', '-s',
+                        default=config.DAEMON_SOCKET,
+                        dest='socket',
+                        help='Unix domain socket to listen on.')
+    parser.add_argument('-prefetch', '--prefetch', '-p',
+                        type=int,
+                        default=config.DAEMON_PREFETCH,
+                        dest='prefetch',
+                        help='Number of jobs to claim at a time.')
+    args = parser.parse_args()
+    
+    if(args.verbose):
+        logutils.logger.setLevel(logging.DEBUG)
+    
+    # Turn SIGTERM into a clean exit so that the socket gets removed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        fetchd.serve(args.socket, args.prefetch)
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Job Exit Hook
+
+Invoked by the Condor starter when a Job leaves the slot for any reason. It is
+given the final Job ClassAd in STDIN and the reason ("exit", "hold", "remove" 
+or "evict") as sys.argv[1]. The exit status of this hook as well as its output
+are ignored by Condor.
+
+The Job is recorded in the CL2S job history, evictions included (see 
+cl2s_history.py). When the Job is a node of a DAG submitted with 
+cl2s_submit_dag.py and exited successfully, the nodes that were only waiting 
+for it are queued.
+
+The work is done by the node-local CL2S daemon (cl2sd.py) if it is running. If
+it is not, we talk to the database directly, which is a lot slower.
+"""
+import sys
+
+from cl2s import hookclient
+
+
+
+# Read the exit reason.
+try:
+    reason = sys.argv[1]
+except:
+    sys.stderr.write('sys.argv[1] is empty (it should be a string).\n')
+    sys.exit(1)
+
+# Read the raw Job ClassAd from STDIN
+job_ad = sys.stdin.read()
+
+# Record the Job and let the DAG, if any, move on.
+try:
+    hookclient.job_exit(reason, job_ad)
+except hookclient.DaemonUnavailable:
+    # No daemon: do the heavy lifting ourselves.
+    from cl2s import logutils
+    from cl2s import hooks
+    
+    logutils.logger.debug('job_exit.py: no daemon, accessing the database')
+    try:
+        hooks.job_exit(reason, job_ad)
+    except Exception, e:
+        logutils.logger.critical('Exception in handling job exit: %s' % (e))
+        sys.exit(2)
+except hookclient.DaemonError, e:
+    sys.stderr.write('Exception in handling job exit: %s\n' % (e))
+    sys.exit(2)
+sys.exit(0)
@@ -1,9 +1,19 @@
 #!/usr/bin/env python
+"""
+Create the CL2S job queue database or, if it already exists, upgrade it in 
+place to the current schema (new columns and indexes) and rebuild the queue 
+counters, which queues created before they existed do not have.
+"""
 import elixir
+from cl2s import JobQueue
+from cl2s import ormutils
 from cl2s.JobQueue import *
+from cl2s.Dag import DagNode, DagEdge
 
 
 
 # Init the database.
 elixir.setup_all()
-elixir.create_all()
+for change in ormutils.upgrade_schema():
+    print(change)
+JobQueue.reconcile_counters()
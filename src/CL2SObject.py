@@ -1,3 +1,2 @@
 class CL2SObject(object):
-    pass
-
+    __slots__ = ()
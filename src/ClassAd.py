@@ -1,15 +1,38 @@
 """
 Condor ClassAd support.
 """
+import collections
 import os
 import re
 
 from CL2SObject import CL2SObject
+import stats
 
 
 
 # Constants
 MULTILINE_BUSTER = re.compile(' *\\\\ *\n *')
+# Split ClassAd (or submit description file) text into lines, each line being
+# an attribute assignment (key, value), a full line comment or anything else 
+# (which had better be a Queue command). Empty lines match nothing.
+LINE = re.compile(r"""
+    ^[ \t]*
+    (?:
+        \+?([^\s=\#"+][^\s=]*)[ \t]*=[ \t]*(.*)
+      | (\#.*)
+      | (.+)
+    )?$""", re.X | re.M)
+# Complete string and number literals.
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"\Z')
+# Escaped characters in string literals.
+STRING_ESCAPE = re.compile(r'\\(["\\])')
+NUMBER = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?\Z')
+QUEUE = re.compile(r'queue(?:\s|\Z)', re.I)
+QUEUE_COUNT = re.compile(r'queue\s+(\d+)(?:\s|\Z)', re.I)
+# Characters number literals start with.
+NUMERIC = frozenset('0123456789+-.')
+# extract_attributes() patterns, by tuple of lowercase attribute names.
+_ATTRIBUTE_SCANNERS = {}
 # Job Universe names->ids
 JOB_UNIVERSE = {'VANILLA': 5, 
                 'SCHEDULER': 7, 
@@ -25,32 +48,50 @@ JOB_UNIVERSE = {'VANILLA': 5,
 # change the attribute name and/or the value.
 # {old_name: (attribute_transform_function, value_transform_function), }
 ALIASES = {'executable': (lambda name: 'Cmd', 
-                          lambda value: value),
+                          lambda value: unicode(value)),
            'universe': (lambda name: 'JobUniverse', 
                         lambda value: JOB_UNIVERSE[value.upper()])}
 
 
+class Expression(unicode):
+    """
+    A ClassAd value that is not a literal (e.g. `ImageSize / 1024` or 
+    `ifThenElse(...)`). It behaves just like the unicode string with the 
+    expression text, but it is not quoted when turned back into ClassAd text.
+    """
+    __slots__ = ()
+
+
 # Helper functions.
 def _classad_val_to_python_val(rawVal):
-    if(rawVal.startswith('"') and rawVal.endswith('"')):
-        return(unicode(rawVal[1:-1]))
-    if(rawVal.upper() == 'FALSE'):
-        return(False)
-    if(rawVal.upper() == 'TRUE'):
-        return(True)
-    try:
+    """
+    Turn the raw ClassAd value text `rawVal` into the corresponding Python value
+    (unicode, bool, int, float or Expression). What kind of literal, if any, we
+    are looking at is decided by its first character.
+    """
+    first = rawVal[:1]
+    if(first == '"'):
+        body = rawVal[1:-1]
+        if(len(rawVal) < 2 or rawVal[-1] != '"' or 
+           ('"' in body and not STRING.match(rawVal))):
+            return(Expression(rawVal))
+        if('\\' in body):
+            body = STRING_ESCAPE.sub(r'\1', body)
+        return(unicode(body))
+    if(first in NUMERIC):
+        if(rawVal.isdigit()):
+            return(int(rawVal))
+        if(not NUMBER.match(rawVal)):
+            return(Expression(rawVal))
+        if('.' in rawVal or 'e' in rawVal or 'E' in rawVal):
+            return(float(rawVal))
         return(int(rawVal))
-    except:
-        pass
-    try:
-        return(float(rawVal))
-    except:
-        pass
-    try:
-        return(unicode(rawVal))
-    except:
-        pass
-    raise(NotImplementedError('Unable to parse `%s`.' % (rawVal)))
+    lower = rawVal.lower()
+    if(lower == 'true'):
+        return(True)
+    if(lower == 'false'):
+        return(False)
+    return(Expression(rawVal))
 
 
 def _classad_environment_to_dict(env_str):
@@ -70,7 +111,7 @@ def _classad_environment_to_dict(env_str):
     # Replace ' ' with '_'
     s = env_str.replace("' '", "'_'")
     # Split on spaces.
-    k_vs = s.split(' ')
+    k_vs = s.split()
     for k_v in k_vs:
         (k, v) = k_v.split('=', 1)
         env[k] = v.replace("'_'", ' ')
@@ -93,12 +134,35 @@ def _dict_to_classad_environment(d):
 
 def _python_val_to_classad_val(pyVal):
     # The only cases we have to handle differently are strings/unicode since
-    # we need to enclose them in double quotes.
+    # we need to enclose them in double quotes (and escape the ones they 
+    # contain). Expressions are the exception: they go out as they are.
+    if(isinstance(pyVal, Expression)):
+        return(pyVal)
     if(isinstance(pyVal, str) or isinstance(pyVal, unicode)):
-        return('"' + pyVal + '"')
+        return('"' + pyVal.replace('\\', '\\\\').replace('"', '\\"') + '"')
     return(str(pyVal))
 
 
+def _classad_val_to_attribute_val(key, rawVal):
+    """
+    Return the Python value of the attribute `key` with ClassAd value text 
+    `rawVal`. This is the inverse of _attribute_to_classad_val().
+    """
+    if(key.lower() == 'environment'):
+        return(_classad_environment_to_dict(rawVal))
+    return(_classad_val_to_python_val(rawVal))
+
+
+def _attribute_to_classad_val(key, pyVal):
+    """
+    Return the ClassAd value text of the attribute `key` with Python value 
+    `pyVal`. Environment is the only attribute we need to handle specially.
+    """
+    if(key.lower() == 'environment'):
+        return(_dict_to_classad_environment(pyVal))
+    return(_python_val_to_classad_val(pyVal))
+
+
 def _dict_to_classad(d):
     """
     Given a dictionary, spit out the corresponding text ClassAd.
@@ -108,11 +172,7 @@ def _dict_to_classad(d):
     """
     s = ''
     for (key, value) in d.items():
-        # Handle the environment string specially.
-        if(key.lower() == 'environment'):
-            s += '%s = %s\n' % (key, _dict_to_classad_environment(value))
-        else:
-            s += '%s = %s\n' % (key, _python_val_to_classad_val(value))
+        s += '%s = %s\n' % (key, _attribute_to_classad_val(key, value))
     
     # Queue
     if('CL2S_INSTANCES' in d.keys()):
@@ -127,6 +187,17 @@ def _classad_to_dict(classAdText):
     """
     Given a multi-line ClassAd text, parse it and return the corresponding
         {key: val}
+    dictionary, in definition order (see _parse_classad()).
+    """
+    (names, res) = _parse_classad(classAdText)
+    return(collections.OrderedDict([(key, res[key]) for key in names]))
+
+
+def _parse_classad(classAdText):
+    """
+    Given a multi-line ClassAd text, parse it and return the list of its 
+    attribute names in definition order and the corresponding plain
+        {key: val}
     dictionary.
     
     Handle a few attributes with care:
@@ -135,45 +206,84 @@ def _classad_to_dict(classAdText):
         Queue -> CL2S_INSTANCES: 1
     Environment is a space separated list of key=value pairs. Turn it in a 
     dictionary.
+    
+    This is a single pass over the text: one regular expression splits it into
+    lines and each line into its components; values are then classified 
+    without raising and catching exceptions.
     """
-    # First of all, handle line continuations.
-    classAdText = MULTILINE_BUSTER.sub(' ', classAdText)
+    # First of all, handle line continuations (if any).
+    if('\\' in classAdText):
+        classAdText = MULTILINE_BUSTER.sub(' ', classAdText)
     
+    names = []
     res = {}
-    lines = classAdText.split('\n')
-    for i in range(len(lines)):
-        line = lines[i].strip()
-        
-        # Handle empty lines.
-        if(not(line)):
-            continue
-        
-        # Handle the Queue command, which does not have an = sign. 
-        if(line.lower().startswith('queue')):
-            res['CL2S_INSTANCES'] = _extract_num_instances(line)
-            continue
-        
-        # Handle simple, full line comments.
-        if(line.startswith('#')):
-            continue
-        
-        try:
-            [key, rawVal] = [x.strip() for x in line.split('=', 1)]
-        except:
-            raise(Exception('Cannot parse line "%s"' % (line)))
-        
-        # Handle Environment.
-        if(key.lower() == 'environment'):
-            res[key] = _classad_environment_to_dict(rawVal)
-            continue
-        
-        # Remember to strip any leading + sign from the key name.
-        if(key[0] == '+'):
-            key = key[1:]
-        val = _classad_val_to_python_val(rawVal)
-        if(res.has_key(key) and res[key] != val):
-            raise(NotImplementedError('ClassAd arrays are not supported.'))
+    for (key, rawVal, comment, other) in LINE.findall(classAdText):
+        # Handle empty lines and simple, full line comments.
+        if(not key):
+            if(not other):
+                continue
+            # Handle the Queue command, which does not have an = sign. 
+            other = other.strip()
+            if(not QUEUE.match(other)):
+                raise(Exception('Cannot parse line "%s"' % (other)))
+            key = 'CL2S_INSTANCES'
+            val = _extract_num_instances(other)
+        elif(key.lower() == 'environment'):
+            # Handle Environment.
+            val = _classad_environment_to_dict(rawVal.rstrip())
+        else:
+            val = _classad_val_to_python_val(rawVal.rstrip())
+            if(key in res and res[key] != val):
+                raise(NotImplementedError('ClassAd arrays are not supported.'))
+        if(key not in res):
+            names.append(key)
         res[key] = val
+    return((names, res))
+
+
+@stats.timed
+def extract_attributes(classAdText, names, pos=0, endpos=None):
+    """
+    Pull the attributes in the list `names` out of the ClassAd text 
+    `classAdText` without parsing the rest of it and return them as a 
+    {name: value} dictionary. Names are matched ignoring case and are returned
+    as given in `names`. Attributes not found in the ad are left out.
+    
+    Only lines defining one of `names` are ever looked at, and the scan stops
+    as soon as all of them have been found. This is what you want to read a 
+    couple of attributes (e.g. CL2S_JOB_ID) from a large ad. Only 
+    classAdText[pos:endpos] is scanned, which saves copying the ad out of a
+    larger string.
+    """
+    if(endpos is None):
+        endpos = len(classAdText)
+    wanted = dict([(name.lower(), name) for name in names])
+    pattern = _ATTRIBUTE_SCANNERS.get(tuple(sorted(wanted)))
+    if(pattern is None):
+        pattern = re.compile(r'^[ \t]*\+?(%s)[ \t]*=[ \t]*(.*)$' \
+                             % ('|'.join([re.escape(n) for n in wanted])),
+                             re.I | re.M)
+        _ATTRIBUTE_SCANNERS[tuple(sorted(wanted))] = pattern
+    
+    res = {}
+    for match in pattern.finditer(classAdText, pos, endpos):
+        (key, rawVal) = match.groups()
+        key = key.lower()
+        if(wanted[key] in res):
+            continue
+        rawVal = rawVal.rstrip()
+        if(rawVal.endswith('\\')):
+            # Line continuations: not worth streaming, parse it all instead.
+            parsed = _classad_to_dict(classAdText[pos:endpos])
+            parsed = dict([(k.lower(), v) for (k, v) in parsed.items()])
+            return(dict([(name, parsed[k]) for (k, name) in wanted.items() 
+                         if k in parsed]))
+        if(key == 'environment'):
+            res[wanted[key]] = _classad_environment_to_dict(rawVal)
+        else:
+            res[wanted[key]] = _classad_val_to_python_val(rawVal)
+        if(len(res) == len(wanted)):
+            break
     return(res)
 
 
@@ -183,18 +293,30 @@ def _extract_num_instances(line):
     start on the grid. The default is 1. This assumes that the line being passed
     as input is indeed a Queue command. We also assume that the line has already
     been strip()-ed.
+    
+    Queue statements with a list of items (e.g. Queue 2 in (a, b)) are accepted
+    as well: what is returned is then the number of instances per item (see 
+    macros.py for their expansion).
     """
-    tokens = line.split()
-    if(len(tokens) == 2):
-        return(int(tokens[1]))
-    return(1)
+    match = QUEUE_COUNT.match(line)
+    if(match is None):
+        return(1)
+    return(int(match.group(1)))
 
 
 
 class ClassAd(CL2SObject):
     """
     Class implementing Condor ClassAd functionality.
+    
+    ClassAd attributes are case-preserving but case-insensitive. Their values
+    are kept in a single mapping indexed by lowercase attribute name and are
+    presented as instance variables. The attribute names, as first seen, are 
+    kept in definition order for turning the instance back into text.
     """
+    __slots__ = ('_ad', '_attrs', '_names')
+    
+    @stats.timed
     def __init__(self, ad):
         """
         Create a ClassAd instance by parsing the input ClassAd text `ad`. The
@@ -210,31 +332,21 @@ class ClassAd(CL2SObject):
         Any leading + in attribute names are stripped. Comments are stripped as
         well.
         
-        Attribute names are presented as instance variables in up to three ways:
-            as they are in the raw ClassAd text
-            lowercase
-            uppercase
+        Attribute names are case-insensitive: ad.Owner, ad.owner and ad.OWNER
+        are all the same attribute. The case used in the raw ClassAd text is 
+        the one used when turning the instance back into text.
         """
         # Store the original ad.
         self._ad = ad
         
-        # Parse it into a dictonary as is.
-        parsed = _classad_to_dict(ad)
-        
-        # Keep track of the ad attributes so that we know how to recreate the ad
-        # later on.
-        self._ad_attributes = parsed.keys()
-        
-        # Now turn all the dictionary keys to lowercase for simplicity (unless
-        # we are asked not to do that, which would be a bummer) and create
-        # just as many instance variables with lowercase and uppercase copies.
-        setter = lambda (k, v): setattr(self, k, v)
-        map(setter, parsed.items())
+        # Parse it as is and index it by lowercase name.
+        (self._names, parsed) = _parse_classad(ad)
+        self._attrs = dict([(k.lower(), v) for (k, v) in parsed.iteritems()])
         
         # Expand the environment, if we are asked to.
         if(not hasattr(self, 'environment')):
             self.Environment = {}
-        if(self.getenv):
+        if(getattr(self, 'getenv', False)):
             self.Environment.update(os.environ)
             self.getenv = False
         
@@ -250,32 +362,72 @@ class ClassAd(CL2SObject):
         return
     
     
+    @stats.timed
     def __repr__(self):
-        d = dict([(k, getattr(self, k)) for k in self._ad_attributes])
-        return(_dict_to_classad(d))
+        attrs = self._attrs
+        return(_dict_to_classad(collections.OrderedDict(
+            [(k, attrs[k.lower()]) for k in self._names])))
+    
+    
+    def __getattr__(self, name):
+        """
+        Only called when `name` is not a regular attribute: look it up among
+        the ClassAd attributes, ignoring case.
+        """
+        # Private names are never ClassAd attributes (and self._attrs itself
+        # might not be there yet).
+        if(name.startswith('_')):
+            raise(AttributeError(name))
+        try:
+            return(self._attrs[name.lower()])
+        except KeyError:
+            raise(AttributeError(name))
     
     
     def __setattr__(self, name, value):
         """
-        Since different pieces of code need to be able to fetch attributes and
-        since attributes and case-preserving but case-insensitive, let's make
-        sure that we keep self._ad_attributes updated and we also keep one
-        lowercase and one uppercase copy of those attrs.
+        Set the ClassAd attribute `name` (case-insensitive) to `value`. An 
+        existing attribute keeps the case it was first defined with.
         """
         # Do not special handle variables starting with _
         if(name.startswith('_')):
             return(CL2SObject.__setattr__(self, name, value))
         
-        if(name not in self._ad_attributes):
-            self._ad_attributes.append(name)
-        # Make sure that we have a lowercase version.
-        if(not hasattr(self, name.lower())):
-            CL2SObject.__setattr__(self, name.lower(), value)
-        # Make sure that we have an uppercase version.
-        if(not hasattr(self, name.upper())):
-            CL2SObject.__setattr__(self, name.upper(), value)
-        # Finally, set the attribute and its value.
-        return(CL2SObject.__setattr__(self, name, value))
+        key = name.lower()
+        if(key not in self._attrs):
+            self._names.append(name)
+        self._attrs[key] = value
+        return
+    
+    
+    def __getstate__(self):
+        """
+        Pickle support: the state of a ClassAd is its attribute store. This is
+        also what lets the job queue keep a pre-parsed copy of each Job (see
+        JobQueue._dump_job()) and hand it back without parsing any text.
+        """
+        return((self._names, self._attrs))
+    
+    
+    def __setstate__(self, state):
+        # Set the slots directly rather than through __setattr__(): this runs
+        # for every Job loaded from the queue or generated by a JobTemplate.
+        _set_names(self, state[0])
+        _set_attrs(self, state[1])
+        _set_ad(self, None)
+        return
+    
+    
+    def __delattr__(self, name):
+        if(name.startswith('_')):
+            return(CL2SObject.__delattr__(self, name))
+        key = name.lower()
+        try:
+            del(self._attrs[key])
+        except KeyError:
+            raise(AttributeError(name))
+        self._names = [n for n in self._names if n.lower() != key]
+        return
     
     
     def _create_aliases(self, aliases=ALIASES):
@@ -292,25 +444,26 @@ class ClassAd(CL2SObject):
         {old_name: (attribute_transform_function, value_transform_function), }
         """
         # Store new attribute.value pairs temorarily here since creating new
-        # instance variables modifies self._ad_attributes.
+        # instance variables modifies self._attrs.
         new_attr_values = []
-        for attr in self._ad_attributes:
-            lattr = attr.lower()
+        for (lattr, value) in self._attrs.items():
             if(not aliases.has_key(lattr)):
                 continue
             # else compute the transormations.
             (key_fn, val_fn) = aliases[lattr]
-            new_attr_values.append((key_fn(lattr), 
-                                    val_fn(getattr(self, lattr))))
+            new_attr_values.append((key_fn(lattr), val_fn(value)))
         
         # Now that we have stored all the new attribute/value pairs, create new
-        # instance varuables. This also creates uppercase and lowercase aliases
-        # and modifies self._ad_attributes.
+        # instance varuables.
         for (attr, value) in new_attr_values:
             setattr(self, attr, value)
         return
 
 
+# Setters of the ClassAd slots, bypassing ClassAd.__setattr__().
+_set_names = ClassAd._names.__set__
+_set_attrs = ClassAd._attrs.__set__
+_set_ad = ClassAd._ad.__set__
 
 
 
@@ -1,18 +1,69 @@
 """
-Handle the parsing of DAG files into Python objects.
+Handle the parsing of DAG files into Python objects and their execution.
 
 A DAG syntax is pretty simple
     JOB JOBNAME JOBSCRIPT
+    VARS JOBNAME macroname="value" [macroname="value" ...]
     PARENT JOBNAME [JOBNAME ...] CHILD JOBNAME [JOBNAME ...]
+
+The submit description files (JOBSCRIPT) are only read when the node Jobs are
+needed, each distinct file once however many nodes use it (see DAG.load()).
+Submitting a DAG (see submit()) stores its nodes and edges in the database,
+each node with the number of its parents that have not completed yet, and
+pushes the root nodes to the job queue. Whenever the job of a node completes
+(see complete(), called by the job exit hook) the counts of its children are
+decremented and those that drop to 0 are pushed to the queue, all in one
+transaction: the work is proportional to the number of children of the node,
+not to the size of the DAG.
 """
+import datetime
+import gc
+import itertools
+import multiprocessing
 import os
+import re
+import uuid
+
+import elixir
+import sqlalchemy
 
+from ClassAd import ClassAd
 from CL2SObject import CL2SObject
-from Job import Job
+import config
+import JobQueue
+from JobTemplate import JobTemplate, PROCESS_MACROS
+import logutils
+import macros
+import ormutils
+import stats
+
+
+
+# Constants
+# Node states.
+WAITING = u'waiting'
+QUEUED = u'queued'
+DONE = u'done'
+FAILED = u'failed'
+# How many node names to put in each IN (...) (SQLite allows 999 parameters).
+IN_CHUNK_SIZE = 500
+# The job_queue columns stored with each node.
+JOB_COLUMNS = ('job_id', 'class_ad', 'job_state', 'dataset', 'owner',
+               'priority')
+# VARS macro definitions: name="value", with \" and \\ escapes in the value.
+VARS = re.compile(r'([A-Za-z_][\w.]*)\s*=\s*"((?:[^"\\]|\\.)*)"')
+UNESCAPE = re.compile(r'\\(.)')
+JOB_MACRO = re.compile(r'\$\(JOB\)', re.I)
+# Parse at most this many submit description files between cache flushes.
+MAX_CACHED_ADS = 1024
+
+
+
+# Parsed submit description files: {(path, mtime): (ClassAd, queue statement)}
+_ADS = {}
 
 
 
-    
 
 
 def _parse(dag, dir):
@@ -20,86 +71,528 @@ def _parse(dag, dir):
     A DAG syntax is pretty simple:
         JOB JOBNAME JOBSCRIPT
         ...
+        VARS JOBNAME macroname="value" [macroname="value" ...]
+        ...
         PARENT JOBNAME [JOBNAME ...] CHILD JOBNAME [JOBNAME ...]
         ...
-    We do not support DATA jobs quite yet.
+    Keywords are case-insensitive and lines starting with # are comments. Job
+    scripts are relative to `dir`. VARS define macros for the submit
+    description file of a node ($(JOB) in their values is the node name). We
+    do not support DATA jobs quite yet.
+
+    Job scripts are not read here (see _load()).
     """
-    lines = [l.strip() for l in dag.split('\n') if l.strip()]
-    
+    if(isinstance(dag, str)):
+        dag = dag.decode('utf-8')
+    lines = [l.strip() for l in dag.split('\n')]
+    lines = [(l, l.split()) for l in lines if l and not l.startswith('#')]
+
     # Nodes.
     nodes = {}                                                  # {name, Node}
-    
-    # We assume here that relationship between nodes are only defined after all
-    # the nodes in question have been defined. This way we do not have to go
-    # through the text twice.
-    for line in lines:
+    paths = {}                                          # {script, full path}
+
+    # Nodes first, so that relationships can be defined anywhere.
+    rest = []                                   # [(line, tokens, keyword)]
+    for (line, tokens) in lines:
+        keyword = tokens[0].upper()
+        if(keyword != 'JOB'):
+            rest.append((line, tokens, keyword))
         # Data Jobs.
-        if(line.startswith('DATA')):
+        if(keyword == 'DATA'):
             raise(NotImplementedError('DATA placement Jobs are not supported.'))
         # Node definition.
-        elif(line.startswith('JOB')):
-            typ, name, script = line.split()
-            nodes[name] = Node(name=name, 
-                               ad=os.path.join(dir, script).read(),
-                               children=[],
-                               parents=[])
-        # Relations.
-        elif(line.startswith('PARENT')):
-            # PARENT <parent1> <parent2> ... CHILD <child1> <child2>...
-            relation_str = line[7:]
-            parent_str, child_str = [x.strip() \
-                                     for x in relation_str.split(' CHILD ')]
-            
-            parents = [nodes[n] for n in parent_str.split()]
-            children = [nodes[n] for n in child_str.split()]
-            
-            # Fix the relationships.
-            for parent in parents:
-                parent.children += children
+        elif(keyword == 'JOB'):
+            if(len(tokens) < 3):
+                raise(ValueError('Cannot parse line "%s"' % (line)))
+            (name, script) = tokens[1:3]
+            if(name in nodes):
+                raise(ValueError('Node %s is defined twice.' % (name)))
+            if(script not in paths):
+                paths[script] = os.path.join(dir, script)
+            nodes[name] = Node(name=name, script=paths[script], dir=dir)
+
+    # Relations and macros.
+    edges = set()                                   # {(parent name, child name)}
+    for (line, tokens, keyword) in rest:
+        if(keyword == 'VARS'):
+            # VARS <name> <macro>="<value>" ...
+            if(len(tokens) < 3 or tokens[1] not in nodes):
+                raise(ValueError('Cannot parse line "%s"' % (line)))
+            node = nodes[tokens[1]]
+            definitions = line.split(None, 2)[2]
+            pairs = VARS.findall(definitions)
+            if(VARS.sub('', definitions).strip() or not pairs):
+                raise(ValueError('Cannot parse line "%s"' % (line)))
+            for (macro, value) in pairs:
+                if('\\' in value):
+                    value = UNESCAPE.sub(r'\1', value)
+                if('$(' in value):
+                    value = JOB_MACRO.sub(node.name, value)
+                node.vars[macro.lower()] = (macro, value)
+            continue
+        elif(keyword != 'PARENT'):
+            continue
+        # PARENT <parent1> <parent2> ... CHILD <child1> <child2>...
+        upper = [t.upper() for t in tokens]
+        if('CHILD' not in upper):
+            raise(ValueError('Cannot parse line "%s"' % (line)))
+        i = upper.index('CHILD')
+        try:
+            parents = [nodes[n] for n in tokens[1:i]]
+            children = [nodes[n] for n in tokens[i+1:]]
+        except KeyError, e:
+            raise(ValueError('Undefined node %s in "%s"' % (e, line)))
+
+        # Fix the relationships.
+        for parent in parents:
             for child in children:
-                child.parents += parents
+                if((parent.name, child.name) not in edges):
+                    edges.add((parent.name, child.name))
+                    parent.children.append(child)
+                    child.parents.append(parent)
     return(nodes.values())
 
 
+def _read(path):
+    """
+    Read and parse the submit description file (or ClassAd file) `path` and
+    return the (ClassAd instance, queue statement or None) pair.
+    """
+    f = open(path)
+    try:
+        text = f.read()
+    finally:
+        f.close()
+    (text, statement) = macros.split_queue(text)
+    return((ClassAd(text), statement))
+
+
+def load_ads(paths, processes=None):
+    """
+    Return the {path: (ClassAd instance, queue statement)} dictionary of the
+    submit description files `paths` (see _read()). Parsed files are cached
+    until they are modified; those that are not cached are parsed by a pool of
+    `processes` processes (config.DAG_PROCESSES by default, 0 meaning one per
+    CPU).
+    """
+    ads = {}
+    missing = []                                        # [(path, cache key)]
+    for path in set(paths):
+        try:
+            key = (path, os.stat(path).st_mtime)
+        except OSError:
+            # Let _read() complain.
+            key = None
+        if(key in _ADS):
+            ads[path] = _ADS[key]
+        else:
+            missing.append((path, key))
+    if(not missing):
+        return(ads)
+
+    if(processes is None):
+        processes = config.DAG_PROCESSES
+    if(not processes):
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(missing))
+    missing_paths = [path for (path, key) in missing]
+    if(processes > 1):
+        pool = multiprocessing.Pool(processes)
+        try:
+            parsed = pool.map(_read, missing_paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        parsed = map(_read, missing_paths)
+
+    if(len(_ADS) + len(missing) > MAX_CACHED_ADS):
+        _ADS.clear()
+    for ((path, key), value) in zip(missing, parsed):
+        _ADS[key] = value
+        ads[path] = value
+    return(ads)
+
+
+def _load(nodes, processes=None):
+    """
+    Bind each of the `nodes` to the Job cluster template of its submit 
+    description file, parsing each distinct file once (see load_ads()). All 
+    the nodes using the same file and defining the same VARS share a template,
+    with one Job per node: the VARS values are its queue items.
+
+    Raise NotImplementedError if a submit file describes more than one Job.
+    """
+    nodes = [node for node in nodes if node._template is None]
+    ads = load_ads([node.script for node in nodes], processes)
+
+    groups = {}                             # {(script, VARS): [Node, ...]}
+    for node in nodes:
+        key = (node.script, tuple(sorted(node.vars)))
+        groups.setdefault(key, []).append(node)
+    for ((script, names), group) in groups.items():
+        (ad, statement) = ads[script]
+        dir = group[0].dir
+        if(statement is not None):
+            (steps, variables, items) = macros.parse_queue(statement, dir)
+        else:
+            (steps, variables, items) = (getattr(ad, 'CL2S_INSTANCES', 1), 
+                                         [], [()])
+        if(steps * len(items) != 1):
+            raise(NotImplementedError('%s has %d jobs: only single Job ' \
+                                      'nodes are supported.' \
+                                      % (script, steps * len(items))))
+        # VARS win over the variables of the queue statement, if any.
+        keep = [i for (i, v) in enumerate(variables) 
+                if v.lower() not in names]
+        variables = [variables[i] for i in keep] + \
+                    [group[0].vars[name][0] for name in names]
+        item = tuple([items[0][i] for i in keep])
+        items = [item + tuple([node.vars[name][1] for name in names]) 
+                 for node in group]
+        # Each node is a cluster of its own, as far as $(Process) goes.
+        variables += PROCESS_MACROS
+        items = [item + (u'0', ) * len(PROCESS_MACROS) for item in items]
+        template = JobTemplate(ad, queue=(1, variables, items), basedir=dir)
+        for (i, node) in enumerate(group):
+            (node._template, node._index) = (template, i)
+    return
+
+
+def _instances(nodes):
+    """
+    Generate the (Node instance, Job instance, ClassAd text) triplets of the
+    (loaded) `nodes`, a template block at a time.
+    """
+    templates = {}                          # {id(template): [Node, ...]}
+    for node in nodes:
+        templates.setdefault(id(node._template), []).append(node)
+    for group in templates.values():
+        template = group[0]._template
+        group.sort(key=lambda node: node._index)
+        if(len(group) == len(template)):
+            pairs = template.instances()
+        else:
+            pairs = (template.instance(node._index) for node in group)
+        for (node, (job, text)) in itertools.izip(group, pairs):
+            yield((node, job, text))
+    return
+
+
 
 
 
 class Node(CL2SObject):
-    def __init__(self, name, script, children=[], parents=[]):
-        ad = open(script).read()
-        
+    """
+    A DAG node: a named Job and the nodes it depends on (its parents) and that
+    depend on it (its children).
+
+    The Job is only built when first needed: see the job property and 
+    DAG.load().
+    """
+    def __init__(self, name, script, dir=None, vars=None, children=None, 
+                 parents=None):
+        """
+        Create the node `name` running the Job described by the submit
+        description (or ClassAd) file `script`, whose queue statement, if any,
+        must describe a single Job. `vars` is the {lowercase macro name: 
+        (macro name, value)} dictionary of the macros defined for the node by
+        the DAG. Files the submit description refers to are relative to `dir`.
+        """
         self.name = name
-        self.job = Job.Job.newFromClassAd(ad)
-        self.children = children
-        self.parents = parents
-        return    
+        self.script = script
+        self.dir = dir
+        self.vars = vars or {}
+        self.children = children or []
+        self.parents = parents or []
+
+        # Job cluster template and Job instance number (see _load()).
+        self._template = None
+        self._index = None
+        self._job = None
+        self._class_ad = None
+        return
+
+
+    def _instantiate(self):
+        if(self._template is None):
+            _load([self, ])
+        (self._job, self._class_ad) = self._template.instance(self._index)
+        return
+
+
+    def _get_job(self):
+        if(self._job is None):
+            self._instantiate()
+        return(self._job)
+    job = property(_get_job)
+
+
+    def _get_class_ad(self):
+        if(self._class_ad is None):
+            self._instantiate()
+        return(self._class_ad)
+    class_ad = property(_get_class_ad)
 
 
 
 class DAG(CL2SObject):
     """
     DAG
-    
+
     Describe the relationship between Jobs as a Directed Acyclic Graph.
     """
     def __init__(self, dag_text, root_dir):
         """
         Create a DAG instance by parsing the imput Condor DAG text `dag_text`.
-        The only complication here is that in order to do so, we need to read 
-        and parse the various Job description files (i.e. Job ClassAds) 
-        referenced in `dag_text`. This is why we need `root_dir`: it is the path
+        The various Job description files (i.e. Job ClassAds) referenced in
+        `dag_text` are only read and parsed by load() (or when the Job of a 
+        node is first needed). This is why we need `root_dir`: it is the path
         of the directory where those ClassAd files are.
+
+        Raise ValueError if the graph has cycles.
         """
-        self.nodes = _parse(dag_text, root_dir)
-        
+        self.dag_id = unicode(uuid.uuid4())
+        # Large DAGs mean hundreds of thousands of new objects, none of them
+        # garbage: spare ourselves the collections they would trigger.
+        collect = gc.isenabled()
+        gc.disable()
+        try:
+            self.nodes = _parse(dag_text, root_dir)
+        finally:
+            if(collect):
+                gc.enable()
+
         # Find the root(s).
         self.roots = []
         for node in self.nodes:
             if(not node.parents):
                 self.roots.append(node)
+
+        # Make sure that every node can be reached from the roots, one
+        # generation at a time (i.e. that there are no cycles).
+        remaining = dict([(node.name, len(node.parents))
+                          for node in self.nodes])
+        ready = list(self.roots)
+        reached = 0
+        while(ready):
+            node = ready.pop()
+            reached += 1
+            for child in node.children:
+                remaining[child.name] -= 1
+                if(not remaining[child.name]):
+                    ready.append(child)
+        if(reached != len(self.nodes)):
+            raise(ValueError('The DAG has cycles.'))
         return
 
 
+    def load(self, processes=None):
+        """
+        Read and parse the submit description files of all the nodes, each
+        distinct file once and using up to `processes` processes (see
+        load_ads()).
+
+        Raise IOError if a file cannot be read and NotImplementedError if one
+        describes more than one Job.
+        """
+        _load(self.nodes, processes)
+        return
+
+
+    def instances(self):
+        """
+        Generate the (Node instance, Job instance, ClassAd text) triplets of 
+        all the nodes, loading them first if needed.
+        """
+        self.load()
+        return(_instances(self.nodes))
+
+
+
+
+class DagNode(elixir.Entity):
+    """
+    A node of a submitted DAG and its Job, ready to be pushed to the job queue
+    as soon as the last of its parents completes.
+    """
+    elixir.using_options(tablename='dag_node')
+
+    # DAG id (DAG.dag_id) and node name.
+    dag_id = elixir.Field(elixir.Unicode(36), primary_key=True)
+    name = elixir.Field(elixir.Unicode(255), primary_key=True)
+    # The job_queue entry of the node Job (see JobQueue._row()).
+    job_id = elixir.Field(elixir.Unicode(255), unique=True)
+    class_ad = elixir.Field(elixir.UnicodeText())
+    job_state = elixir.Field(elixir.UnicodeText(), info={'cache': True})
+    dataset = elixir.Field(elixir.Unicode(255))
+    owner = elixir.Field(elixir.Unicode(255), default=u'')
+    priority = elixir.Field(elixir.Integer, default=0)
+    # Number of parents that have not completed yet.
+    remaining = elixir.Field(elixir.Integer, default=0)
+    # WAITING for its parents, QUEUED (or running), DONE or FAILED.
+    state = elixir.Field(elixir.Unicode(16), default=WAITING)
+
+    def __repr__(self):
+        return('DagNode(%r, %r)' % (self.dag_id, self.name))
+
+
+
+class DagEdge(elixir.Entity):
+    """
+    A parent -> child dependency of a submitted DAG. The primary key doubles as
+    the index to find the children of a node.
+    """
+    elixir.using_options(tablename='dag_edge')
+
+    dag_id = elixir.Field(elixir.Unicode(36), primary_key=True)
+    parent = elixir.Field(elixir.Unicode(255), primary_key=True)
+    child = elixir.Field(elixir.Unicode(255), primary_key=True)
+
+    def __repr__(self):
+        return('DagEdge(%r, %r, %r)' % (self.dag_id, self.parent, self.child))
+
+
+
+
+def _chunks(rows, chunk_size):
+    # Split the list rows in lists of chunk_size rows.
+    return([rows[i:i+chunk_size] for i in range(0, len(rows), chunk_size)])
+
+
+def _queue_row(node):
+    """
+    Return the job_queue row dictionary of the dag_node row `node`.
+    """
+    row = dict([(column, node[column]) for column in JOB_COLUMNS])
+    row['date_added'] = datetime.datetime.now()
+    row['busy'] = False
+    return(row)
+
+
+@stats.timed
+@logutils.logit
+def submit(dag, chunk_size=None):
+    """
+    Store the DAG instance `dag` in the database and push its root nodes to
+    the job queue, all in one transaction. Nodes and edges are inserted
+    `chunk_size` at a time (config.QUEUE_PUSH_CHUNK_SIZE by default). The
+    node Jobs are built here if they have not been already (see DAG.load()).
+
+    Return the id of the DAG.
+    """
+    elixir.setup_all()
+
+    if(chunk_size is None):
+        chunk_size = config.QUEUE_PUSH_CHUNK_SIZE
+
+    nodes = []
+    edges = []
+    for (node, job, class_ad) in dag.instances():
+        row = JobQueue._row(job, class_ad)
+        row = dict([(column, row[column]) for column in JOB_COLUMNS])
+        row.update({'dag_id': dag.dag_id,
+                    'name': node.name,
+                    'remaining': len(node.parents),
+                    'state': QUEUED if not node.parents else WAITING})
+        nodes.append(row)
+        edges += [{'dag_id': dag.dag_id,
+                   'parent': node.name,
+                   'child': child.name} for child in node.children]
+    roots = [_queue_row(row) for row in nodes if row['state'] == QUEUED]
+
+    # Owners and datasets need their queue counters before any node Job can
+    # be queued (see JobQueue._ensure_counters()).
+    JobQueue._ensure_counters(nodes)
+    with ormutils.transaction() as connection:
+        for chunk in _chunks(nodes, chunk_size):
+            connection.execute(DagNode.table.insert(), chunk)
+        for chunk in _chunks(edges, chunk_size):
+            connection.execute(DagEdge.table.insert(), chunk)
+        for chunk in _chunks(roots, chunk_size):
+            JobQueue._insert(connection, chunk)
+    return(dag.dag_id)
+
+
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def complete(job_id, success=True):
+    """
+    The Job with id `job_id` has completed, successfully if `success`. If it
+    is the Job of a DAG node, mark the node DONE (or FAILED) and, if it
+    succeeded, push the children it was the last parent of to the job queue.
+    Nothing happens for any other Job, or if the node was already marked.
+
+    Return the list of the names of the nodes pushed to the queue.
+    """
+    elixir.setup_all()
+
+    nodes = DagNode.table
+    edges = DagEdge.table
+    with ormutils.transaction() as connection:
+        node = connection.execute(sqlalchemy.select([nodes.c.dag_id,
+                                                     nodes.c.name])
+                                  .where(nodes.c.job_id == job_id)).first()
+        if(node is None):
+            return([])
+
+        # Only the first report of the completion of a node counts.
+        this = sqlalchemy.and_(nodes.c.dag_id == node.dag_id,
+                               nodes.c.name == node.name,
+                               nodes.c.state == QUEUED)
+        result = connection.execute(nodes.update().where(this).values(
+            state=DONE if success else FAILED))
+        if(not result.rowcount or not success):
+            return([])
+
+        # Children: one fewer parent to wait for. Those with none left are
+        # ready. Row locks make sure that only the last parent to complete
+        # sees the count go to 0.
+        children = sqlalchemy.select([edges.c.child]) \
+                             .where(sqlalchemy.and_(
+                                 edges.c.dag_id == node.dag_id,
+                                 edges.c.parent == node.name))
+        mine = sqlalchemy.and_(nodes.c.dag_id == node.dag_id,
+                               nodes.c.name.in_(children))
+        connection.execute(nodes.update().where(mine)
+                                .values(remaining=nodes.c.remaining - 1))
+        ready = connection.execute(
+            sqlalchemy.select([nodes.c.name] +
+                              [nodes.c[column] for column in JOB_COLUMNS])
+            .where(sqlalchemy.and_(mine,
+                                   nodes.c.remaining == 0,
+                                   nodes.c.state == WAITING))).fetchall()
+        if(not ready):
+            return([])
+
+        names = [row.name for row in ready]
+        for chunk in _chunks(names, IN_CHUNK_SIZE):
+            connection.execute(nodes.update()
+                                    .where(sqlalchemy.and_(
+                                        nodes.c.dag_id == node.dag_id,
+                                        nodes.c.name.in_(chunk)))
+                                    .values(state=QUEUED))
+        JobQueue._insert(connection, [_queue_row(row) for row in ready])
+    return(names)
+
+
+def status(dag_id):
+    """
+    Return the {state: number of nodes} dictionary of the DAG with id
+    `dag_id`.
+    """
+    elixir.setup_all()
+
+    nodes = DagNode.table
+    with ormutils.transaction() as connection:
+        rows = connection.execute(sqlalchemy.select([nodes.c.state,
+                                                     sqlalchemy.func.count()])
+                                  .where(nodes.c.dag_id == dag_id)
+                                  .group_by(nodes.c.state)).fetchall()
+    return(dict([(state, n) for (state, n) in rows]))
+
+
 
 
 
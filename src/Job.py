@@ -22,6 +22,8 @@ class Job(ClassAd):
        InputDataset attribute.
     
     """
+    __slots__ = ()
+    
     def __init__(self, ad):
         """
         Create a Job instance from the input text ClassAd `ad`. This also 
@@ -32,9 +34,15 @@ class Job(ClassAd):
         """
         # Invoke the superclass constructor.
         super(Job, self).__init__(ad)
-        
-        # Create our extra instance variables. Modify self._ad_attributes to 
-        # reflect the new variables we have created.
+        self._set_defaults()
+        return
+    
+    
+    def _set_defaults(self):
+        """
+        Create our extra instance variables (see __init__()) unless they are
+        already defined.
+        """
         if(not hasattr(self, 'CL2S_JOB_ID')):
             self.CL2S_JOB_ID = unicode(uuid.uuid4())
         
@@ -23,19 +23,133 @@ receiving Job ClassAds.
 This means that there has to be a way to link ClassAds with entries in the Job 
 queue (i.e. by means of a custon ClassAd attribute). The Python uuid module is
 used for that purpose. The ClassAd special attribute is called CL2S_JOB_ID.
+
+Each queue entry keeps the Job ClassAd twice: as ready to emit text, which is
+all the fetch hook needs to send to the startd, and as the JSON text of the
+attributes of the pre-parsed Job instance for those who need the object. 
+Neither form is ever parsed as a ClassAd again when the entry is claimed. The
+latter is data only: loading it never runs any code stored in the database.
 """
+import collections
 import datetime
+import itertools
+import json
+import time
+import uuid
 
 import elixir
+import sqlalchemy
+import sqlalchemy.exc
 
+import config
+import expressions
 import logutils
 import ormutils
+import stats
+import ClassAd
+from ClassAd import Expression
 from Job import Job
 
 
 
 
-
+# Constants
+# Entries are claimed highest priority first and, among entries with the same
+# priority, oldest first. "Oldest" below is short for that order.
+# Flavours that can claim the oldest idle entry and hand back its ClassAd with a
+# single UPDATE statement. Row locks are skipped, not waited on, so concurrent
+# claimers never queue up behind each other. Everything else goes through
+# _claim_conditional(). %(filter)s is where the dataset and owner filters go, 
+# if any (see _filter()). Every claim comes with a lease: entries still busy 
+# when it runs out go back to the queue (see expire_leases()).
+CLAIM_STATEMENTS = {
+    'postgresql': '''UPDATE job_queue 
+                     SET busy = :busy, lease_expires = :lease_expires
+                     WHERE job_id = (SELECT job_id FROM job_queue
+                                     WHERE busy = :idle%(filter)s
+                                     ORDER BY priority DESC, date_added
+                                     LIMIT 1
+                                     FOR UPDATE SKIP LOCKED)
+                     RETURNING job_id, owner, dataset, class_ad, job_state''',
+    'mssql': '''WITH oldest AS (SELECT TOP 1 busy, lease_expires, job_id, 
+                                       owner, dataset, class_ad, job_state
+                                FROM job_queue
+                                WITH (ROWLOCK, UPDLOCK, READPAST)
+                                WHERE busy = :idle%(filter)s
+                                ORDER BY priority DESC, date_added)
+                UPDATE oldest SET busy = :busy, lease_expires = :lease_expires
+                OUTPUT inserted.job_id, inserted.owner, inserted.dataset, 
+                       inserted.class_ad, inserted.job_state''',
+}
+# Select the oldest idle entry (candidate for a conditional claim).
+SELECT_OLDEST = '''SELECT job_id, owner, dataset, class_ad, job_state 
+                   FROM job_queue
+                   WHERE busy = :idle%(filter)s
+                   ORDER BY priority DESC, date_added
+                   LIMIT 1'''
+# Restrict claims to entries for the datasets :dataset0, :dataset1 etc.
+AFFINITY_FILTER = ' AND dataset IN (%s)'
+# Restrict claims to entries of :owner.
+OWNER_FILTER = ' AND owner = :owner'
+# Flavours with row locks we can skip while selecting a candidate.
+SKIP_LOCKED_FLAVOURS = ('mysql', )
+# Mark the candidate busy, but only if nobody else got to it first.
+CONDITIONAL_CLAIM = '''UPDATE job_queue 
+                       SET busy = :busy, lease_expires = :lease_expires
+                       WHERE job_id = :job_id AND busy = :idle'''
+# Claim up to :n of the oldest idle entries at once, tagging them with the 
+# :claim_id of this batch. Flavours that can hand the claimed rows back directly
+# do so; for the others we fetch them by claim_id afterwards. The statement
+# used by all the flavours not listed is CLAIM_BATCH_STATEMENTS[None].
+CLAIM_BATCH_STATEMENTS = {
+    'postgresql': '''UPDATE job_queue 
+                     SET busy = :busy, claim_id = :claim_id, 
+                         lease_expires = :lease_expires
+                     WHERE job_id IN (SELECT job_id FROM job_queue
+                                      WHERE busy = :idle%(filter)s
+                                      ORDER BY priority DESC, date_added
+                                      LIMIT :n
+                                      FOR UPDATE SKIP LOCKED)
+                     RETURNING priority, date_added, job_id, owner, dataset, 
+                               class_ad, job_state''',
+    'mssql': '''WITH oldest AS (SELECT TOP (:n) busy, claim_id, 
+                                       lease_expires, priority, date_added, 
+                                       job_id, owner, dataset, class_ad, 
+                                       job_state
+                                FROM job_queue
+                                WITH (ROWLOCK, UPDLOCK, READPAST)
+                                WHERE busy = :idle%(filter)s
+                                ORDER BY priority DESC, date_added)
+                UPDATE oldest 
+                SET busy = :busy, claim_id = :claim_id, 
+                    lease_expires = :lease_expires
+                OUTPUT inserted.priority, inserted.date_added, inserted.job_id,
+                       inserted.owner, inserted.dataset, inserted.class_ad, 
+                       inserted.job_state''',
+    'mysql': '''UPDATE job_queue 
+                SET busy = :busy, claim_id = :claim_id, 
+                    lease_expires = :lease_expires
+                WHERE busy = :idle%(filter)s
+                ORDER BY priority DESC, date_added
+                LIMIT :n''',
+    None: '''UPDATE job_queue 
+             SET busy = :busy, claim_id = :claim_id, 
+                 lease_expires = :lease_expires
+             WHERE job_id IN (SELECT job_id FROM job_queue
+                              WHERE busy = :idle%(filter)s
+                              ORDER BY priority DESC, date_added
+                              LIMIT :n)''',
+}
+# Flavours whose batch claim statement returns the claimed rows.
+RETURNING_FLAVOURS = ('postgresql', 'mssql')
+# Fetch the rows claimed by a batch.
+SELECT_CLAIMED = '''SELECT priority, date_added, job_id, owner, dataset, 
+                           class_ad, job_state
+                    FROM job_queue
+                    WHERE claim_id = :claim_id'''
+# How many entries _release() puts back per UPDATE (SQLite takes at most 999
+# bound parameters).
+RELEASE_CHUNK_SIZE = 500
 
 
 
@@ -50,17 +164,55 @@ class JobQueueEntry(elixir.Entity):
     This is where Jobs are put when they are ready to execute.
     """
     elixir.using_options(tablename='job_queue')
+    # pop() looks for the oldest idle entry: let it walk an index in claim 
+    # order instead of scanning and sorting the whole table. Same thing for
+    # the oldest idle entry of given datasets or of a given owner. Priorities
+    # are indexed in descending order (see ormutils._create_index()).
+    elixir.using_table_options(sqlalchemy.Index('ix_job_queue_priority', 
+                                                'busy', 
+                                                'priority',
+                                                'date_added',
+                                                descending=('priority', )),
+                               sqlalchemy.Index('ix_job_queue_dataset_priority',
+                                                'busy',
+                                                'dataset',
+                                                'priority',
+                                                'date_added',
+                                                descending=('priority', )),
+                               sqlalchemy.Index('ix_job_queue_owner_priority',
+                                                'busy',
+                                                'owner',
+                                                'priority',
+                                                'date_added',
+                                                descending=('priority', )),
+                               sqlalchemy.Index('ix_job_queue_lease',
+                                                'busy',
+                                                'lease_expires'))
     
     # Job id
     job_id = elixir.Field(elixir.Unicode(255), primary_key=True)
+    # Priority (the JobPrio of the Job): higher priority entries are claimed
+    # first.
+    priority = elixir.Field(elixir.Integer, default=0)
     # Date enqueued.
-    date_added = elixir.Field(elixir.DateTime, default=datetime.datetime.now())
+    date_added = elixir.Field(elixir.DateTime, default=datetime.datetime.now)
     # Raw ClassAd
     class_ad = elixir.Field(elixir.UnicodeText())
+    # Pre-parsed Job instance, as JSON text (see _dump_job()). NULL for 
+    # entries queued before this column existed: those are parsed from 
+    # class_ad instead. Which is also why upgrade_schema() can empty it.
+    job_state = elixir.Field(elixir.UnicodeText(), info={'cache': True})
     # Dataset name
     dataset = elixir.Field(elixir.Unicode(255))
+    # Owner of the Job (see OwnerShare).
+    owner = elixir.Field(elixir.Unicode(255), default=u'')
     # In use flag
     busy = elixir.Field(elixir.Boolean, default=False)
+    # Id of the pop_batch() claim that marked this entry busy, if any.
+    claim_id = elixir.Field(elixir.Unicode(36), index=True)
+    # When the claim on a busy entry runs out, if nobody deletes or reinserts
+    # it before (e.g. because the node that claimed it died).
+    lease_expires = elixir.Field(elixir.DateTime)
     
     
     
@@ -69,145 +221,1025 @@ class JobQueueEntry(elixir.Entity):
 
 
 
+class OwnerShare(elixir.Entity):
+    """
+    Fair-share bookkeeping: one row per Job owner, updated in the same 
+    transaction as the queue entries it describes.
+    
+    recent_usage is the number of Jobs the owner has been handed, decayed 
+    exponentially over time (see decay_usage()). When fair-share is on, claim()
+    serves the owner with idle entries and the lowest recent_usage first: one
+    walk of an index on the (few) owners instead of a look at the queue.
+    """
+    elixir.using_options(tablename='owner_share')
+    elixir.using_table_options(sqlalchemy.Index('ix_owner_share_usage', 
+                                                'waiting', 
+                                                'recent_usage',
+                                                'owner'))
+    
+    # Owner name (JobQueueEntry.owner).
+    owner = elixir.Field(elixir.Unicode(255), primary_key=True)
+    # True if the owner has idle entries, i.e. if idle > 0. It comes before 
+    # idle so that MySQL, which applies UPDATE assignments left to right, 
+    # computes it from the old value of idle just like everybody else does.
+    waiting = elixir.Field(elixir.Boolean, default=False)
+    # Number of idle entries.
+    idle = elixir.Field(elixir.Integer, default=0)
+    # Number of busy (claimed) entries.
+    claimed = elixir.Field(elixir.Integer, default=0)
+    # Decayed number of Jobs handed out.
+    recent_usage = elixir.Field(elixir.Float, default=0.)
+    # When recent_usage was last decayed (seconds since the epoch).
+    last_decay = elixir.Field(elixir.Float)
+    
+    def __repr__(self):
+        return('OwnerShare(%r)' % (self.owner))
+
 
 
-@ormutils.run_with_retries_and_rollback
-@logutils.logit
-def push(job):
+class DatasetCount(elixir.Entity):
     """
-    Add the input Job instance `job` to the Job Queue.
+    Number of idle and busy entries for each dataset, updated in the same 
+    transaction as the queue entries it counts (see counts()).
     """
-    elixir.setup_all()
+    elixir.using_options(tablename='dataset_count')
     
-    # Remeber the string representation of a Job instance is its most up to date
-    # ClassAd.
-    entry = JobQueueEntry(job_id=job.CL2S_JOB_ID,
-                          class_ad=unicode(job),
-                          dataset=job.CL2S_DATASET)
-    elixir.session.commit()
-    return
+    # Dataset name (JobQueueEntry.dataset).
+    dataset = elixir.Field(elixir.Unicode(255), primary_key=True)
+    # Number of idle entries.
+    idle = elixir.Field(elixir.Integer, default=0)
+    # Number of busy (claimed) entries.
+    claimed = elixir.Field(elixir.Integer, default=0)
+    
+    def __repr__(self):
+        return('DatasetCount(%r)' % (self.dataset))
 
 
-@ormutils.run_with_retries_and_rollback
-@logutils.logit
-def pop():
+
+class QueuedJob(object):
     """
-    "Retrieve" the oldest entry from the JobQueue. By that we mean that we mark
-    the oldest entry in the job queue as busy and we return it. If then the 
-    system tells us that it accepted it, we remove it using delete().
+    A Job claimed from the queue, as stored there: its id, its dataset and its
+    ClassAd text, ready to be handed to Condor as is. The corresponding Job 
+    instance is only loaded, from the pre-parsed copy in the queue, the first 
+    time self.job is accessed.
     """
-    elixir.setup_all()
+    __slots__ = ('job_id', 'dataset', 'class_ad', '_job_state', '_job')
     
-    # Get the oldest entry.
-    q = JobQueueEntry.query.filter_by(busy=False)
-    entry = q.order_by(JobQueueEntry.date_added).first()
-    if(not entry):
-        # Nothing to see here. Move along.
+    def __init__(self, job_id, class_ad, job_state=None, dataset=None):
+        self.job_id = job_id
+        self.dataset = dataset
+        self.class_ad = class_ad
+        self._job_state = job_state
+        self._job = None
         return
     
-    # Mark it busy.
-    entry.busy = True
-    elixir.session.commit()
+    def __repr__(self):
+        return('QueuedJob(%r)' % (self.job_id))
+    
+    def __unicode__(self):
+        return(self.class_ad)
     
-    # Create and return the corresponding Job instance
-    return(Job(entry.class_ad))
+    @property
+    def job(self):
+        if(self._job is None):
+            self._job = _load_job(self.class_ad, self._job_state)
+            self._job_state = None
+        return(self._job)
 
 
-@logutils.logit
-def length():
+
+
+def _dump_job(job):
     """
-    Return the number of entries in the queue.
+    Return the pre-parsed form of the Job instance `job` we store in the queue:
+    the JSON text of its attribute names and values (see 
+    ClassAd.__getstate__()), with expressions and environments tagged as
+    {"e": text} and {"d": dictionary}. This does not depend on how the Job 
+    and ClassAd classes are laid out or where they live.
     """
-    elixir.setup_all()
-    return(JobQueueEntry.query.count())
+    (names, attrs) = job.__getstate__()
+    values = {}
+    for (key, value) in attrs.iteritems():
+        if(isinstance(value, Expression)):
+            value = {'e': value}
+        elif(isinstance(value, dict)):
+            value = {'d': value}
+        values[key] = value
+    return(unicode(json.dumps([names, values], separators=(',', ':'))))
+
+
+def _priority(job):
+    """
+    Return the priority of the Job instance `job`: its JobPrio attribute, 
+    evaluated if it is an expression. Jobs with no valid JobPrio have priority
+    0, just like in Condor.
+    """
+    value = getattr(job, 'JobPrio', 0)
+    if(not isinstance(value, (int, long, float)) or isinstance(value, bool)):
+        value = expressions.evaluate(value, job)
+    if(not isinstance(value, (int, long, float)) or isinstance(value, bool)):
+        return(0)
+    return(int(value))
 
 
-@ormutils.run_with_retries_and_rollback
-@logutils.logit
-def delete(job):
+def _owner(job):
     """
-    This is where we delete a Job instance from the queue. It generally means 
-    that that system has accepted our job and is running it.
+    Return the owner of the Job instance `job` (u'' if it does not say).
     """
-    # TODO: What is the jow queue entry is not marked busy?????
-    elixir.setup_all()
-    
-    # Find the job using its id.
-    entry = JobQueueEntry.query.filter_by(job_id=job.CL2S_JOB_ID).first()
-    if(not entry):
-        msg = 'Tried deleting a Job from the queue but could not find it (%s).'
-        raise(Exception(msg % (str(job))))
-    
-    # Delete it.
-    entry.delete()
-    elixir.session.commit()
+    owner = getattr(job, 'Owner', None)
+    if(not isinstance(owner, basestring)):
+        return(u'')
+    return(unicode(owner))
+
+
+def _row(job, class_ad=None):
+    """
+    Return the job_queue row dictionary for the Job instance `job`. Its ClassAd
+    text `class_ad` is computed unless given.
+    """
+    # Remeber the string representation of a Job instance is its most up to date
+    # ClassAd.
+    if(class_ad is None):
+        class_ad = unicode(job)
+    return({'job_id': job.CL2S_JOB_ID,
+            'date_added': datetime.datetime.now(),
+            'class_ad': class_ad,
+            'job_state': _dump_job(job),
+            'dataset': job.CL2S_DATASET,
+            'owner': _owner(job),
+            'priority': _priority(job),
+            'busy': False})
+
+
+def _load_job(class_ad, job_state):
+    """
+    Return the Job instance stored in the queue as `job_state` (see 
+    _dump_job()), falling back on parsing the ClassAd text `class_ad` for 
+    entries that do not have one, or that were queued by older versions (as
+    pickles, which we do not load: they can run any code).
+    """
+    if(isinstance(job_state, buffer)):
+        # Stored as binary by older versions.
+        job_state = str(job_state)
+    if(not job_state or job_state[0] != '['):
+        return(Job(class_ad))
+    (names, values) = json.loads(job_state)
+    for (key, value) in values.items():
+        if(isinstance(value, dict)):
+            values[key] = Expression(value['e']) if 'e' in value \
+                          else value['d']
+    job = Job.__new__(Job)
+    job.__setstate__((names, values))
+    return(job)
+
+
+
+
+def _counters():
+    """
+    Return the (table, key column name, defaults of new rows) of each counter
+    table.
+    """
+    return(((OwnerShare.table, 'owner', {'waiting': False,
+                                         'idle': 0,
+                                         'claimed': 0,
+                                         'recent_usage': 0.,
+                                         'last_decay': time.time()}),
+            (DatasetCount.table, 'dataset', {'idle': 0, 
+                                             'claimed': 0})))
+
+
+def _ensure_counters(rows):
+    """
+    Make sure that the owners and datasets of the job_queue `rows` have their
+    owner_share and dataset_count rows, so that the queue only ever needs to 
+    UPDATE those. Missing rows are inserted in the same transaction as the 
+    lookup. Should somebody else insert some of the same ones at the same 
+    time, we insert ours one by one, each in its own transaction: theirs are 
+    as good as ours.
+    """
+    missing = []
+    try:
+        with ormutils.transaction() as connection:
+            for (table, key, defaults) in _counters():
+                keys = set([row[key] for row in rows]) - set([None, ])
+                if(not keys):
+                    continue
+                existing = connection.execute(sqlalchemy.select([table.c[key]])
+                                              .where(table.c[key].in_(keys)))
+                keys -= set([row[key] for row in existing])
+                missing += [(table, dict(defaults, **{key: k})) for k in keys]
+            for (table, values) in missing:
+                connection.execute(table.insert(), **values)
+        return
+    except sqlalchemy.exc.IntegrityError:
+        pass
+    for (table, values) in missing:
+        try:
+            with ormutils.transaction() as connection:
+                connection.execute(table.insert(), **values)
+        except sqlalchemy.exc.IntegrityError:
+            pass
     return
-    
 
-@ormutils.run_with_retries_and_rollback
-@logutils.logit
-def reinsert(job):
+
+def _groups(rows):
     """
-    This is an undo on pop(). It can happen that we propose a Job instance to 
-    the Condor startd and it refoses to accept it. In that case we want to 
-    re-insert that job instance in the queue, i.e. mark it non busy.
+    Return the (owner, dataset, number of rows) groups of the job_queue `rows`
+    (row proxies or dictionaries with owner and dataset).
     """
-    # TODO: What is the jow queue entry is not marked busy?????
-    elixir.setup_all()
-    
-    # Find the job using its id.
-    entry = JobQueueEntry.query.filter_by(job_id=job.CL2S_JOB_ID).first()
-    if(not entry):
-        msg = 'Tried reinserting a Job in the queue but could not find it (%s).'
-        raise(Exception(msg % (str(job))))
-    
-    # Mark it non busy.
-    entry.busy = False
-    elixir.session.commit()
+    groups = collections.defaultdict(int)
+    for row in rows:
+        groups[(row['owner'], row['dataset'])] += 1
+    return([(owner, dataset, n) for ((owner, dataset), n) in groups.items()])
+
+
+def _update_counters(connection, table, key, deltas, usage=False):
+    """
+    Add to the idle, claimed and, if `usage`, recent_usage counters of the rows
+    of the counter `table` the amounts in `deltas`, a {value of the `key` 
+    column: (idle, claimed, usage)} dictionary. One executemany() for all the
+    rows.
+    """
+    if(not deltas):
+        return
     
-    # Create and return the corresponding Job instance
+    idle = table.c.idle + sqlalchemy.bindparam('_idle')
+    values = {'idle': idle,
+              'claimed': table.c.claimed + sqlalchemy.bindparam('_claimed')}
+    if('waiting' in table.c):
+        values['waiting'] = sqlalchemy.case([(idle > 0, True)], else_=False)
+    if(usage):
+        values['recent_usage'] = table.c.recent_usage + \
+                                 sqlalchemy.bindparam('_usage')
+    statement = table.update() \
+                     .where(table.c[key] == sqlalchemy.bindparam('_key')) \
+                     .values(**values)
+    connection.execute(statement, [{'_key': k, 
+                                    '_idle': i, 
+                                    '_claimed': c, 
+                                    '_usage': u}
+                                   for (k, (i, c, u)) in deltas.items()])
     return
 
 
+def _count(connection, groups, idle=0, claimed=0, usage=0):
+    """
+    Update the counters of the (owner, dataset, number of entries) `groups` 
+    (see _groups()): add `idle` and `claimed` times the number of entries to 
+    the idle and claimed counters of their owner and dataset and `usage` times
+    that to the recent usage of their owner. One executemany() per counter 
+    table.
+    """
+    owners = collections.defaultdict(int)
+    datasets = collections.defaultdict(int)
+    for (owner, dataset, n) in groups:
+        owners[owner] += n
+        datasets[dataset] += n
+    
+    # Entries queued before owners were recorded and entries with no dataset
+    # are not counted there.
+    _update_counters(connection, OwnerShare.table, 'owner',
+                     dict([(owner, (idle * n, claimed * n, usage * n))
+                           for (owner, n) in owners.items() 
+                           if owner is not None]),
+                     usage=bool(usage))
+    _update_counters(connection, DatasetCount.table, 'dataset',
+                     dict([(dataset, (idle * n, claimed * n, 0))
+                           for (dataset, n) in datasets.items() 
+                           if dataset is not None]))
+    return
 
 
+@stats.timed
+@logutils.logit
+def push(job):
+    """
+    Add the input Job instance `job` to the Job Queue.
+    """
+    elixir.setup_all()
+    
+    row = _row(job)
+    _ensure_counters([row, ])
+    _insert_rows([row, ])
+    return
 
 
+@ormutils.run_with_retries_and_rollback
+def _insert_rows(rows):
+    """
+    Insert the list of job_queue row dictionaries `rows` with a single 
+    executemany() in one transaction. The owner_share rows of their owners 
+    must exist already, and so must their dataset_count rows (see 
+    _ensure_counters()).
+    """
+    with ormutils.transaction() as connection:
+        _insert(connection, rows)
+    return
 
 
+def _insert(connection, rows):
+    """
+    Like _insert_rows() but in the transaction of `connection`, for callers 
+    that need the new entries to be queued together with changes of their own
+    (see Dag.py).
+    """
+    connection.execute(JobQueueEntry.table.insert(), rows)
+    _count(connection, _groups(rows), idle=1)
+    return
 
 
+@stats.timed
+@logutils.logit
+def push_many(jobs, chunk_size=None):
+    """
+    Add all the Job instances in the iterable `jobs` to the Job Queue. This is
+    what you want to use for large clusters: jobs are inserted `chunk_size` at 
+    a time (config.QUEUE_PUSH_CHUNK_SIZE by default), each chunk with a single
+    statement and transaction. `jobs` is consumed lazily, which means that it 
+    can be a generator.
+    
+    Each chunk is retried on its own: should one fail for good, the chunks 
+    before it stay queued.
+    
+    Return the number of jobs added to the queue.
+    """
+    return(_push_rows((_row(job) for job in jobs), chunk_size))
 
 
+@stats.timed
+@logutils.logit
+def push_cluster(template, chunk_size=None):
+    """
+    Add all the instances of the JobTemplate `template` (see JobTemplate.py) to
+    the Job Queue. Instances are generated as they are inserted, `chunk_size` 
+    at a time just like in push_many(): however large the cluster, only one 
+    chunk of it is ever in memory.
+    
+    Return the number of jobs added to the queue.
+    """
+    return(_push_rows((_row(job, class_ad) 
+                       for (job, class_ad) in template.instances()), 
+                      chunk_size))
 
 
+def _push_rows(rows, chunk_size=None):
+    """
+    Insert the job_queue row dictionaries in the iterable `rows` `chunk_size` 
+    at a time (see push_many()) and return how many they were.
+    """
+    elixir.setup_all()
+    
+    if(chunk_size is None):
+        chunk_size = config.QUEUE_PUSH_CHUNK_SIZE
+    if(chunk_size < 1):
+        raise(ValueError('chunk_size must be greater or equal to 1'))
+    
+    n = 0
+    rows = iter(rows)
+    while(True):
+        chunk = list(itertools.islice(rows, chunk_size))
+        if(not chunk):
+            break
+        _ensure_counters(chunk)
+        _insert_rows(chunk)
+        n += len(chunk)
+    return(n)
+
+
+def _claim_text(sql):
+    """
+    Return the claim statement `sql` as a text clause, binding :lease_expires
+    as a DateTime like the column it goes in.
+    """
+    return(sqlalchemy.text(sql, bindparams=[
+        sqlalchemy.bindparam('lease_expires', type_=elixir.DateTime)]))
 
 
+def _lease_expiry():
+    """
+    Return the expiry date of a lease taken now (see config.QUEUE_LEASE).
+    """
+    return(datetime.datetime.now() + 
+           datetime.timedelta(seconds=config.QUEUE_LEASE))
 
 
+def _filter(datasets=(), owner=None):
+    """
+    Return the SQL filter restricting claims to entries for any of the 
+    `datasets` and/or of `owner` (no filter at all if neither is given) 
+    together with its bind parameters.
+    """
+    (where, params) = ('', {})
+    if(datasets):
+        params = dict([('dataset%d' % (i), dataset) 
+                       for (i, dataset) in enumerate(datasets)])
+        where = AFFINITY_FILTER % (', '.join([':' + k for k in sorted(params)]))
+    if(owner is not None):
+        where += OWNER_FILTER
+        params['owner'] = owner
+    return(where, params)
+
+
+def _next_owner(connection):
+    """
+    Return the owner to be served next according to fair-share: the one with 
+    idle entries and the lowest recent usage. Return None if nobody has idle 
+    entries (as far as OwnerShare knows).
+    """
+    table = OwnerShare.table
+    return(connection.execute(sqlalchemy.select([table.c.owner])
+                              .where(table.c.waiting == True)
+                              .order_by(table.c.recent_usage, 
+                                        table.c.owner)
+                              .limit(1)).scalar())
 
 
+def _claim_order(connection, datasets=()):
+    """
+    Return the list of the (datasets, owner) filters a claim should try, in 
+    order: the owner fair-share says is next, if fair-share is on, for any of 
+    `datasets` and then for any dataset; then anybody for `datasets` and then
+    simply the oldest entry.
+    """
+    datasets = list(datasets)
+    owners = [None, ]
+    if(config.FAIRSHARE_ENABLED):
+        owner = _next_owner(connection)
+        if(owner is not None):
+            owners.insert(0, owner)
+    res = []
+    for owner in owners:
+        if(datasets):
+            res.append((datasets, owner))
+        res.append(((), owner))
+    return(res)
+
+
+def _claim_one(connection, datasets=(), owner=None):
+    """
+    Claim the oldest idle entry for any of `datasets` and of `owner` (the 
+    oldest idle entry tout court if neither is given). Return the claimed row 
+    or None.
+    """
+    (where, params) = _filter(datasets, owner)
+    claim_sql = CLAIM_STATEMENTS.get(connection.dialect.name)
+    if(claim_sql):
+        return(connection.execute(_claim_text(claim_sql % {'filter': where}),
+                                  busy=True,
+                                  idle=False,
+                                  lease_expires=_lease_expiry(),
+                                  **params).first())
+    return(_claim_conditional(connection, where, params))
+
+
+def _claim_conditional(connection, where='', params={}):
+    """
+    Claim the oldest idle entry on flavours that cannot do it in one statement.
+    `where` and `params` are the dataset and owner filters, if any (see 
+    _filter()).
+    
+    Pick a candidate and mark it busy only if it is still idle: if the UPDATE
+    did not touch exactly one row, somebody else claimed it in the meantime and
+    we simply move on to the next candidate. Return the claimed row or None if
+    the queue has no idle entries.
+    """
+    select_sql = SELECT_OLDEST % {'filter': where}
+    if(connection.dialect.name in SKIP_LOCKED_FLAVOURS):
+        select_sql += ' FOR UPDATE SKIP LOCKED'
+    select_oldest = sqlalchemy.text(select_sql)
+    conditional_claim = _claim_text(CONDITIONAL_CLAIM)
+    
+    while(True):
+        candidate = connection.execute(select_oldest, 
+                                       idle=False, 
+                                       **params).first()
+        if(candidate is None):
+            return
+        result = connection.execute(conditional_claim,
+                                    job_id=candidate.job_id,
+                                    busy=True,
+                                    idle=False,
+                                    lease_expires=_lease_expiry())
+        if(result.rowcount == 1):
+            return(candidate)
+
+
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def claim(datasets=()):
+    """
+    "Retrieve" the oldest entry from the JobQueue. By that we mean that we mark
+    the oldest entry in the job queue as busy and we return it as a QueuedJob
+    instance. If then the system tells us that it accepted it, we remove it 
+    using delete().
+    
+    If fair-share is on (config.FAIRSHARE_ENABLED), the oldest entry of the 
+    owner who has been handed the fewest Jobs lately goes first (see 
+    OwnerShare). If `datasets` is given, prefer the oldest entry for any of 
+    those datasets (e.g. the ones whose files the calling node already has) 
+    and fall back on the oldest entry overall if there is none.
+    
+    The claim is atomic: no two callers can ever be handed the same entry, no
+    matter how many of them poll the queue at the same time. It is also a 
+    lease: unless the entry is deleted or reinserted within config.QUEUE_LEASE
+    seconds, it goes back in the queue (see expire_leases()).
+    """
+    elixir.setup_all()
+    
+    # Grab and mark the oldest entry in one go.
+    with ormutils.transaction() as connection:
+        _sweep_if_due(connection)
+        row = None
+        for (preferred, owner) in _claim_order(connection, datasets):
+            row = _claim_one(connection, preferred, owner)
+            if(row is not None):
+                break
+        if(row is not None):
+            _count(connection, [(row.owner, row.dataset, 1), ], 
+                   idle=-1, claimed=1, usage=1)
+    if(row is None):
+        # Nothing to see here. Move along.
+        return
+    return(QueuedJob(row.job_id, row.class_ad, row.job_state, row.dataset))
 
 
+@stats.timed
+@logutils.logit
+def pop(datasets=()):
+    """
+    Like claim() but return the claimed Job instance (None if the queue has no
+    idle entries).
+    """
+    queued = claim(datasets)
+    if(queued is None):
+        return
+    return(queued.job)
 
 
+def _claim_batch(connection, n, owner=None):
+    """
+    Claim up to `n` of the oldest idle entries of `owner` (of anybody if None)
+    with a single statement. Return the claimed rows, in no particular order.
+    """
+    (where, params) = _filter(owner=owner)
+    flavour = connection.dialect.name
+    claim_sql = CLAIM_BATCH_STATEMENTS.get(flavour, 
+                                           CLAIM_BATCH_STATEMENTS[None])
+    claim_id = unicode(uuid.uuid4())
+    result = connection.execute(_claim_text(claim_sql % {'filter': where}),
+                                busy=True,
+                                idle=False,
+                                claim_id=claim_id,
+                                lease_expires=_lease_expiry(),
+                                n=n,
+                                **params)
+    if(flavour not in RETURNING_FLAVOURS):
+        result = connection.execute(sqlalchemy.text(SELECT_CLAIMED),
+                                    claim_id=claim_id)
+    return(result.fetchall())
+
+
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def claim_batch(n):
+    """
+    Like claim() but claim up to `n` of the oldest entries in the JobQueue with
+    a single statement. Return the corresponding QueuedJob instances, oldest 
+    first (an empty list if the queue has no idle entries).
+    
+    With fair-share on, the batch is filled with the entries of the owner to be
+    served next first and topped up with the oldest entries overall.
+    
+    The caller owns the claimed Jobs: each has to be either deleted or 
+    reinserted (see also release()) just like those returned by claim().
+    """
+    elixir.setup_all()
+    
+    if(n < 1):
+        return([])
+    
+    with ormutils.transaction() as connection:
+        _sweep_if_due(connection)
+        rows = []
+        for (preferred, owner) in _claim_order(connection):
+            rows += _claim_batch(connection, n - len(rows), owner)
+            if(len(rows) >= n):
+                break
+        _count(connection, _groups(rows), idle=-1, claimed=1, usage=1)
+    rows.sort(key=lambda row: (-(row.priority or 0), row.date_added))
+    return([QueuedJob(row.job_id, row.class_ad, row.job_state, row.dataset) 
+            for row in rows])
+
+
+@stats.timed
+@logutils.logit
+def pop_batch(n):
+    """
+    Like claim_batch() but return the claimed Job instances.
+    """
+    return([queued.job for queued in claim_batch(n)])
 
 
+def _release(connection, where, refund=True):
+    """
+    Mark the busy entries selected by the clause `where` non busy and, if 
+    `refund`, give their owners back the usage they were charged for them. 
+    Return the number of entries put back.
+    
+    The entries are locked (SELECT ... FOR UPDATE) before anything is counted:
+    somebody else releasing some of the same ones at the same time (e.g. 
+    release() and expire_leases()) waits for us and then finds them idle, 
+    instead of counting them a second time.
+    """
+    table = JobQueueEntry.table
+    rows = connection.execute(
+        sqlalchemy.select([table.c.job_id, table.c.owner, table.c.dataset],
+                          for_update=True)
+        .where(where)
+        .where(table.c.busy == True)).fetchall()
+    n = 0
+    job_ids = [row.job_id for row in rows]
+    for i in range(0, len(job_ids), RELEASE_CHUNK_SIZE):
+        n += connection.execute(table.update()
+                                .where(table.c.job_id.in_(
+                                    job_ids[i:i+RELEASE_CHUNK_SIZE]))
+                                .where(table.c.busy == True)
+                                .values(busy=False, 
+                                        claim_id=None, 
+                                        lease_expires=None)).rowcount
+    _count(connection, _groups(rows), idle=1, claimed=-1, 
+           usage=-1 if refund else 0)
+    return(n)
+
+
+def _expire_leases(connection, now=None):
+    """
+    Put back in the queue the busy entries whose lease expired before `now` 
+    (datetime.datetime.now() by default). Return their number.
+    """
+    if(now is None):
+        now = datetime.datetime.now()
+    
+    # This walks ix_job_queue_lease and is all it takes when nothing expired: 
+    # no need to lock anything for writing then.
+    table = JobQueueEntry.table
+    expired = sqlalchemy.and_(table.c.busy == True, 
+                              table.c.lease_expires < now)
+    if(connection.execute(sqlalchemy.select([table.c.job_id])
+                          .where(expired)
+                          .limit(1)).first() is None):
+        return(0)
+    # Their owners stay charged: the Jobs were handed out and may well have
+    # run (and taken their node down).
+    n = _release(connection, expired, refund=False)
+    logutils.logger.warning('Put back %d Jobs whose claim had expired.' % (n))
+    return(n)
+
+
+# When this process last looked for expired leases (see _sweep_if_due()).
+_LAST_SWEEP = 0.
+
+
+def _sweep_if_due(connection):
+    """
+    Expire leases (see _expire_leases()) if this process has not done it in
+    the last config.QUEUE_SWEEP_INTERVAL seconds.
+    """
+    global _LAST_SWEEP
+    
+    now = time.time()
+    if(now - _LAST_SWEEP < config.QUEUE_SWEEP_INTERVAL):
+        return(0)
+    _LAST_SWEEP = now
+    return(_expire_leases(connection))
 
 
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def release(job_ids):
+    """
+    Bulk version of reinsert() taking Job ids instead of Job instances: mark all
+    the entries with id in `job_ids` non busy with a single statement. Ids not 
+    in the queue are ignored.
+    
+    Return the number of entries that were put back in the queue.
+    """
+    elixir.setup_all()
+    
+    job_ids = list(job_ids)
+    if(not job_ids):
+        return(0)
+    
+    table = JobQueueEntry.table
+    with ormutils.transaction() as connection:
+        n = _release(connection, table.c.job_id.in_(job_ids))
+    return(n)
 
 
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def expire_leases(now=None):
+    """
+    Put back in the queue all the busy entries whose claim expired before `now`
+    (datetime.datetime.now() by default): those claimed by nodes that went 
+    away without deleting or reinserting them. Their lease is 
+    config.QUEUE_LEASE seconds from the time they were claimed. Unlike 
+    release(), this does not give their owners back the usage they were 
+    charged for them.
+    
+    claim() and claim_batch() do this on their own every 
+    config.QUEUE_SWEEP_INTERVAL seconds; the CL2S daemon does it periodically
+    even when nobody claims anything.
+    
+    Return the number of entries that were put back in the queue.
+    """
+    elixir.setup_all()
+    
+    with ormutils.transaction() as connection:
+        n = _expire_leases(connection, now)
+    return(n)
 
 
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def reprioritize(priority=None, delta=None, job_ids=None, datasets=None):
+    """
+    Set the priority of queued entries to `priority` or, if `delta` is given
+    instead, change it by that much. Only the entries with id in `job_ids` 
+    and/or for any of `datasets` are touched if either is given, all of them 
+    otherwise. Whatever the number of entries, this is a single UPDATE.
+    
+    Only the priority column changes: the ClassAds in the queue keep their 
+    original JobPrio.
+    
+    Return the number of entries that were reprioritized.
+    """
+    elixir.setup_all()
+    
+    if((priority is None) == (delta is None)):
+        raise(ValueError('Exactly one of priority and delta must be given.'))
+    
+    table = JobQueueEntry.table
+    statement = table.update()
+    for (column, values) in ((table.c.job_id, job_ids), 
+                             (table.c.dataset, datasets)):
+        if(values is None):
+            continue
+        values = [unicode(value) for value in values]
+        if(not values):
+            return(0)
+        statement = statement.where(column.in_(values))
+    if(priority is not None):
+        statement = statement.values(priority=int(priority))
+    else:
+        statement = statement.values(priority=table.c.priority + int(delta))
+    with ormutils.transaction() as connection:
+        result = connection.execute(statement)
+    return(result.rowcount)
+
+
+@stats.timed
+@logutils.logit
+def counts(owner=None, dataset=None):
+    """
+    Return the number of idle and of busy (claimed) entries in the queue as an
+    (idle, claimed) tuple: those of `owner` or those for `dataset` if either 
+    is given (not both), all of them otherwise.
+    
+    These are read from the counters kept up to date along with the queue (a 
+    single row for an owner or a dataset, one row per owner for the whole 
+    queue) rather than counted. See reconcile_counters() for queues that 
+    predate them.
+    """
+    elixir.setup_all()
+    
+    if(owner is not None and dataset is not None):
+        raise(ValueError('Entries are counted by owner or by dataset, not ' + 
+                         'by both.'))
+    
+    (table, where) = (OwnerShare.table, None)
+    if(owner is not None):
+        where = table.c.owner == owner
+    elif(dataset is not None):
+        table = DatasetCount.table
+        where = table.c.dataset == dataset
+    query = sqlalchemy.select([sqlalchemy.func.sum(table.c.idle), 
+                               sqlalchemy.func.sum(table.c.claimed)])
+    if(where is not None):
+        query = query.where(where)
+    with ormutils.transaction() as connection:
+        (idle, claimed) = connection.execute(query).first()
+    return((int(idle or 0), int(claimed or 0)))
+
+
+@stats.timed
+@logutils.logit
+def length():
+    """
+    Return the number of entries in the queue (see counts()).
+    """
+    return(sum(counts()))
 
 
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def delete_by_id(job_id):
+    """
+    Like delete() but take the id of the Job (i.e. its CL2S_JOB_ID) instead of
+    the Job instance itself. Entries that are not marked busy are deleted all
+    the same (and counted as such).
+    """
+    elixir.setup_all()
+    
+    table = JobQueueEntry.table
+    selected = table.c.job_id == job_id
+    with ormutils.transaction() as connection:
+        row = connection.execute(sqlalchemy.select([table.c.owner, 
+                                                    table.c.dataset,
+                                                    table.c.busy])
+                                 .where(selected)).first()
+        result = connection.execute(table.delete().where(selected))
+        if(row is not None and row.busy):
+            _count(connection, [(row.owner, row.dataset, 1), ], claimed=-1)
+        elif(row is not None):
+            _count(connection, [(row.owner, row.dataset, 1), ], idle=-1)
+    if(not result.rowcount):
+        msg = 'Tried deleting a Job from the queue but could not find it (%s).'
+        raise(Exception(msg % (job_id)))
+    return
 
 
+@stats.timed
+def delete(job):
+    """
+    This is where we delete a Job instance from the queue. It generally means 
+    that that system has accepted our job and is running it.
+    """
+    return(delete_by_id(job.CL2S_JOB_ID))
 
 
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def reinsert_by_id(job_id):
+    """
+    Like reinsert() but take the id of the Job (i.e. its CL2S_JOB_ID) instead 
+    of the Job instance itself. Entries that are not marked busy are left as
+    they are.
+    """
+    elixir.setup_all()
+    
+    # Mark it non busy.
+    table = JobQueueEntry.table
+    selected = table.c.job_id == job_id
+    with ormutils.transaction() as connection:
+        found = _release(connection, selected) or \
+                connection.execute(sqlalchemy.select([table.c.job_id])
+                                   .where(selected)).first() is not None
+    if(not found):
+        msg = 'Tried reinserting a Job in the queue but could not find it (%s).'
+        raise(Exception(msg % (job_id)))
+    return
 
 
+@stats.timed
+def reinsert(job):
+    """
+    This is an undo on pop(). It can happen that we propose a Job instance to 
+    the Condor startd and it refoses to accept it. In that case we want to 
+    re-insert that job instance in the queue, i.e. mark it non busy.
+    """
+    return(reinsert_by_id(job.CL2S_JOB_ID))
 
 
 
 
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def decay_usage(half_life=None, now=None):
+    """
+    Decay the recent usage of all the owners so that it halves every 
+    `half_life` seconds (config.FAIRSHARE_HALF_LIFE by default). Each owner is
+    decayed for the time elapsed since its last decay as of `now` (seconds 
+    since the epoch, time.time() by default): this can be called as often as 
+    convenient and by any number of processes at once.
+    
+    Return the number of owners whose usage was decayed.
+    """
+    elixir.setup_all()
+    
+    if(half_life is None):
+        half_life = config.FAIRSHARE_HALF_LIFE
+    if(now is None):
+        now = time.time()
+    
+    table = OwnerShare.table
+    n = 0
+    with ormutils.transaction() as connection:
+        rows = connection.execute(sqlalchemy.select([table.c.owner, 
+                                                     table.c.last_decay]))
+        for row in rows.fetchall():
+            if(row.last_decay is not None and row.last_decay >= now):
+                continue
+            factor = 1.
+            if(row.last_decay is not None):
+                factor = .5 ** ((now - row.last_decay) / half_life)
+            # Only if nobody else decayed it in the meantime.
+            result = connection.execute(
+                table.update()
+                .where(table.c.owner == row.owner)
+                .where(table.c.last_decay == row.last_decay)
+                .values(recent_usage=table.c.recent_usage * factor,
+                        last_decay=now))
+            n += result.rowcount
+    return(n)
+
+
+@stats.timed
+@logutils.logit
+def shares():
+    """
+    Return the fair-share state of all the owners as a list of dictionaries 
+    with keys owner, idle, claimed, recent_usage and share (the fraction of 
+    the recent usage of all the owners that is theirs). The owner to be served
+    next comes first.
+    """
+    elixir.setup_all()
+    
+    table = OwnerShare.table
+    with ormutils.transaction() as connection:
+        rows = connection.execute(sqlalchemy.select([table])
+                                  .order_by(table.c.waiting.desc(),
+                                            table.c.recent_usage,
+                                            table.c.owner)).fetchall()
+    total = sum([max(row.recent_usage, 0.) for row in rows])
+    return([{'owner': row.owner,
+             'idle': row.idle,
+             'claimed': row.claimed,
+             'recent_usage': row.recent_usage,
+             'share': total and max(row.recent_usage, 0.) / total}
+            for row in rows])
+
+
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+@logutils.logit
+def reconcile_counters():
+    """
+    Rebuild the idle and claimed counters of all the owners and datasets (see
+    counts()) from the queue itself, with one UPDATE per counter table. Needed
+    once after upgrading a queue created before the counters existed (which
+    jobqueue-init.py does); harmless at any other time. Recent usage is left 
+    alone.
+    
+    Entries with no owner (i.e. queued before the owner column existed) get 
+    the Owner of their ClassAd first.
+    
+    Return the number of owners and datasets.
+    """
+    elixir.setup_all()
+    
+    queue = JobQueueEntry.table
+    with ormutils.transaction() as connection:
+        owners = []
+        for (job_id, class_ad) in connection.execute(
+                sqlalchemy.select([queue.c.job_id, queue.c.class_ad])
+                .where(queue.c.owner == u'')):
+            owner = ClassAd.extract_attributes(class_ad or u'', 
+                                               ('Owner', )).get('Owner')
+            if(isinstance(owner, basestring) and owner):
+                owners.append({'id': job_id, 'new_owner': unicode(owner)})
+        if(owners):
+            connection.execute(queue.update()
+                               .where(queue.c.job_id == 
+                                      sqlalchemy.bindparam('id'))
+                               .values(owner=sqlalchemy.bindparam('new_owner')),
+                               owners)
+        rows = connection.execute(sqlalchemy.select([queue.c.owner, 
+                                                     queue.c.dataset])
+                                  .distinct()).fetchall()
+    _ensure_counters(rows)
+    
+    n = 0
+    for (table, key, defaults) in _counters():
+        def count(busy):
+            return(sqlalchemy.select([sqlalchemy.func.count(queue.c.job_id)])
+                   .where(queue.c[key] == table.c[key])
+                   .where(queue.c.busy == busy)
+                   .correlate(table)
+                   .as_scalar())
+        values = {'idle': count(False), 'claimed': count(True)}
+        if('waiting' in table.c):
+            values['waiting'] = sqlalchemy.case([(count(False) > 0, True)], 
+                                                else_=False)
+        with ormutils.transaction() as connection:
+            n += connection.execute(table.update().values(**values)).rowcount
+    return(n)
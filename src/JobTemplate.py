@@ -0,0 +1,224 @@
+"""
+Job cluster templates.
+
+A submit description file describes a cluster of jobs (see macros.py for the
+queue statement) which only differ by the value of a few macros (e.g.
+$(Process) or the queue variables). Rather than turning the whole ad into text,
+replacing the macros and parsing it back once per job, a JobTemplate parses it
+once, expands the macros that are the same for every job (e.g. the ones
+defined in the submit file itself) and compiles what is left, both in the ad
+text and in the attribute values. Jobs are then generated a block at a time:
+each compiled text is filled for the whole block in one go.
+"""
+import itertools
+import re
+import uuid
+
+from ClassAd import ClassAd, Expression
+from ClassAd import _attribute_to_classad_val, _classad_val_to_attribute_val
+from Job import Job
+import macros
+
+
+
+# Constants
+# Macros with a different value for each job, besides the queue variables.
+PROCESS_MACROS = ('process', 'procid')
+ITEM_MACROS = ('itemindex', 'row')
+JOB_MACROS = PROCESS_MACROS + ITEM_MACROS + ('step', 'cl2s_job_id')
+# Macros with the same value for every job, besides the submit file ones.
+CLUSTER_MACROS = ('cluster', 'clusterid')
+# Jobs are generated this many at a time.
+BLOCK_SIZE = 1000
+# Characters that make filling string literals need parsing.
+UNSAFE = re.compile(r'["\\]')
+
+
+
+
+def _macro_text(key, value):
+    """
+    Return the text the attribute `key` with Python value `value` expands to
+    when used as a macro: its ClassAd text, without the quotes for strings.
+    """
+    text = unicode(_attribute_to_classad_val(key, value))
+    if(key == 'environment' or
+       (isinstance(value, basestring) and not isinstance(value, Expression))):
+        return(text[1:-1])
+    return(text)
+
+
+
+
+class JobTemplate(object):
+    """
+    A Job cluster, parsed once. Its instances are Job instances with all the
+    macros expanded and which get their own CL2S_JOB_ID (the cluster id
+    followed by the instance number) unless the ad defines one.
+    """
+    def __init__(self, ad, cluster_id=None, queue=None, basedir=None):
+        """
+        Create the template for the Job cluster described by the ClassAd (or
+        submit description text) `ad`. The jobs are given by the queue
+        statement `queue` (see macros.py), which defaults to the one in the
+        text or to `Queue N` for ClassAd instances with CL2S_INSTANCES = N.
+        `queue` can also be an already parsed statement (see 
+        macros.parse_queue()). Queue item files are relative to `basedir` (the
+        current directory by default). `cluster_id` defaults to a new UUID.
+        """
+        if(isinstance(ad, basestring)):
+            (ad, statement) = macros.split_queue(ad)
+            ad = ClassAd(ad)
+            if(queue is None):
+                queue = statement
+        if(isinstance(queue, tuple)):
+            (self.steps, self.variables, self.items) = queue
+        elif(queue is not None):
+            (self.steps, self.variables, self.items) = \
+                macros.parse_queue(queue, basedir)
+        else:
+            (self.steps, self.variables, self.items) = \
+                (getattr(ad, 'CL2S_INSTANCES', 1), [], [()])
+        self.size = self.steps * len(self.items)
+        if(cluster_id is None):
+            cluster_id = unicode(uuid.uuid4())
+        self.cluster_id = cluster_id
+
+        # Build the template Job out of a copy of the ad attributes: each
+        # instance is a single job.
+        template = Job.__new__(Job)
+        template.__setstate__((list(ad._names), dict(ad._attrs)))
+        template.CL2S_INSTANCES = 1
+        if(not hasattr(template, 'CL2S_JOB_ID')):
+            template.CL2S_JOB_ID = u'$(CL2S_JOB_ID)'
+        template._set_defaults()
+        (self._names, self._attrs) = template.__getstate__()
+
+        # Expand the macros that are the same for every job. What is left
+        # refers to per job macros only.
+        job_macros = frozenset(JOB_MACROS +
+                               tuple([v.lower() for v in self.variables]))
+        definitions = dict([(key, _macro_text(key, value))
+                            for (key, value) in self._attrs.items()])
+        for key in CLUSTER_MACROS:
+            definitions[key] = self.cluster_id
+        for key in job_macros:
+            definitions.pop(key, None)
+        texts = {}
+        for name in self._names:
+            key = name.lower()
+            text = unicode(_attribute_to_classad_val(key, self._attrs[key]))
+            if('$(' not in text):
+                continue
+            text = macros.expand(text, definitions, keep=job_macros)
+            self._attrs[key] = _classad_val_to_attribute_val(key, text)
+            texts[key] = text
+
+        # The ClassAd text of the jobs and the attributes still using macros,
+        # compiled.
+        self._text = macros.compile_text(unicode(template))
+        self._slots = []
+        for (key, text) in texts.items():
+            compiled = macros.compile_text(text)
+            if(not compiled[1]):
+                continue
+            # Plain string literals are filled without the quotes and need no
+            # parsing, as long as the macros do not bring in quotes or 
+            # backslashes (see _values()).
+            body = None
+            if(key != 'environment' and len(text) > 1 and text[0] == '"' and 
+               text[-1] == '"' and not UNSAFE.search(text[1:-1])):
+                body = macros.compile_text(text[1:-1])
+            self._slots.append((key, compiled, body))
+
+        # The per job macros actually used.
+        self._used = set(self._text[1])
+        for (key, compiled, body) in self._slots:
+            self._used.update(compiled[1])
+        return
+
+
+    def __len__(self):
+        return(self.size)
+
+
+    def _columns(self, start, stop):
+        """
+        Return the {macro name: list of values} dictionary of the per job
+        macros used by the instances from number `start` to `stop` (excluded).
+        """
+        used = self._used
+        steps = self.steps
+        columns = {}
+        if(used.intersection(PROCESS_MACROS + ('cl2s_job_id', ))):
+            processes = [unicode(p) for p in xrange(start, stop)]
+            for key in PROCESS_MACROS:
+                columns[key] = processes
+            columns['cl2s_job_id'] = [u'%s.%s' % (self.cluster_id, p)
+                                      for p in processes]
+        if('step' in used):
+            columns['step'] = [unicode(p % steps) for p in xrange(start, stop)]
+        indices = xrange(start // steps, (stop - 1) // steps + 1)
+        if(steps != 1):
+            indices = [p // steps for p in xrange(start, stop)]
+        if(used.intersection(ITEM_MACROS)):
+            column = [unicode(i) for i in indices]
+            for key in ITEM_MACROS:
+                columns[key] = column
+        items = self.items
+        for (i, name) in enumerate(self.variables):
+            if(name.lower() in used):
+                columns[name.lower()] = [items[j][i] for j in indices]
+        return(columns)
+
+
+    def instance(self, process):
+        """
+        Return the (Job instance, ClassAd text) pair of instance number
+        `process` of the cluster. The text is what unicode() of the Job
+        instance would return.
+        """
+        return(self.instances(process, process + 1).next())
+
+
+    def instances(self, start=0, stop=None):
+        """
+        Generate the (Job instance, ClassAd text) pairs of the instances of the
+        cluster from number `start` to `stop` (excluded, the cluster size by
+        default), one at a time.
+        """
+        if(stop is None):
+            stop = self.size
+        for first in xrange(start, stop, BLOCK_SIZE):
+            last = min(first + BLOCK_SIZE, stop)
+            n = last - first
+            columns = self._columns(first, last)
+            keys = [key for (key, compiled, body) in self._slots]
+            values = self._values(columns, n) or [()] * n
+            texts = macros.fill_all(self._text, columns, n)
+            for (text, row) in itertools.izip(texts, values):
+                attrs = self._attrs.copy()
+                attrs.update(itertools.izip(keys, row))
+                job = Job.__new__(Job)
+                job.__setstate__((list(self._names), attrs))
+                yield((job, text))
+        return
+
+
+    def _values(self, columns, n):
+        """
+        Return the list of the `n` rows of values of the attributes still 
+        using macros (in the order of self._slots) given the per job macro 
+        `columns` (see _columns()).
+        """
+        # Macros whose values can go in a string literal as they are.
+        safe = set([name for (name, column) in columns.items()
+                    if not UNSAFE.search(u''.join(column))])
+        res = []
+        for (key, compiled, body) in self._slots:
+            if(body is not None and safe.issuperset(body[1])):
+                res.append(macros.fill_all(body, columns, n))
+                continue
+            res.append([_classad_val_to_attribute_val(key, text) 
+                        for text in macros.fill_all(compiled, columns, n)])
+        return(zip(*res))
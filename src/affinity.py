@@ -0,0 +1,104 @@
+"""
+Dataset affinity.
+
+Our jobs keep re-reading the same input datasets. Handing the jobs of a dataset
+to the nodes that processed that dataset recently saves copying its files all
+over again. The job fetch hook finds out which datasets a node has by looking
+at
+    1. the slot ClassAd attribute config.AFFINITY_SLOT_ATTRIBUTE (a comma
+       separated list of dataset names, e.g. published by a startd cron job);
+    2. a node-local cache file where it records the dataset of each job it
+       hands out, most recent first.
+It then asks the queue for a job for any of those datasets and falls back on
+the oldest job in the queue if there is none (see JobQueue.claim()).
+"""
+import os
+import threading
+
+import ClassAd
+import config
+
+
+
+
+# Serializes cache file updates made by the threads of the node daemon (hook
+# processes replace the file atomically and do not need it).
+_LOCK = threading.Lock()
+
+
+
+
+def slot_datasets(slot_ad, attribute=None):
+    """
+    Return the list of datasets advertised in the raw slot ClassAd `slot_ad`
+    by `attribute` (config.AFFINITY_SLOT_ATTRIBUTE by default).
+    """
+    if(attribute is None):
+        attribute = config.AFFINITY_SLOT_ATTRIBUTE
+    if(not attribute or not slot_ad):
+        return([])
+    value = ClassAd.extract_attributes(slot_ad, [attribute]).get(attribute)
+    if(not isinstance(value, basestring)):
+        return([])
+    return([d.strip() for d in value.split(',') if d.strip()])
+
+
+def recent_datasets(path=None):
+    """
+    Return the list of the datasets recorded in the cache file `path`
+    (config.AFFINITY_CACHE_FILE by default), most recent first.
+    """
+    if(path is None):
+        path = config.AFFINITY_CACHE_FILE
+    try:
+        f = open(path)
+    except IOError:
+        return([])
+    try:
+        return([line.strip().decode('utf-8') for line in f if line.strip()])
+    finally:
+        f.close()
+
+
+def record(dataset, path=None, size=None):
+    """
+    Record in the cache file `path` (config.AFFINITY_CACHE_FILE by default)
+    that the dataset `dataset` was just handed out on this node, keeping at
+    most `size` (config.AFFINITY_CACHE_SIZE by default) datasets.
+    """
+    if(not dataset):
+        return
+    if(path is None):
+        path = config.AFFINITY_CACHE_FILE
+    if(size is None):
+        size = config.AFFINITY_CACHE_SIZE
+
+    with _LOCK:
+        datasets = recent_datasets(path)
+        datasets = [dataset, ] + [d for d in datasets if d != dataset]
+
+        # Write the new file next to the old one and swap them, so that other
+        # hooks never see a half written file.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        f = open(tmp_path, 'w')
+        try:
+            f.write(''.join([d.encode('utf-8') + '\n'
+                             for d in datasets[:size]]))
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    return
+
+
+def datasets(slot_ad):
+    """
+    Return the datasets the node described by the raw slot ClassAd `slot_ad`
+    should preferably be given jobs for: the ones advertised in the slot ad
+    followed by the ones in the cache file. Return an empty list if affinity
+    is turned off.
+    """
+    if(not config.AFFINITY_ENABLED):
+        return([])
+    res = slot_datasets(slot_ad)
+    res += [d for d in recent_datasets() if d not in res]
+    return(res)
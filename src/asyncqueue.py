@@ -0,0 +1,287 @@
+"""
+Non-blocking job queue access for services.
+
+The JobQueue functions block their caller for as long as the database takes,
+retries included (see ormutils.run_with_retries_and_rollback). A service
+handling many clients from a single thread (e.g. a submission gateway built
+around an event loop) cannot afford that. An AsyncJobQueue runs them on a
+bounded pool of worker threads instead and hands back a Future right away:
+at most `max_workers` queue operations talk to the database at any time, all
+the others wait their turn in memory.
+
+Retryable database errors (locks, deadlocks, lost connections) are not slept
+on by the workers: the operation is resubmitted after a back-off delay by a
+timer, and the worker moves on to the next one in the meantime.
+
+Future callbacks run in the worker threads: services with an event loop of
+their own hand the result over to it from there (e.g. with the thread-safe
+"call soon" of the loop).
+"""
+import itertools
+import Queue
+import sys
+import threading
+
+import elixir
+
+import config
+import JobQueue
+import logutils
+import ormutils
+
+
+
+
+# Constants
+# What workers are told to stop with.
+_STOP = object()
+
+
+
+
+class Future(object):
+    """
+    The result of an operation that is still running. Thread-safe.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        return
+
+
+    def done(self):
+        """
+        Return True if the operation has completed (or failed).
+        """
+        return(self._done.is_set())
+
+
+    def result(self, timeout=None):
+        """
+        Wait up to `timeout` seconds (forever by default) for the operation to
+        complete and return its result. Raise the exception the operation
+        raised, if any, and RuntimeError if it does not complete in time.
+        """
+        if(not self._done.wait(timeout)):
+            raise(RuntimeError('Timed out waiting for the result.'))
+        if(self._exc_info is not None):
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return(self._result)
+
+
+    def exception(self, timeout=None):
+        """
+        Wait like result() and return the exception the operation raised, or
+        None.
+        """
+        if(not self._done.wait(timeout)):
+            raise(RuntimeError('Timed out waiting for the result.'))
+        if(self._exc_info is not None):
+            return(self._exc_info[1])
+        return
+
+
+    def add_done_callback(self, fn):
+        """
+        Call `fn` with the Future as only argument when the operation
+        completes, or right away if it already has.
+        """
+        with self._lock:
+            if(not self._done.is_set()):
+                self._callbacks.append(fn)
+                return
+        fn(self)
+        return
+
+
+    def _set(self, result=None, exc_info=None):
+        with self._lock:
+            (self._result, self._exc_info) = (result, exc_info)
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                logutils.logger.error('Exception in Future callback: %s' % (e))
+        return
+
+
+
+
+class _Then(object):
+    """
+    Returned by an operation made of several steps (each one retried on its
+    own): the next step is f(*args) and the Future gets its result instead.
+    """
+    def __init__(self, f, *args):
+        self.f = f
+        self.args = args
+        return
+
+
+
+
+class AsyncJobQueue(object):
+    """
+    The JobQueue operations, run by `max_workers` threads and returning
+    Futures. Retryable database errors are retried up to `max_retries` times
+    with exponential back-off (see ormutils.backoff()).
+    """
+    def __init__(self, max_workers=None, max_retries=ormutils.MAX_RETRIES,
+                 sleep_time=ormutils.SLEEP_TIME,
+                 max_sleep_time=ormutils.MAX_SLEEP_TIME):
+        """
+        `max_workers` defaults to config.ENGINE_POOL_SIZE: more workers would
+        only wait for database connections.
+        """
+        if(max_workers is None):
+            max_workers = config.ENGINE_POOL_SIZE
+        if(max_workers < 1):
+            raise(ValueError('max_workers must be greater than 0'))
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.sleep_time = sleep_time
+        self.max_sleep_time = max_sleep_time
+
+        self._tasks = Queue.Queue()
+        # Number of operations submitted and not done yet.
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._closed = False
+        self._workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._work,
+                                      name='AsyncJobQueue-%d' % (i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        return
+
+
+    def _work(self):
+        with ormutils.deferred_retries():
+            while(True):
+                task = self._tasks.get()
+                if(task is _STOP):
+                    return
+                self._run(*task)
+        return
+
+
+    def _run(self, future, retries, f, args, kwargs):
+        try:
+            result = f(*args, **kwargs)
+        except Exception, e:
+            exc_info = sys.exc_info()
+            if(ormutils.is_retryable(e) and retries < self.max_retries):
+                logutils.logger.warning('Retrying %s (%d/%d): %s' \
+                                        % (f.__name__, retries + 1,
+                                           self.max_retries, e))
+                # Back in the queue after the back-off delay.
+                timer = threading.Timer(ormutils.backoff(retries + 1,
+                                                         self.sleep_time,
+                                                         self.max_sleep_time),
+                                        self._tasks.put,
+                                        ((future, retries + 1, f, args,
+                                          kwargs), ))
+                timer.daemon = True
+                timer.start()
+                return
+            self._done(future, exc_info=exc_info)
+            return
+        if(isinstance(result, _Then)):
+            # One more step: its retries start from scratch.
+            self._tasks.put((future, 0, result.f, result.args, {}))
+            return
+        self._done(future, result)
+        return
+
+
+    def _done(self, future, result=None, exc_info=None):
+        future._set(result, exc_info)
+        with self._idle:
+            self._pending -= 1
+            if(not self._pending):
+                self._idle.notify_all()
+        return
+
+
+    def submit(self, f, *args, **kwargs):
+        """
+        Schedule the call f(*args, **kwargs) and return its Future.
+        """
+        with self._idle:
+            if(self._closed):
+                raise(RuntimeError('The queue has been shut down.'))
+            self._pending += 1
+        future = Future()
+        self._tasks.put((future, 0, f, args, kwargs))
+        return(future)
+
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting operations and stop the workers. If `wait`, wait for
+        the operations already submitted (retries included) to be done first;
+        otherwise the ones waiting to be retried are dropped.
+        """
+        with self._idle:
+            self._closed = True
+            while(wait and self._pending):
+                self._idle.wait()
+        for worker in self._workers:
+            self._tasks.put(_STOP)
+        if(wait):
+            for worker in self._workers:
+                worker.join()
+        return
+
+
+    # The JobQueue operations.
+    def push(self, job):
+        return(self.submit(JobQueue.push, job))
+
+    def push_many(self, jobs, chunk_size=None):
+        """
+        Like JobQueue.push_many(), except that each chunk is an operation of
+        its own, retried on its own: retrying the whole push_many() would
+        queue the chunks before the failed one twice (or lose them, if `jobs`
+        is a generator). The Future result is the number of jobs queued.
+        """
+        if(chunk_size is None):
+            chunk_size = config.QUEUE_PUSH_CHUNK_SIZE
+        if(chunk_size < 1):
+            raise(ValueError('chunk_size must be greater or equal to 1'))
+        rows = (JobQueue._row(job) for job in jobs)
+        return(self.submit(self._next_chunk, rows, chunk_size, 0))
+
+    def _next_chunk(self, rows, chunk_size, n):
+        # Read the next chunk of `rows`, `n` rows having been queued so far.
+        elixir.setup_all()
+        chunk = list(itertools.islice(rows, chunk_size))
+        if(not chunk):
+            return(n)
+        return(_Then(self._push_chunk, rows, chunk_size, n, chunk))
+
+    def _push_chunk(self, rows, chunk_size, n, chunk):
+        # Queue the rows in the list `chunk` in one transaction.
+        JobQueue._ensure_counters(chunk)
+        JobQueue._insert_rows(chunk)
+        return(_Then(self._next_chunk, rows, chunk_size, n + len(chunk)))
+
+    def pop(self, datasets=()):
+        return(self.submit(JobQueue.pop, datasets))
+
+    def delete(self, job):
+        return(self.submit(JobQueue.delete, job))
+
+    def reinsert(self, job):
+        return(self.submit(JobQueue.reinsert, job))
+
+    def length(self):
+        return(self.submit(JobQueue.length))
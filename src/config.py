@@ -25,6 +25,19 @@ for name in names:
 if(not config):
     raise(Exception('No configuration file found in any of %s' % (str(names))))
 
+def _get(section, option, default):
+    """
+    Return the value of `option` in `section`, converted to the type of 
+    `default`. Fall back to `default` if the config file does not have it (e.g.
+    because it predates that option).
+    """
+    if(not config.has_option(section, option)):
+        return(default)
+    if(isinstance(default, bool)):
+        return(config.getboolean(section, option))
+    return(type(default)(config.get(section, option)))
+
+
 # Configuration!
 DATABASE_HOST = config.get('Database', 'host')
 DATABASE_PORT = config.getint('Database', 'port')
@@ -35,6 +48,43 @@ DATABASE_FLAVOUR = config.get('Database', 'flavour')
 
 LOG_LEVEL = config.get('Log', 'level')
 
+QUEUE_PUSH_CHUNK_SIZE = _get('Queue', 'push_chunk_size', 1000)
+QUEUE_LEASE = _get('Queue', 'lease', 300.)
+QUEUE_SWEEP_INTERVAL = _get('Queue', 'sweep_interval', 60.)
+
+DAEMON_SOCKET = _get('Daemon', 'socket', '/tmp/cl2sd.sock')
+DAEMON_TIMEOUT = _get('Daemon', 'timeout', 30.)
+DAEMON_PREFETCH = _get('Daemon', 'prefetch', 0)
+DAEMON_PREFETCH_TTL = _get('Daemon', 'prefetch_ttl', 10.)
+
+ENGINE_POOL_SIZE = _get('Engine', 'pool_size', 5)
+ENGINE_MAX_OVERFLOW = _get('Engine', 'max_overflow', 10)
+ENGINE_POOL_TIMEOUT = _get('Engine', 'pool_timeout', 30.)
+ENGINE_POOL_RECYCLE = _get('Engine', 'pool_recycle', 3600)
+ENGINE_PRE_PING = _get('Engine', 'pre_ping', True)
+ENGINE_SQLITE_JOURNAL_MODE = _get('Engine', 'sqlite_journal_mode', 'WAL')
+ENGINE_SQLITE_SYNCHRONOUS = _get('Engine', 'sqlite_synchronous', 'NORMAL')
+ENGINE_SQLITE_BUSY_TIMEOUT = _get('Engine', 'sqlite_busy_timeout', 10000)
+ENGINE_SQLITE_MMAP_SIZE = _get('Engine', 'sqlite_mmap_size', 67108864)
+
+STATS_ENABLED = _get('Stats', 'enabled', False)
+STATS_FILE = _get('Stats', 'file', '/tmp/cl2s-stats.%(pid)d.json')
+STATS_SIGNAL = _get('Stats', 'signal', 'SIGUSR1')
+
+AFFINITY_ENABLED = _get('Affinity', 'enabled', True)
+AFFINITY_SLOT_ATTRIBUTE = _get('Affinity', 'slot_attribute', 'CL2S_Datasets')
+AFFINITY_CACHE_FILE = _get('Affinity', 'cache_file', '/tmp/cl2s-datasets.txt')
+AFFINITY_CACHE_SIZE = _get('Affinity', 'cache_size', 16)
+
+MATCHING_ENABLED = _get('Matching', 'enabled', True)
+MATCHING_MAX_CANDIDATES = _get('Matching', 'max_candidates', 10)
 
+FAIRSHARE_ENABLED = _get('FairShare', 'enabled', True)
+FAIRSHARE_HALF_LIFE = _get('FairShare', 'half_life', 86400.)
+FAIRSHARE_DECAY_INTERVAL = _get('FairShare', 'decay_interval', 300.)
 
+DAG_PROCESSES = _get('Dag', 'processes', 0)
 
+HISTORY_ENABLED = _get('History', 'enabled', True)
+HISTORY_KEEP_DAYS = _get('History', 'keep_days', 7)
+HISTORY_ARCHIVE_DIR = _get('History', 'archive_dir', '/tmp/cl2s-history')
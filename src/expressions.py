@@ -0,0 +1,661 @@
+"""
+ClassAd expression evaluation.
+
+ClassAd attributes whose value is not a literal (e.g. Requirements or
+RequestMemory = ceiling(ifThenElse(...))) are kept as ClassAd.Expression
+strings. This module evaluates them, typically with a job ClassAd as MY and a
+slot ClassAd as TARGET, which is what the job fetch hook needs to make sure it
+only hands out jobs that fit the slot asking for work (see matches()).
+
+Supported are
+    - literals: integers, reals, strings, true, false, undefined, error;
+    - attribute references: Name (MY first, then TARGET), MY.Name,
+      TARGET.Name (OTHER.Name is the same as TARGET.Name);
+    - operators, loosest binding first: ?:, ||, &&, == != =?= =!= is isnt,
+      < <= > >=, + -, * / %, unary - + !;
+    - functions: ifThenElse, ceiling, floor, round, int, real, string,
+      strcat, toUpper, toLower, size, time, isUndefined, isError, isString,
+      isInteger, isReal, isBoolean.
+with the usual UNDEFINED and ERROR semantics: referring to a missing attribute
+gives UNDEFINED, which propagates through most operators (but false &&
+UNDEFINED is false, true || UNDEFINED is true and =?=/=!= are never
+UNDEFINED); type mismatches give ERROR.
+
+Matching does not need whole ClassAds: a LazyAd only pulls the attributes an
+expression refers to out of the ClassAd text, as they are needed.
+
+Each distinct expression text is compiled only once into a Python closure,
+which is then kept in a LRU cache (see compile_expression()). Evaluating an
+already compiled expression is just a few nested function calls.
+"""
+import collections
+import math
+import re
+import threading
+import time
+
+import ClassAd
+import stats
+
+
+
+
+# Constants
+# How many compiled expressions to keep around.
+CACHE_SIZE = 1024
+# How deep attribute references can nest before we give up (e.g. because of
+# cycles like A = B, B = A).
+MAX_DEPTH = 32
+# Tokens: numbers, strings, names (with an optional scope) and operators.
+TOKEN = re.compile(r'''\s*(?:
+    (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)?)
+  | (?P<op>=\?=|=!=|==|!=|<=|>=|&&|\|\||[-+*/%<>!?:(),])
+  )''', re.X)
+
+
+
+
+class _Special(object):
+    """
+    The UNDEFINED and ERROR ClassAd values.
+    """
+    __slots__ = ('name', )
+
+    def __init__(self, name):
+        self.name = name
+        return
+
+    def __repr__(self):
+        return(self.name)
+
+UNDEFINED = _Special('UNDEFINED')
+ERROR = _Special('ERROR')
+KEYWORDS = {'true': True, 'false': False,
+            'undefined': UNDEFINED, 'error': ERROR}
+
+
+class ExpressionError(Exception):
+    """
+    The expression text cannot be parsed.
+    """
+    pass
+
+
+
+
+class LazyAd(object):
+    """
+    The attributes of the ClassAd text `text`, indexed by lowercase name, each
+    one only pulled out of the text (see ClassAd.extract_attributes()) the
+    first time it is looked up. Use it as MY or TARGET ClassAd when the text
+    is large and expressions only refer to a few of its attributes.
+    """
+    def __init__(self, text):
+        self.text = text
+        # {lowercase name: value or None if the ad does not have it}
+        self._attrs = {}
+        return
+
+    def load(self, names):
+        """
+        Pull the attributes with lowercase names in `names` out of the text in
+        a single scan, unless they have been already.
+        """
+        names = [name for name in names if name not in self._attrs]
+        if(not names):
+            return
+        found = ClassAd.extract_attributes(self.text, names)
+        for name in names:
+            self._attrs[name] = found.get(name)
+        return
+
+    def __contains__(self, name):
+        self.load((name, ))
+        return(self._attrs[name] is not None)
+
+    def __getitem__(self, name):
+        if(name not in self):
+            raise(KeyError(name))
+        return(self._attrs[name])
+
+
+
+
+# Helper functions.
+def _is_number(value):
+    return(isinstance(value, (int, long, float)) and
+           not isinstance(value, bool))
+
+
+def _attributes(ad):
+    """
+    Return the {lowercase name: value} attribute dictionary of `ad`, which can
+    be a ClassAd instance, a LazyAd, a dictionary or None.
+    """
+    if(ad is None):
+        return({})
+    if(isinstance(ad, ClassAd.ClassAd)):
+        return(ad._attrs)
+    if(isinstance(ad, LazyAd)):
+        return(ad)
+    return(dict([(k.lower(), v) for (k, v) in ad.items()]))
+
+
+def _resolve(value, my, target, depth):
+    # Attribute values that are expressions are evaluated in the scope of the
+    # ad they belong to.
+    if(isinstance(value, ClassAd.Expression)):
+        if(depth > MAX_DEPTH):
+            return(ERROR)
+        return(compile_expression(value)(my, target, depth + 1))
+    if(isinstance(value, str)):
+        return(value.decode('utf-8'))
+    if(isinstance(value, dict)):
+        # Environment.
+        return(ERROR)
+    return(value)
+
+
+def _arithmetic(op, x, y):
+    if(x is ERROR or y is ERROR):
+        return(ERROR)
+    if(x is UNDEFINED or y is UNDEFINED):
+        return(UNDEFINED)
+    if(not _is_number(x) or not _is_number(y)):
+        return(ERROR)
+    if(op == '+'):
+        return(x + y)
+    if(op == '-'):
+        return(x - y)
+    if(op == '*'):
+        return(x * y)
+    if(y == 0):
+        return(ERROR)
+    if(isinstance(x, float) or isinstance(y, float)):
+        if(op == '/'):
+            return(float(x) / y)
+        return(math.fmod(x, y))
+    # Integer division and modulo truncate towards zero, like in C.
+    quotient = abs(x) // abs(y)
+    if((x < 0) != (y < 0)):
+        quotient = -quotient
+    if(op == '/'):
+        return(quotient)
+    return(x - y * quotient)
+
+
+def _compare(op, x, y):
+    if(op == '=?='):
+        return(_identical(x, y))
+    if(op == '=!='):
+        return(not _identical(x, y))
+    if(x is ERROR or y is ERROR):
+        return(ERROR)
+    if(x is UNDEFINED or y is UNDEFINED):
+        return(UNDEFINED)
+    if(isinstance(x, basestring) and isinstance(y, basestring)):
+        (x, y) = (x.lower(), y.lower())
+    elif(isinstance(x, bool) and isinstance(y, bool)):
+        if(op not in ('==', '!=')):
+            return(ERROR)
+    elif(not _is_number(x) or not _is_number(y)):
+        return(ERROR)
+    if(op == '=='):
+        return(x == y)
+    if(op == '!='):
+        return(x != y)
+    if(op == '<'):
+        return(x < y)
+    if(op == '<='):
+        return(x <= y)
+    if(op == '>'):
+        return(x > y)
+    return(x >= y)
+
+
+def _identical(x, y):
+    # =?= : same type and same value, strings compared case-sensitively.
+    if(isinstance(x, _Special) or isinstance(y, _Special)):
+        return(x is y)
+    if(isinstance(x, bool) or isinstance(y, bool)):
+        return(isinstance(x, bool) and isinstance(y, bool) and x == y)
+    if(isinstance(x, basestring) or isinstance(y, basestring)):
+        return(isinstance(x, basestring) and isinstance(y, basestring) and
+               x == y)
+    return(type(x) == type(y) and x == y)
+
+
+
+
+# Functions. Strict ones return ERROR/UNDEFINED if any argument is.
+def _to_int(x):
+    if(isinstance(x, basestring)):
+        try:
+            return(int(float(x)))
+        except ValueError:
+            return(ERROR)
+    return(int(x))
+
+
+def _to_real(x):
+    if(isinstance(x, basestring)):
+        try:
+            return(float(x))
+        except ValueError:
+            return(ERROR)
+    return(float(x))
+
+
+def _to_string(x):
+    if(isinstance(x, bool)):
+        return(unicode(x).lower())
+    return(unicode(x))
+
+
+def _numeric(f):
+    def g(x):
+        if(not _is_number(x)):
+            return(ERROR)
+        return(f(x))
+    return(g)
+
+
+def _string(f):
+    def g(*args):
+        if([a for a in args if not isinstance(a, basestring)]):
+            return(ERROR)
+        return(f(*args))
+    return(g)
+
+
+STRICT_FUNCTIONS = {
+    'ceiling': _numeric(lambda x: int(math.ceil(x))),
+    'floor': _numeric(lambda x: int(math.floor(x))),
+    'round': _numeric(lambda x: int(round(x))),
+    'int': _to_int,
+    'real': _to_real,
+    'string': _to_string,
+    'strcat': lambda *args: u''.join([_to_string(a) for a in args]),
+    'toupper': _string(lambda s: s.upper()),
+    'tolower': _string(lambda s: s.lower()),
+    'size': _string(len),
+    'time': lambda: int(time.time()),
+}
+FUNCTIONS = {
+    'isundefined': lambda x: x is UNDEFINED,
+    'iserror': lambda x: x is ERROR,
+    'isstring': lambda x: isinstance(x, basestring),
+    'isinteger': lambda x: isinstance(x, (int, long)) and
+                           not isinstance(x, bool),
+    'isreal': lambda x: isinstance(x, float),
+    'isboolean': lambda x: isinstance(x, bool),
+}
+
+
+
+
+class _Compiler(object):
+    """
+    Recursive descent parser turning expression text into a closure
+        f(my, target, depth)
+    where `my` and `target` are {lowercase name: value} attribute dictionaries
+    and `depth` is how deep in nested attribute references we are.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        pos = 0
+        text = text.rstrip()
+        while(pos < len(text)):
+            match = TOKEN.match(text, pos)
+            if(match is None or match.end() == pos):
+                raise(ExpressionError('Cannot parse "%s" at "%s"' \
+                                      % (self.text, text[pos:])))
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            pos = match.end()
+        self.pos = 0
+        # Lowercase names of the attributes referred to, whatever their scope.
+        self.references = set()
+        return
+
+    def compile(self):
+        f = self.ternary()
+        if(self.pos != len(self.tokens)):
+            raise(ExpressionError('Unexpected "%s" in "%s"' \
+                                  % (self.tokens[self.pos][1], self.text)))
+        return(f)
+
+    # Token helpers.
+    def peek(self):
+        if(self.pos < len(self.tokens)):
+            return(self.tokens[self.pos])
+        return((None, None))
+
+    def accept(self, *ops):
+        (kind, value) = self.peek()
+        if(kind == 'op' and value in ops):
+            self.pos += 1
+            return(value)
+        if(kind == 'name' and value.lower() in ops):
+            self.pos += 1
+            return(value.lower())
+        return
+
+    def expect(self, op):
+        if(not self.accept(op)):
+            raise(ExpressionError('Expected "%s" in "%s"' % (op, self.text)))
+        return
+
+    # Grammar, loosest binding first.
+    def ternary(self):
+        cond = self.or_()
+        if(not self.accept('?')):
+            return(cond)
+        a = self.ternary()
+        self.expect(':')
+        b = self.ternary()
+        return(_if_then_else(cond, a, b))
+
+    def or_(self):
+        f = self.and_()
+        while(self.accept('||')):
+            f = _or(f, self.and_())
+        return(f)
+
+    def and_(self):
+        f = self.equality()
+        while(self.accept('&&')):
+            f = _and(f, self.equality())
+        return(f)
+
+    def equality(self):
+        f = self.relational()
+        while(True):
+            op = self.accept('==', '!=', '=?=', '=!=', 'is', 'isnt')
+            if(not op):
+                return(f)
+            op = {'is': '=?=', 'isnt': '=!='}.get(op, op)
+            f = _binary(_compare, op, f, self.relational())
+
+    def relational(self):
+        f = self.additive()
+        while(True):
+            op = self.accept('<', '<=', '>', '>=')
+            if(not op):
+                return(f)
+            f = _binary(_compare, op, f, self.additive())
+
+    def additive(self):
+        f = self.multiplicative()
+        while(True):
+            op = self.accept('+', '-')
+            if(not op):
+                return(f)
+            f = _binary(_arithmetic, op, f, self.multiplicative())
+
+    def multiplicative(self):
+        f = self.unary()
+        while(True):
+            op = self.accept('*', '/', '%')
+            if(not op):
+                return(f)
+            f = _binary(_arithmetic, op, f, self.unary())
+
+    def unary(self):
+        op = self.accept('-', '+', '!')
+        if(not op):
+            return(self.primary())
+        f = self.unary()
+        if(op == '-'):
+            return(_binary(_arithmetic, '-', _constant(0), f))
+        if(op == '+'):
+            return(_binary(_arithmetic, '+', _constant(0), f))
+        return(_not(f))
+
+    def primary(self):
+        (kind, value) = self.peek()
+        self.pos += 1
+        if(kind == 'number'):
+            return(_constant(ClassAd._classad_val_to_python_val(value)))
+        if(kind == 'string'):
+            return(_constant(ClassAd._classad_val_to_python_val(value)))
+        if(kind == 'op' and value == '('):
+            f = self.ternary()
+            self.expect(')')
+            return(f)
+        if(kind == 'name'):
+            if(self.accept('(')):
+                return(self.call(value.lower()))
+            if(value.lower() in KEYWORDS):
+                return(_constant(KEYWORDS[value.lower()]))
+            self.references.add(value.rpartition('.')[2].lower())
+            return(_reference(value))
+        raise(ExpressionError('Unexpected "%s" in "%s"' % (value, self.text)))
+
+    def call(self, name):
+        args = []
+        if(not self.accept(')')):
+            args.append(self.ternary())
+            while(self.accept(',')):
+                args.append(self.ternary())
+            self.expect(')')
+        if(name == 'ifthenelse'):
+            if(len(args) != 3):
+                return(_constant(ERROR))
+            return(_if_then_else(*args))
+        if(name in STRICT_FUNCTIONS):
+            return(_call(STRICT_FUNCTIONS[name], args, True))
+        if(name in FUNCTIONS):
+            return(_call(FUNCTIONS[name], args, False))
+        return(_constant(ERROR))
+
+
+
+
+# Closure factories.
+def _constant(value):
+    return(lambda my, target, depth: value)
+
+
+def _reference(name):
+    (scope, _, attribute) = name.rpartition('.')
+    scope = scope.lower()
+    attribute = attribute.lower()
+    if(scope == 'my'):
+        def f(my, target, depth):
+            if(attribute not in my):
+                return(UNDEFINED)
+            return(_resolve(my[attribute], my, target, depth))
+    elif(scope in ('target', 'other')):
+        def f(my, target, depth):
+            if(attribute not in target):
+                return(UNDEFINED)
+            return(_resolve(target[attribute], target, my, depth))
+    elif(not scope):
+        def f(my, target, depth):
+            if(attribute in my):
+                return(_resolve(my[attribute], my, target, depth))
+            if(attribute in target):
+                return(_resolve(target[attribute], target, my, depth))
+            return(UNDEFINED)
+    else:
+        return(_constant(ERROR))
+    return(f)
+
+
+def _binary(operation, op, a, b):
+    return(lambda my, target, depth: operation(op,
+                                               a(my, target, depth),
+                                               b(my, target, depth)))
+
+
+def _and(a, b):
+    def f(my, target, depth):
+        x = a(my, target, depth)
+        if(x is False):
+            return(False)
+        if(x is not True and x is not UNDEFINED):
+            return(ERROR)
+        y = b(my, target, depth)
+        if(y is False):
+            return(False)
+        if(y is not True and y is not UNDEFINED):
+            return(ERROR)
+        if(x is UNDEFINED or y is UNDEFINED):
+            return(UNDEFINED)
+        return(True)
+    return(f)
+
+
+def _or(a, b):
+    def f(my, target, depth):
+        x = a(my, target, depth)
+        if(x is True):
+            return(True)
+        if(x is not False and x is not UNDEFINED):
+            return(ERROR)
+        y = b(my, target, depth)
+        if(y is True):
+            return(True)
+        if(y is not False and y is not UNDEFINED):
+            return(ERROR)
+        if(x is UNDEFINED or y is UNDEFINED):
+            return(UNDEFINED)
+        return(False)
+    return(f)
+
+
+def _not(a):
+    def f(my, target, depth):
+        x = a(my, target, depth)
+        if(isinstance(x, bool)):
+            return(not x)
+        if(x is UNDEFINED):
+            return(UNDEFINED)
+        return(ERROR)
+    return(f)
+
+
+def _if_then_else(cond, a, b):
+    def f(my, target, depth):
+        x = cond(my, target, depth)
+        if(x is True):
+            return(a(my, target, depth))
+        if(x is False):
+            return(b(my, target, depth))
+        if(x is UNDEFINED):
+            return(UNDEFINED)
+        if(_is_number(x)):
+            # Numbers are true if non-zero.
+            if(x):
+                return(a(my, target, depth))
+            return(b(my, target, depth))
+        return(ERROR)
+    return(f)
+
+
+def _call(function, args, strict):
+    def f(my, target, depth):
+        values = [arg(my, target, depth) for arg in args]
+        if(strict):
+            if([v for v in values if v is ERROR]):
+                return(ERROR)
+            if([v for v in values if v is UNDEFINED]):
+                return(UNDEFINED)
+        try:
+            return(function(*values))
+        except (TypeError, ValueError, OverflowError):
+            # Wrong number or type of arguments.
+            return(ERROR)
+    return(f)
+
+
+
+
+# Compiled expressions as (closure, attribute names referred to), least
+# recently used first.
+_CACHE = collections.OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def _compile(text):
+    """
+    Return the (closure, frozenset of the lowercase attribute names it refers
+    to) of the ClassAd expression `text`, compiling it only if it is not in 
+    the cache already.
+    """
+    with _CACHE_LOCK:
+        entry = _CACHE.pop(text, None)
+        if(entry is not None):
+            _CACHE[text] = entry
+            return(entry)
+    try:
+        compiler = _Compiler(text)
+        entry = (compiler.compile(), frozenset(compiler.references))
+    except ExpressionError:
+        entry = (_constant(ERROR), frozenset())
+    with _CACHE_LOCK:
+        _CACHE[text] = entry
+        while(len(_CACHE) > CACHE_SIZE):
+            _CACHE.popitem(last=False)
+    return(entry)
+
+
+def compile_expression(text):
+    """
+    Return the closure
+        f(my, target, depth)
+    evaluating the ClassAd expression `text` (see _Compiler), compiling it only
+    if it is not in the cache already. Expressions that cannot be parsed
+    compile to a closure returning ERROR.
+    """
+    return(_compile(text)[0])
+
+
+def references(text):
+    """
+    Return the set of the lowercase names of the attributes the ClassAd
+    expression `text` refers to, whatever their scope (empty if the text
+    cannot be parsed). Shares the cache of compile_expression().
+    """
+    return(_compile(text)[1])
+
+
+def evaluate(expression, my=None, target=None):
+    """
+    Evaluate the ClassAd expression `expression` (text or a value taken from a
+    ClassAd, like ad.Requirements) with `my` as MY ClassAd and `target` as
+    TARGET ClassAd. These can be ClassAd instances, plain dictionaries or None.
+
+    Return a Python value or UNDEFINED or ERROR.
+    """
+    my = _attributes(my)
+    target = _attributes(target)
+    if(isinstance(expression, basestring)):
+        return(compile_expression(expression)(my, target, 0))
+    return(_resolve(expression, my, target, 0))
+
+
+@stats.timed
+def matches(job, slot):
+    """
+    Return True if the Requirements of the `job` ClassAd evaluate to true with
+    the `slot` ClassAd as TARGET (or if the job has no Requirements), False
+    otherwise (this includes UNDEFINED and ERROR).
+
+    Either ClassAd can be a LazyAd: the attributes Requirements refers to are
+    then pulled out of its text in one go.
+    """
+    my = _attributes(job)
+    if('requirements' not in my):
+        return(True)
+    target = _attributes(slot)
+    requirements = my['requirements']
+    lazy = [ad for ad in (my, target) if isinstance(ad, LazyAd)]
+    if(lazy and isinstance(requirements, ClassAd.Expression)):
+        names = references(requirements)
+        for ad in lazy:
+            ad.load(names)
+    return(_resolve(requirements, my, target, 0) is True)
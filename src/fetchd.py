@@ -0,0 +1,217 @@
+"""
+Node-local CL2S daemon.
+
+Starting a Python interpreter, importing the ORM, parsing the configuration
+file and binding a database engine each time the startd invokes a job hook
+costs far more than the one query the hook needs. The daemon pays that price
+once: it keeps a warm database connection around and serves the Job Fetch and
+Reply Fetch hooks over a Unix domain socket. The hook side of the conversation
+is in hookclient.py.
+"""
+import collections
+import os
+import socket
+import SocketServer
+import threading
+import time
+
+import config
+import hookclient
+import hooks
+import JobQueue
+import logutils
+import ormutils
+
+
+
+
+class PrefetchBuffer(object):
+    """
+    Node-local buffer of claimed Jobs (as JobQueue.QueuedJob instances).
+    
+    Instead of going to the database once per slot, claim `size` Jobs at a time
+    with JobQueue.claim_batch() and hand them out to the slots of this node one by
+    one. Jobs that nobody asks for within `ttl` seconds are put back in the
+    queue so that other nodes can run them.
+    """
+    def __init__(self, size, ttl):
+        self.size = int(size)
+        self.ttl = float(ttl)
+        self._jobs = collections.deque()              # (claimed, QueuedJob)
+        self._lock = threading.Lock()
+        return
+    
+    def __len__(self):
+        return(len(self._jobs))
+    
+    def claim(self, datasets=()):
+        """
+        Return the next claimed QueuedJob, refilling the buffer from the queue
+        if it is empty. Return None if the queue has nothing for us either.
+        
+        Buffered Jobs for any of `datasets` are handed out first (see 
+        JobQueue.claim()).
+        """
+        with self._lock:
+            self._expire(time.time() - self.ttl)
+            if(not self._jobs):
+                now = time.time()
+                self._jobs.extend([(now, queued) for queued 
+                                   in JobQueue.claim_batch(self.size)])
+            if(not self._jobs):
+                return
+            if(datasets):
+                for (i, (claimed, queued)) in enumerate(self._jobs):
+                    if(queued.dataset in datasets):
+                        del(self._jobs[i])
+                        return(queued)
+            return(self._jobs.popleft()[1])
+    
+    def expire(self):
+        """
+        Put the Jobs that have been sitting in the buffer for longer than 
+        self.ttl seconds back in the queue.
+        """
+        with self._lock:
+            self._expire(time.time() - self.ttl)
+        return
+    
+    def release(self):
+        """
+        Put all the buffered Jobs back in the queue.
+        """
+        with self._lock:
+            self._expire(None)
+        return
+    
+    def _expire(self, cutoff):
+        # Jobs are buffered in claim order: the stale ones are at the front.
+        stale = []
+        while(self._jobs and (cutoff is None or self._jobs[0][0] < cutoff)):
+            stale.append(self._jobs.popleft()[1].job_id)
+        if(stale):
+            JobQueue.release(stale)
+        return
+
+
+
+class _HookRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Serve one hook request (see hookclient.py for the protocol).
+    """
+    def handle(self):
+        (command, _, payload) = self.rfile.read().partition('\n')
+        words = command.split()
+        try:
+            if(words == [hookclient.FETCH, ]):
+                body = hooks.fetch_job(payload, self.server.claim) or u''
+            elif(len(words) == 2 and words[0] == hookclient.REPLY):
+                hooks.reply_fetch(words[1], payload)
+                body = u''
+            elif(len(words) == 2 and words[0] == hookclient.EXIT):
+                hooks.job_exit(words[1], payload)
+                body = u''
+            else:
+                raise(ValueError('Unknown command "%s".' % (command)))
+            status = hookclient.OK
+        except Exception, e:
+            logutils.logger.critical('Exception serving %s: %s' % (command, e))
+            (status, body) = (hookclient.ERROR, unicode(e))
+        self.wfile.write('%s\n%s' % (status, body.encode('utf-8')))
+        return
+
+
+
+class FetchDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Threaded Unix domain socket server answering job hook requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, prefetch=0, 
+                 prefetch_ttl=config.DAEMON_PREFETCH_TTL):
+        """
+        Listen on the Unix domain socket `path`, replacing any stale socket
+        file left behind by a daemon that died. Refuse to start if another
+        daemon is still listening there.
+        
+        If `prefetch` is greater than 1, claim that many Jobs at a time and 
+        buffer them for up to `prefetch_ttl` seconds (see PrefetchBuffer).
+        """
+        self.buffer = None
+        self.claim = JobQueue.claim
+        if(prefetch > 1):
+            self.buffer = PrefetchBuffer(prefetch, prefetch_ttl)
+            self.claim = self.buffer.claim
+            if(prefetch_ttl >= config.QUEUE_LEASE):
+                logutils.logger.warning('Prefetched Jobs can outlive their ' +
+                                        'lease: prefetch_ttl should be well ' +
+                                        'below the queue lease.')
+        
+        if(os.path.exists(path)):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+            else:
+                raise(RuntimeError('A daemon is already listening on %s.' \
+                                   % (path)))
+            finally:
+                probe.close()
+        SocketServer.UnixStreamServer.__init__(self, path, _HookRequestHandler)
+        return
+
+    def server_close(self):
+        if(self.buffer is not None):
+            self.buffer.release()
+        SocketServer.UnixStreamServer.server_close(self)
+        if(os.path.exists(self.server_address)):
+            os.unlink(self.server_address)
+        return
+
+
+
+
+def _periodically(interval, f, what):
+    # Call f() every interval seconds, forever, logging what failed if it does.
+    while(True):
+        time.sleep(interval)
+        try:
+            f()
+        except Exception, e:
+            logutils.logger.critical('Exception %s: %s' % (what, e))
+
+
+def _start_periodically(interval, f, what):
+    thread = threading.Thread(target=_periodically, args=(interval, f, what))
+    thread.daemon = True
+    thread.start()
+    return(thread)
+
+
+def serve(path, prefetch=config.DAEMON_PREFETCH):
+    """
+    Run the daemon on the Unix domain socket `path` until interrupted, 
+    prefetching `prefetch` Jobs at a time (see FetchDaemon).
+    """
+    server = FetchDaemon(path, prefetch)
+    # Put unclaimed prefetched Jobs back even when no slot is asking for work,
+    # and the Jobs of nodes that went away too.
+    if(server.buffer is not None):
+        _start_periodically(server.buffer.ttl, server.buffer.expire, 
+                            'releasing Jobs')
+    _start_periodically(config.QUEUE_SWEEP_INTERVAL, JobQueue.expire_leases,
+                        'expiring leases')
+    # Keep fair-share usage decaying (see JobQueue.decay_usage()).
+    if(config.FAIRSHARE_ENABLED):
+        _start_periodically(config.FAIRSHARE_DECAY_INTERVAL, 
+                            JobQueue.decay_usage, 'decaying usage')
+    logutils.logger.info('CL2S daemon listening on %s' % (path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        logutils.logger.info('CL2S daemon stopped. Database retries: %s' \
+                             % (ormutils.retry_stats()))
+    return
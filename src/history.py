@@ -0,0 +1,211 @@
+"""
+Job history.
+
+Jobs leave the job queue as soon as a slot accepts them (see
+hooks.reply_fetch()): the queue only ever holds live work. What happens to
+them afterwards is recorded by the Job Exit Hook (see hooks.job_exit()) as one
+compact row per Job leaving a slot, for whatever reason: completion, eviction,
+hold or removal.
+
+Rows go to one table per day, job_history_YYYYMMDD (UTC), created on demand.
+Nothing ever deletes single rows: archive() writes whole days to gzipped, tab
+separated files and drops their tables, so that the history kept in the
+database stays small however many Jobs go through the system.
+"""
+import csv
+import datetime
+import gzip
+import os
+
+import elixir
+import sqlalchemy
+
+import ormutils
+import stats
+
+
+
+
+# Constants
+TABLE_PREFIX = 'job_history_'
+DAY_FORMAT = '%Y%m%d'
+# The columns of the history tables and of the archive files.
+COLUMNS = ('job_id', 'reason', 'exit_code', 'exit_signal', 'owner', 'dataset',
+           'started', 'exited', 'runtime')
+# How archive files represent NULL.
+NULL = '\\N'
+
+
+
+# Init the ORM connection to the database, unless somebody (e.g. JobQueue)
+# already did.
+if(elixir.metadata.bind is None):
+    ormutils.init()
+
+# History tables live outside of the elixir metadata: they come and go.
+_METADATA = sqlalchemy.MetaData()
+# The (database URL, table name) of the tables we know to exist.
+_CREATED = set()
+
+
+
+
+def _table(day):
+    """
+    Return the history Table for the date `day`.
+    """
+    name = TABLE_PREFIX + day.strftime(DAY_FORMAT)
+    table = _METADATA.tables.get(name)
+    if(table is not None):
+        return(table)
+    return(sqlalchemy.Table(
+        name, _METADATA,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('job_id', sqlalchemy.Unicode(255), nullable=False),
+        # exit, evict, hold or remove.
+        sqlalchemy.Column('reason', sqlalchemy.Unicode(16), nullable=False),
+        sqlalchemy.Column('exit_code', sqlalchemy.Integer),
+        sqlalchemy.Column('exit_signal', sqlalchemy.Integer),
+        sqlalchemy.Column('owner', sqlalchemy.Unicode(255)),
+        sqlalchemy.Column('dataset', sqlalchemy.Unicode(255)),
+        sqlalchemy.Column('started', sqlalchemy.DateTime),
+        sqlalchemy.Column('exited', sqlalchemy.DateTime, nullable=False),
+        # Wall clock seconds.
+        sqlalchemy.Column('runtime', sqlalchemy.Float)))
+
+
+def _day(name):
+    """
+    Return the date of the history table `name`, None if it is not one.
+    """
+    if(not name.startswith(TABLE_PREFIX)):
+        return
+    try:
+        return(datetime.datetime.strptime(name[len(TABLE_PREFIX):],
+                                          DAY_FORMAT).date())
+    except ValueError:
+        return
+
+
+@stats.timed
+@ormutils.run_with_retries_and_rollback
+def record(job_id, reason, exit_code=None, exit_signal=None, owner=None,
+           dataset=None, started=None, runtime=None, exited=None):
+    """
+    Record that the Job with id `job_id` left its slot because of `reason`
+    ("exit", "evict", "hold" or "remove") at time `exited` (a UTC datetime,
+    now by default) after running for `runtime` seconds since `started`.
+    `exit_code` and `exit_signal` are only meaningful for reason "exit".
+    """
+    if(exited is None):
+        exited = datetime.datetime.utcnow()
+    table = _table(exited.date())
+    key = (str(elixir.metadata.bind.url), table.name)
+    with ormutils.transaction() as connection:
+        if(key not in _CREATED):
+            table.create(bind=connection, checkfirst=True)
+        connection.execute(table.insert(), {'job_id': unicode(job_id),
+                                            'reason': unicode(reason),
+                                            'exit_code': exit_code,
+                                            'exit_signal': exit_signal,
+                                            'owner': owner,
+                                            'dataset': dataset,
+                                            'started': started,
+                                            'exited': exited,
+                                            'runtime': runtime})
+    _CREATED.add(key)
+    return
+
+
+def days():
+    """
+    Return the sorted list of the dates that have a history table.
+    """
+    names = elixir.metadata.bind.table_names()
+    return(sorted([day for day in map(_day, names) if day is not None]))
+
+
+def counts():
+    """
+    Return the list of the (date, {reason: number of Jobs}) pairs of each day
+    in the history tables, oldest first.
+    """
+    res = []
+    with ormutils.transaction() as connection:
+        for day in days():
+            table = _table(day)
+            rows = connection.execute(
+                sqlalchemy.select([table.c.reason, sqlalchemy.func.count()])
+                          .group_by(table.c.reason)).fetchall()
+            res.append((day, dict([(reason, n) for (reason, n) in rows])))
+    return(res)
+
+
+def _format(value):
+    if(value is None):
+        return(NULL)
+    if(isinstance(value, unicode)):
+        return(value.encode('utf-8'))
+    if(isinstance(value, datetime.datetime)):
+        return(value.strftime('%Y-%m-%d %H:%M:%S'))
+    return(str(value))
+
+
+def archive(directory, keep=7, today=None):
+    """
+    Move the history of the days older than `keep` days before `today` (UTC)
+    to gzipped, tab separated files in `directory`, one per day
+    (job_history_YYYYMMDD.tsv.gz, with a header line), and drop their tables.
+    Rows are streamed to the file, which only takes its final name once it is
+    complete; the table is only dropped after that. Archiving a day that
+    already has a file adds a new one (job_history_YYYYMMDD.1.tsv.gz, ...).
+
+    `keep` has to be at least 1: today's table is the one being written to.
+
+    Return the list of the paths of the files written.
+    """
+    if(keep < 1):
+        raise(ValueError('At least one day of history stays in the database.'))
+    if(today is None):
+        today = datetime.datetime.utcnow().date()
+    cutoff = today - datetime.timedelta(days=keep - 1)
+
+    if(not os.path.isdir(directory)):
+        os.makedirs(directory)
+    paths = []
+    for day in days():
+        if(day >= cutoff):
+            break
+        table = _table(day)
+        path = os.path.join(directory, table.name + '.tsv.gz')
+        n = 0
+        while(os.path.exists(path)):
+            n += 1
+            path = os.path.join(directory, '%s.%d.tsv.gz' % (table.name, n))
+
+        tmp = path + '.tmp'
+        connection = elixir.metadata.bind.connect()
+        try:
+            f = gzip.open(tmp, 'wb')
+            try:
+                writer = csv.writer(f, dialect='excel-tab',
+                                    lineterminator='\n')
+                writer.writerow(COLUMNS)
+                result = connection.execute(sqlalchemy.select(
+                    [table.c[column] for column in COLUMNS])
+                    .order_by(table.c.id))
+                for row in result:
+                    writer.writerow([_format(value) for value in row])
+            finally:
+                f.close()
+            os.rename(tmp, path)
+            table.drop(bind=connection)
+        except:
+            if(os.path.exists(tmp)):
+                os.remove(tmp)
+            raise
+        finally:
+            connection.close()
+        _CREATED.discard((str(elixir.metadata.bind.url), table.name))
+        paths.append(path)
+    return(paths)
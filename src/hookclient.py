@@ -0,0 +1,112 @@
+"""
+Thin client for the node-local CL2S daemon (see fetchd.py).
+
+The Condor job hooks run in a brand new Python interpreter every single time the
+startd polls. This module is all they need to import to have the daemon do the
+work for them: no ORM, no database connection and no ClassAd parsing.
+
+The protocol is trivial: the client sends a command line followed by the
+payload and closes its end of the socket; the daemon answers with a status line
+(OK or ERROR) followed by the response body and closes the connection.
+"""
+import socket
+
+import config
+
+
+
+# Constants
+# Commands understood by the daemon.
+FETCH = 'FETCH'
+REPLY = 'REPLY'
+EXIT = 'EXIT'
+# Status lines sent back by the daemon.
+OK = 'OK'
+ERROR = 'ERROR'
+# How many bytes to read from the socket at a time.
+BUFFER_SIZE = 65536
+
+
+
+
+class DaemonUnavailable(Exception):
+    """
+    The daemon is not running (or not listening where we expect it to).
+    """
+    pass
+
+
+class DaemonError(Exception):
+    """
+    The daemon is running but could not carry out the request.
+    """
+    pass
+
+
+
+
+def request(command, payload='', path=None):
+    """
+    Send `command` and `payload` to the daemon listening on the Unix domain
+    socket `path` (config.DAEMON_SOCKET by default) and return the body of its
+    response.
+
+    Raise DaemonUnavailable if there is no daemon to talk to and DaemonError if
+    the daemon reports a failure.
+    """
+    if(path is None):
+        path = config.DAEMON_SOCKET
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(config.DAEMON_TIMEOUT)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        sock.close()
+        raise(DaemonUnavailable('Cannot connect to %s: %s' % (path, e)))
+
+    chunks = []
+    try:
+        sock.sendall('%s\n%s' % (command, payload))
+        sock.shutdown(socket.SHUT_WR)
+        while(True):
+            chunk = sock.recv(BUFFER_SIZE)
+            if(not chunk):
+                break
+            chunks.append(chunk)
+    except socket.error, e:
+        raise(DaemonError('Lost connection to %s: %s' % (path, e)))
+    finally:
+        sock.close()
+
+    (status, _, body) = ''.join(chunks).partition('\n')
+    if(status != OK):
+        raise(DaemonError(body or 'Empty response from %s' % (path)))
+    return(body)
+
+
+def fetch(slot_ad, path=None):
+    """
+    Have the daemon claim a Job for the slot described by the raw ClassAd
+    `slot_ad`. Return the Job ClassAd text or an empty string if there is
+    nothing to do.
+    """
+    return(request(FETCH, slot_ad, path))
+
+
+def reply(response, ads, path=None):
+    """
+    Tell the daemon whether the startd accepted or rejected the Job: `response`
+    is "accept" or "reject" and `ads` is the raw Reply Fetch Hook input.
+    """
+    request('%s %s' % (REPLY, response), ads, path)
+    return
+
+
+def job_exit(reason, job_ad, path=None):
+    """
+    Tell the daemon that a Job exited: `reason` is what the Job Exit Hook got
+    as its first argument (e.g. "exit") and `job_ad` its raw input.
+    """
+    request('%s %s' % (EXIT, reason), job_ad, path)
+    return
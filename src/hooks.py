@@ -0,0 +1,198 @@
+"""
+What the Condor job hooks actually do, independently of how they are invoked.
+
+The hook scripts in bin/ either ask the node-local CL2S daemon (see fetchd.py)
+to run these functions on their behalf or, if the daemon is not running, run
+them directly.
+"""
+import datetime
+
+import affinity
+import ClassAd
+import config
+import Dag
+import expressions
+import history
+import logutils
+import JobQueue
+
+
+
+# Constants
+# The Reply Fetch Hook gets the job and slot ClassAds separated by this.
+SEPARATOR = '-----\n'
+
+
+
+
+def fetch_job(slot_ad, claim=JobQueue.claim):
+    """
+    Job Fetch Hook: claim a Job for the slot described by the raw ClassAd 
+    `slot_ad` and return its ClassAd text. Return None if there is nothing to 
+    do.
+    
+    Jobs are claimed by calling `claim`, straight from the queue by default. 
+    The ClassAd text comes from the queue as is.
+    
+    Jobs for the datasets this node has worked on recently are preferred (see
+    affinity.py). Jobs whose Requirements the slot does not meet are put back
+    in the queue; up to config.MATCHING_MAX_CANDIDATES Jobs are looked at.
+    Neither ClassAd is parsed for that (see _fits()).
+    """
+    logutils.logger.debug('Worker slot ClassAd:\n%s' % (slot_ad))
+    
+    slot = None
+    if(config.MATCHING_ENABLED):
+        # Shared by all the candidates: slot attributes are pulled out of the
+        # text at most once.
+        slot = expressions.LazyAd(slot_ad)
+    datasets = affinity.datasets(slot_ad)
+    
+    queued = None
+    mismatched = []
+    try:
+        for i in range(max(config.MATCHING_MAX_CANDIDATES, 1)):
+            # Claim a QueuedJob instance from the queue. This returns a 
+            # QueuedJob instance if it managed to claim one; None if there 
+            # aren't any; an exception if some error occurred.
+            queued = claim(datasets)
+            if(queued is None):
+                break
+            if(not isinstance(queued, JobQueue.QueuedJob)):
+                raise(TypeError('Was expecting a QueuedJob instance, got %s ' \
+                                'instead.' % (queued.__class__.__name__)))
+            if(slot is None or _fits(queued, slot)):
+                break
+            logutils.logger.debug('Job %s does not fit the slot.' \
+                                  % (queued.job_id))
+            mismatched.append(queued.job_id)
+            queued = None
+    finally:
+        # Put back the Jobs that did not fit.
+        if(mismatched):
+            JobQueue.release(mismatched)
+    
+    if(queued is None):
+        logutils.logger.debug('Noting to do...')
+        return
+    if(config.AFFINITY_ENABLED):
+        affinity.record(queued.dataset)
+    return(queued.class_ad)
+
+
+def _fits(queued, slot):
+    """
+    Return True if the Requirements of the QueuedJob `queued` are met by the
+    slot LazyAd `slot`. Only the Requirements and the attributes they refer 
+    to are pulled out of the job ClassAd text: no Job instance is built. 
+    Requirements are not checked (i.e. we return True) if the ClassAds cannot
+    be parsed.
+    """
+    try:
+        return(expressions.matches(expressions.LazyAd(queued.class_ad), slot))
+    except Exception, e:
+        logutils.logger.warning('Cannot match Job %s: %s' % (queued.job_id, e))
+        return(True)
+
+
+def reply_fetch(response, ads):
+    """
+    Reply Fetch Hook: `response` is either "accept" or "reject" and `ads` is the
+    job ClassAd followed by the slot ClassAd, separated by SEPARATOR. Remove
+    accepted Jobs from the queue and put rejected ones back.
+    
+    All we need is the id of the Job, which we fish out of the job ClassAd 
+    without parsing it (it can be huge, what with GetEnv and all).
+    """
+    # Find where the job ClassAd ends and the slot ClassAd starts.
+    end = ads.find(SEPARATOR)
+    if(end == -1):
+        raise(ValueError('Unable to separate slot and job ads: %s' % (ads)))
+    logutils.logger.debug('Worker slot ClassAd %s' \
+                          % (ads[end + len(SEPARATOR):]))
+    logutils.logger.debug('Job ClassAd %s' % (ads[:end]))
+    logutils.logger.debug('Job was %sed' % (response))
+    
+    job_id = ClassAd.extract_attributes(ads, 
+                                        ('CL2S_JOB_ID', ), 
+                                        endpos=end).get('CL2S_JOB_ID')
+    if(job_id is None):
+        raise(ValueError('No CL2S_JOB_ID in job ad: %s' % (ads[:end])))
+
+    # If the job was accepted, remove it from the queue. Otherwise re-insert it.
+    if(response.lower() == 'accept'):
+        logutils.logger.debug('Deleting the job from the queue.')
+        JobQueue.delete_by_id(job_id)
+    else:
+        logutils.logger.debug('Re-inserting the job in the queue.')
+        JobQueue.reinsert_by_id(job_id)
+    return
+
+
+def job_exit(reason, job_ad):
+    """
+    Job Exit Hook: `reason` is why the Job left the slot ("exit", "hold", 
+    "remove" or "evict") and `job_ad` is its final ClassAd. The Job is 
+    recorded in the job history (see history.py). When a Job that is a DAG 
+    node exits, the DAG moves on: its children are queued if it exited with 
+    status 0 (see Dag.complete()); it is marked as failed otherwise.
+    """
+    attrs = ClassAd.extract_attributes(job_ad, ('CL2S_JOB_ID', 
+                                                'ExitCode', 
+                                                'ExitBySignal',
+                                                'ExitSignal',
+                                                'Owner',
+                                                'CL2S_DATASET',
+                                                'JobStartDate',
+                                                'RemoteWallClockTime'))
+    job_id = attrs.get('CL2S_JOB_ID')
+    if(job_id is None):
+        raise(ValueError('No CL2S_JOB_ID in job ad: %s' % (job_ad)))
+    logutils.logger.debug('Job %s left the slot: %s' % (job_id, reason))
+    
+    reason = reason.lower()
+    exited = reason == 'exit'
+    if(config.HISTORY_ENABLED):
+        started = attrs.get('JobStartDate')
+        if(isinstance(started, (int, long, float))):
+            started = datetime.datetime.utcfromtimestamp(started)
+        else:
+            started = None
+        runtime = attrs.get('RemoteWallClockTime')
+        if(not isinstance(runtime, (int, long, float))):
+            runtime = None
+        (exit_code, exit_signal) = (None, None)
+        if(exited and attrs.get('ExitBySignal')):
+            exit_signal = _integer(attrs.get('ExitSignal'))
+        elif(exited):
+            exit_code = _integer(attrs.get('ExitCode'))
+        history.record(job_id, reason, 
+                       exit_code=exit_code,
+                       exit_signal=exit_signal,
+                       owner=_text(attrs.get('Owner')),
+                       dataset=_text(attrs.get('CL2S_DATASET')),
+                       started=started,
+                       runtime=runtime)
+    
+    # Only Jobs that ran to completion count.
+    if(not exited):
+        return
+    success = attrs.get('ExitCode') == 0 and not attrs.get('ExitBySignal')
+    released = Dag.complete(unicode(job_id), success)
+    if(released):
+        logutils.logger.debug('Queued DAG nodes %s.' % (', '.join(released)))
+    return
+
+
+def _integer(value):
+    # ClassAd integers, None for anything else (e.g. undefined).
+    if(isinstance(value, bool) or not isinstance(value, (int, long))):
+        return
+    return(value)
+
+
+def _text(value):
+    # ClassAd strings, None for anything else.
+    if(not isinstance(value, basestring)):
+        return
+    return(unicode(value))
@@ -36,6 +36,7 @@ class logit(object):
     """
     def __init__(self, f, log_level='DEBUG'):
         assert(log_level in logging.__dict__.keys())
+        self.level = getattr(logging, log_level)
         self.writer = getattr(logger, log_level.lower())
         self.f = f
         self.__name__ = f.__name__
@@ -46,6 +47,10 @@ class logit(object):
         return(self.f.__doc__)
     
     def __call__(self, *args, **kws):
+        # Formatting arguments and results (e.g. whole ClassAds) is anything 
+        # but cheap: do not bother unless somebody is going to read it.
+        if(not logger.isEnabledFor(self.level)):
+            return(self.f(*args, **kws))
         self.writer('Calling %s.%s with args %s and kwargs %s' \
                     % (self.f.__module__, self.f.__name__, str(args), str(kws)))
         result = self.f(*args, **kws)
@@ -0,0 +1,224 @@
+"""
+condor_submit macros and queue statements.
+
+Submit description files refer to macros as $(Name) (names are case-
+insensitive). Macros are either defined by the submit file itself (every
+`Name = value` line is one) or by the queue statement, which creates one job
+per item and step:
+    Queue [N]
+    Queue [N] [var[, var ...]] in (item, item, ...)
+    Queue [N] [var[, var ...]] from file
+    Queue [N] [var[, var ...]] from (
+        item line
+        ...
+    )
+    Queue [N] [var] matching [files | dirs] pattern [pattern ...]
+The variables default to Item. Each from line is split at commas and/or
+whitespace, one field per variable (the last variable gets the rest of the
+line); missing fields are empty. Besides the variables, every job gets
+$(Process) (or $(ProcId), 0, 1, ... across the whole cluster), $(Step) (0 to
+N-1 for each item), $(ItemIndex) (or $(Row), the index of the item) and
+$(Cluster) (or $(ClusterId)). Undefined macros expand to nothing, just like in
+condor_submit; $$(Name) is left alone.
+
+Texts using macros are compiled once into a format string (see
+compile_text()) which is then filled for any number of jobs at a time, column
+by column (see fill_all()): expanding a cluster never goes through the text
+more than once.
+"""
+import glob
+import itertools
+import os
+import re
+
+
+
+
+# Constants
+MACRO = re.compile(r'(?<!\$)\$\(([A-Za-z_][\w.]*)\)')
+# The queue statement, which might span several lines if it has a list of
+# items in parentheses. `queue = value` defines a macro instead.
+QUEUE_LINE = re.compile(r'^[ \t]*queue(?![ \t]*=)(?:[ \t]|$).*$', 
+                        re.I | re.M)
+QUEUE = re.compile(r'''\s*queue
+    (?:\s+(\d+))?
+    (?:\s+(?:(.*?)\s+)??(in|from|matching)(?:\s+|(?=\())(.*?))?
+    \s*\Z''', re.I | re.S | re.X)
+# Item fields (and variable names) are separated by commas and/or whitespace.
+SEPARATOR = re.compile(r'\s*,\s*|\s+')
+# Nested macros are expanded up to this many levels deep.
+MAX_DEPTH = 32
+# The default queue variable.
+DEFAULT_VARIABLE = 'Item'
+
+
+
+
+def split_queue(text):
+    """
+    Split the submit description `text` into the commands and the queue
+    statement. Return the (commands, queue statement) tuple; the statement is
+    None if there is none.
+    
+    Only one queue statement is supported: ValueError is raised if there are
+    more (rather than silently ignoring them).
+    """
+    match = QUEUE_LINE.search(text)
+    if(match is None):
+        return((text, None))
+    start = match.start()
+    end = match.end()
+    if(text.count('(', start, end) > text.count(')', start, end)):
+        # A list of items spanning several lines: it ends at the first ).
+        end = text.find(')', end)
+        if(end == -1):
+            raise(ValueError('Unterminated queue statement.'))
+        end += 1
+    extra = QUEUE_LINE.search(text, end)
+    if(extra is not None):
+        raise(ValueError('Only one queue statement per submit description ' +
+                         'is supported, found "%s" after "%s".' 
+                         % (extra.group().strip(), text[start:end].strip())))
+    return((text[:start] + text[end:], text[start:end]))
+
+
+def _parenthesized(arg):
+    """
+    Return the body of the parenthesized list `arg`, or None if it is not one.
+    """
+    arg = arg.strip()
+    if(arg.startswith('(') and arg.endswith(')')):
+        return(arg[1:-1])
+    return(None)
+
+
+def _split_items(lines, n):
+    """
+    Split each of the item `lines` into `n` fields. Empty lines and comments
+    are skipped.
+    """
+    lines = [line.strip() for line in lines]
+    lines = [line for line in lines if line and line[0] != '#']
+    if(n == 1):
+        return([(line, ) for line in lines])
+    split = SEPARATOR.split
+    items = [tuple(split(line, n - 1)) for line in lines]
+    missing = (u'', ) * n
+    return([fields if len(fields) == n else (fields + missing)[:n]
+            for fields in items])
+
+
+def parse_queue(statement, basedir=None):
+    """
+    Parse the queue `statement` and return the tuple
+        (number of steps per item, [variable names], [item tuples])
+    where each item tuple has one value per variable. Plain `Queue N` has no
+    variables and a single, empty item. Files (from and matching) are relative
+    to `basedir` (the current directory by default). Item values are unicode.
+    """
+    if(isinstance(statement, str)):
+        statement = statement.decode('utf-8')
+    match = QUEUE.match(statement)
+    if(match is None):
+        raise(ValueError('Cannot parse queue statement "%s"' % (statement)))
+    (count, names, kind, arg) = match.groups()
+    count = int(count) if count is not None else 1
+    if(kind is None):
+        return((count, [], [()]))
+    names = [n for n in SEPARATOR.split(names or '') if n] or \
+            [DEFAULT_VARIABLE, ]
+    if(basedir is None):
+        basedir = os.getcwd()
+
+    kind = kind.lower()
+    body = _parenthesized(arg)
+    if(kind == 'from'):
+        if(body is not None):
+            lines = body.splitlines()
+        else:
+            f = open(os.path.join(basedir, arg.strip()))
+            try:
+                lines = f.read().decode('utf-8').splitlines()
+            finally:
+                f.close()
+        return((count, names, _split_items(lines, len(names))))
+
+    if(len(names) != 1):
+        raise(ValueError('Queue %s takes a single variable.' % (kind)))
+    if(kind == 'in'):
+        if(body is None):
+            raise(ValueError('Queue in needs a list of items in parentheses.'))
+        items = [(v, ) for v in SEPARATOR.split(body.strip()) if v]
+        return((count, names, items))
+
+    # matching [files | dirs] pattern ...
+    patterns = arg.split()
+    keep = os.path.exists
+    if(patterns and patterns[0].lower() in ('files', 'dirs')):
+        keep = os.path.isfile if patterns[0].lower() == 'files' \
+               else os.path.isdir
+        patterns = patterns[1:]
+    items = []
+    for pattern in patterns:
+        paths = glob.glob(os.path.join(basedir, pattern))
+        items += sorted([(os.path.relpath(p, basedir), ) for p in paths
+                         if keep(p)])
+    return((count, names, items))
+
+
+def expand(text, macros, keep=(), depth=0):
+    """
+    Expand the macros in `text` using the {lowercase name: text} dictionary
+    `macros`. Macro texts are expanded in turn. Macros whose lowercase name is
+    in `keep` are left as they are; undefined ones expand to nothing.
+    """
+    if(depth > MAX_DEPTH):
+        raise(ValueError('Macros nested too deep (circular definition?)'))
+
+    def replace(match):
+        name = match.group(1).lower()
+        if(name in keep):
+            return(match.group(0))
+        value = macros.get(name, u'')
+        if('$(' in value):
+            value = expand(value, macros, keep, depth + 1)
+        return(value)
+    return(MACRO.sub(replace, text))
+
+
+def compile_text(text):
+    """
+    Compile the macro references in `text`: return the (format, [lowercase
+    macro names]) tuple that fill() and fill_all() use. A text with no macros
+    compiles to (text, []).
+    """
+    names = [name.lower() for name in MACRO.findall(text)]
+    if(not names):
+        return((text, names))
+    return((MACRO.sub('%s', text.replace('%', '%%')), names))
+
+
+def fill(compiled, values):
+    """
+    Return the compiled text `compiled` (see compile_text()) with its macros
+    replaced by their value in the {lowercase name: value} dictionary `values`.
+    """
+    (fmt, names) = compiled
+    if(not names):
+        return(fmt)
+    return(fmt % tuple([values[name] for name in names]))
+
+
+def fill_all(compiled, columns, n):
+    """
+    Return the list of the `n` texts obtained by filling the compiled text
+    `compiled` (see compile_text()) with each row of `columns`, a
+    {lowercase name: list of `n` values} dictionary.
+    """
+    (fmt, names) = compiled
+    if(not names):
+        return([fmt] * n)
+    if(len(names) == 1):
+        return([fmt % (v, ) for v in columns[names[0]]])
+    return([fmt % row
+            for row in itertools.izip(*[columns[name] for name in names])])
@@ -1,21 +1,51 @@
+import contextlib
 import os
+import random
+import re
+import sys
+import threading
 import time
 import urllib
 
 import elixir
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.exc
+from sqlalchemy.engine import reflection
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateIndex
 
 import config
 import logutils
+import stats
 
 
 
 
 
 # Constants
-# How many times do we try to get a lock on the DB before giving up?
+# How many times do we retry getting a lock on the DB before giving up?
 MAX_RETRIES = 3
-# How many seconds do we wait between retries?
+# How many seconds do we wait between retries (initially and at most)?
 SLEEP_TIME = 0.1
+MAX_SLEEP_TIME = 2.
+# Database errors worth retrying (see is_retryable()): PostgreSQL SQLSTATEs
+# (serialization failure, deadlock, lock not available) besides connection
+# errors and shutdowns (classes 08 and 57)...
+RETRYABLE_SQLSTATES = ('40001', '40P01', '55P03')
+# ... MySQL error numbers (lock wait timeout, deadlock, server gone away, lost
+# connection, cannot connect)...
+RETRYABLE_MYSQL_ERRORS = (1205, 1213, 2002, 2003, 2006, 2013)
+# ... and error messages, for everybody else (e.g. SQLite, MSSQL).
+RETRYABLE_MESSAGE = re.compile(r'locked|busy|deadlock|serializ|timeout|' +
+                               r'timed out|lost connection|connection (is )?' +
+                               r'closed|gone away|could not connect|' +
+                               r'communication link failure', re.I)
+# Retry counters of the decorated functions (see retry_stats()).
+_RETRY_STATS = {}
+_RETRY_STATS_LOCK = threading.Lock()
+# Per thread retry policy (see deferred_retries()).
+_LOCAL = threading.local()
 
 
 
@@ -23,8 +53,7 @@ def init():
     # Define the database connection.
     # We use SQLite3 for testing and small installations...
     if(config.DATABASE_FLAVOUR == 'sqlite'):
-        elixir.metadata.bind = 'sqlite:///%s' \
-                               % (os.path.abspath(config.DATABASE_DB))
+        url = 'sqlite:///%s' % (os.path.abspath(config.DATABASE_DB))
     else:
         has_mssql = config.DATABASE_FLAVOUR.startswith('mssql')
         port_info = ''
@@ -51,44 +80,327 @@ def init():
         else:
             connection_str += '%(port_info)s%(db_info)s'
         
-        elixir.metadata.bind = connection_str % {'flavour': config.DATABASE_FLAVOUR,
-                                                 'user': config.DATABASE_USER,
-                                                 'passwd': pwd,
-                                                 'host': config.DATABASE_HOST,
-                                                 'port_info': port_info,
-                                                 'db_info': db_info}
+        url = connection_str % {'flavour': config.DATABASE_FLAVOUR,
+                                'user': config.DATABASE_USER,
+                                'passwd': pwd,
+                                'host': config.DATABASE_HOST,
+                                'port_info': port_info,
+                                'db_info': db_info}
+    elixir.metadata.bind = create_engine(url)
     elixir.metadata.bind.echo = False
     return
 
 
+def create_engine(url, tuned=True):
+    """
+    Create an engine for the database at `url` set up as per the [Engine] 
+    section of the configuration file: connection pool size, overflow, timeout,
+    recycling and liveness checks for database servers; journal mode, 
+    synchronous level, busy timeout and memory mapping for SQLite, applied to 
+    every new connection.
+    
+    With `tuned` False, create the engine with the SQLAlchemy defaults instead 
+    (handy for comparisons).
+    
+    Either way, statements sent to the database are counted as round trips by
+    the stats module.
+    """
+    if(not tuned):
+        engine = sqlalchemy.create_engine(url)
+    elif(url.startswith('sqlite')):
+        # SQLAlchemy does not pool SQLite file connections: nothing to tune.
+        engine = sqlalchemy.create_engine(url)
+        sqlalchemy.event.listen(engine, 'connect', _tune_sqlite)
+    else:
+        pool = {'pool_size': config.ENGINE_POOL_SIZE,
+                'max_overflow': config.ENGINE_MAX_OVERFLOW,
+                'pool_timeout': config.ENGINE_POOL_TIMEOUT,
+                'pool_recycle': config.ENGINE_POOL_RECYCLE}
+        engine = sqlalchemy.create_engine(url, **pool)
+        if(config.ENGINE_PRE_PING):
+            sqlalchemy.event.listen(engine.pool, 'checkout', _ping)
+    
+    # Count round trips to the database (see stats.py).
+    stats.instrument_engine(engine)
+    return(engine)
+
+
+def _tune_sqlite(dbapi_connection, connection_record):
+    """
+    Configure a brand new SQLite connection (see create_engine()).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA busy_timeout = %d' \
+                   % (config.ENGINE_SQLITE_BUSY_TIMEOUT))
+    cursor.execute('PRAGMA journal_mode = %s' \
+                   % (config.ENGINE_SQLITE_JOURNAL_MODE))
+    cursor.execute('PRAGMA synchronous = %s' \
+                   % (config.ENGINE_SQLITE_SYNCHRONOUS))
+    cursor.execute('PRAGMA mmap_size = %d' % (config.ENGINE_SQLITE_MMAP_SIZE))
+    cursor.close()
+    return
+
+
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    """
+    Make sure that the pooled connection we are about to hand out is still 
+    alive. If it is not, have the pool throw it away and try another one.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise(sqlalchemy.exc.DisconnectionError())
+    finally:
+        cursor.close()
+    return
+
+
+@compiles(CreateIndex)
+def _create_index(create, compiler, **kw):
+    """
+    Index columns listed in the `descending` keyword argument of 
+    sqlalchemy.Index (e.g. Index('ix', 'a', 'b', descending=('b', ))) are 
+    indexed in descending order. This is what lets a query ordered by 
+    b DESC, c walk an index instead of sorting.
+    """
+    sql = compiler.visit_create_index(create, **kw)
+    descending = create.element.kwargs.get('descending', ())
+    if(not descending):
+        return(sql)
+    
+    # The column list is the last thing in the statement.
+    (head, columns) = sql.rstrip().rsplit('(', 1)
+    columns = [c.strip() for c in columns.rstrip(')').split(',')]
+    quoted = [compiler.preparer.quote(name, None) for name in descending]
+    columns = [c + ' DESC' if c in quoted else c for c in columns]
+    return('%s(%s)' % (head, ', '.join(columns)))
+
+
+def _is_binary(column_type):
+    return(isinstance(column_type, sqlalchemy.types._Binary))
+
+
+def upgrade_schema():
+    """
+    Bring the tables of an existing database up to date with the entity 
+    definitions, in place: create missing tables, add missing columns, create 
+    missing indexes and drop the ix_<table>_* indexes that are no longer 
+    defined (they were superseded by new ones). Data is never touched except to
+    give newly added columns their default value and to empty cache columns 
+    (see below). Safe to run any number of times.
+    
+    Columns defined with info={'cache': True} only hold data that can be done
+    without (e.g. JobQueueEntry.job_state). When their type changed between
+    binary and text, they are dropped and added again, empty, rather than 
+    converted. Not on SQLite, which stores any value in any column.
+    
+    Return the list of the DDL changes that were made, as strings.
+    """
+    engine = elixir.metadata.bind
+    elixir.metadata.create_all(engine)
+    inspector = reflection.Inspector.from_engine(engine)
+    
+    # MSSQL does not want the COLUMN keyword in ALTER TABLE ... ADD.
+    add_column = 'ALTER TABLE %s ADD COLUMN %s %s'
+    if(engine.dialect.name == 'mssql'):
+        add_column = 'ALTER TABLE %s ADD %s %s'
+    drop_column = 'ALTER TABLE %s DROP COLUMN %s'
+    # MySQL and MSSQL want to know the table of the index to drop.
+    drop_index = 'DROP INDEX %(index)s'
+    if(engine.dialect.name in ('mysql', 'mssql')):
+        drop_index = 'DROP INDEX %(index)s ON %(table)s'
+    
+    changes = []
+    for table in elixir.metadata.sorted_tables:
+        existing = dict([(c['name'], c['type']) 
+                         for c in inspector.get_columns(table.name)])
+        for column in table.columns:
+            if(column.name in existing):
+                if(not column.info.get('cache') or 
+                   engine.dialect.name == 'sqlite' or
+                   _is_binary(existing[column.name]) == 
+                   _is_binary(column.type)):
+                    continue
+                ddl = drop_column % (table.name, column.name)
+                engine.execute(ddl)
+                changes.append(ddl)
+            ddl = add_column % (table.name, 
+                                column.name, 
+                                column.type.compile(dialect=engine.dialect))
+            engine.execute(ddl)
+            if(column.default is not None and column.default.is_scalar):
+                engine.execute(table.update().values({column.name: 
+                                                      column.default.arg}))
+            changes.append(ddl)
+        
+        existing = [i['name'] for i in inspector.get_indexes(table.name)]
+        defined = [index.name for index in table.indexes]
+        for name in existing:
+            if(name in defined or not name.startswith('ix_%s_' % (table.name))):
+                continue
+            ddl = drop_index % {'index': name, 'table': table.name}
+            engine.execute(ddl)
+            changes.append(ddl)
+        for index in table.indexes:
+            if(index.name in existing):
+                continue
+            index.create(bind=engine)
+            changes.append('CREATE INDEX %s ON %s' % (index.name, table.name))
+    return(changes)
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Context manager handing out a connection to the bound database with a
+    transaction already started. The transaction is committed when the block
+    exits normally and rolled back if it raises.
+    
+    Use it like this:
+        with transaction() as connection:
+            connection.execute(...)
+    """
+    connection = elixir.metadata.bind.connect()
+    trans = connection.begin()
+    try:
+        yield(connection)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def is_retryable(exception):
+    """
+    Return True if `exception` is the kind of database error that might go 
+    away if we simply try again: lock timeouts, deadlocks, dropped connections
+    and the like. Programming errors, integrity violations and anything not 
+    coming from the database are not worth retrying.
+    """
+    if(isinstance(exception, sqlalchemy.exc.TimeoutError)):
+        # No connection available in the pool (yet).
+        return(True)
+    if(not isinstance(exception, sqlalchemy.exc.DBAPIError)):
+        return(False)
+    if(exception.connection_invalidated):
+        return(True)
+    
+    # Locks, deadlocks, serialization failures and lost connections, by 
+    # driver error code where there is one (MySQL error numbers, PostgreSQL 
+    # SQLSTATEs) and by message otherwise. Drivers report most of these as 
+    # OperationalError, but so does SQLite for missing tables, missing columns 
+    # and syntax errors: the class alone says nothing.
+    orig = exception.orig
+    code = getattr(orig, 'pgcode', None)
+    if(code is not None):
+        return(code in RETRYABLE_SQLSTATES or code[:2] in ('08', '57'))
+    args = getattr(orig, 'args', ())
+    if(args and isinstance(args[0], (int, long))):
+        return(args[0] in RETRYABLE_MYSQL_ERRORS)
+    return(RETRYABLE_MESSAGE.search(str(orig)) is not None)
+
+
+def retry_stats():
+    """
+    Return the retry counters of all the functions decorated with 
+    run_with_retries_and_rollback that have been called so far, as a 
+        {module.function: {'attempts': a, 'retries': r, 'give_ups': g}}
+    dictionary. A steady stream of retries is the tell-tale sign of lock 
+    contention on the database.
+    """
+    with _RETRY_STATS_LOCK:
+        return(dict([(name, dict(counters)) 
+                     for (name, counters) in _RETRY_STATS.items()]))
+
+
+def reset_retry_stats():
+    """
+    Zero all the retry_stats() counters.
+    """
+    with _RETRY_STATS_LOCK:
+        _RETRY_STATS.clear()
+    return
+
+
+def backoff(retries, sleep_time=SLEEP_TIME, max_sleep_time=MAX_SLEEP_TIME):
+    """
+    Return how many seconds to wait before retry number `retries` (1, 2, ...):
+    a random amount between 0 and min(`max_sleep_time`, 
+    `sleep_time` * 2**(`retries`-1)).
+    """
+    delay = min(max_sleep_time, sleep_time * 2 ** (retries - 1))
+    return(random.uniform(0, delay))
+
+
+@contextlib.contextmanager
+def deferred_retries():
+    """
+    Context manager making the functions decorated with
+    run_with_retries_and_rollback called in the block (by this thread) raise
+    retryable exceptions right away instead of sleeping and retrying: the
+    caller takes care of retrying, without tying up the thread in the
+    meantime (see asyncqueue.py).
+    """
+    deferred = getattr(_LOCAL, 'deferred', False)
+    _LOCAL.deferred = True
+    try:
+        yield
+    finally:
+        _LOCAL.deferred = deferred
+
+
+def _count(name, counter):
+    with _RETRY_STATS_LOCK:
+        counters = _RETRY_STATS.setdefault(name, {'attempts': 0, 
+                                                  'retries': 0, 
+                                                  'give_ups': 0})
+        counters[counter] += 1
+    return
+
+
 # Decorator to handle cases where the DB operation might fail and need to be
 # retried. Inspired by the retry decorator in the Python Decorator Library.
 class run_with_retries_and_rollback(object):
     """
     Decorator
     
-    Execute the function we are decorating. If that function raises an exception
-    log it, record it, rollback the DB session, sleep for `sleep_time` seconds 
-    and then try again a maximum of `max_retries` number of times.
+    Execute the function we are decorating. If that function raises a 
+    retryable exception (see is_retryable()) log it, rollback the DB session, 
+    sleep a bit and then try again a maximum of `max_retries` times. Any other
+    exception, and the last one if we run out of retries, is raised to the
+    caller.
+    
+    Retries back off exponentially with full jitter: before retry number n we
+    sleep a random amount of time between 0 and 
+        min(`max_sleep_time`, `sleep_time` * 2**(n-1))
+    seconds, so that callers contending for the same lock do not all come back 
+    at the same time.
     
     `max_retries` has to be an integer >= 0 (default = 3).
     `sleep_time` has to be a float >= 0 (default = 0.1).
+    `max_sleep_time` has to be a float >= 0 (default = 2.0).
+    `retryable` is the function deciding which exceptions are worth another 
+        try (default = is_retryable).
+    
+    Retry state is private to each call. How many attempts, retries and 
+    give-ups each decorated function had is recorded and made available by 
+    retry_stats(). Within a deferred_retries() block, retryable exceptions 
+    are raised right away for the caller to retry.
     
     Use it like this:
-        @run_with_retries(5, 0.2)
-        def foo(bar, baz):
-            ...
-        foo(99, 'boo')
-    will try and run foo(99, 'boo') up to 5 times, waiting 0.2 seconds between 
-    retries.
-        @run_with_retries(3, 0.1)
+        @run_with_retries_and_rollback
         def foo(bar, baz):
             ...
         foo(99, 'boo')
-    will instead try and run foo(99, 'boo') up to 3 times, waiting 0.1 seconds
-    between retries.
+    will try and run foo(99, 'boo') and retry it up to 3 times, starting with
+    sleeps of up to 0.1 seconds. To change the defaults:
+        foo = run_with_retries_and_rollback(foo, 5, 0.2)
     """
-    def __init__(self, f, max_retries=MAX_RETRIES, sleep_time=SLEEP_TIME):
+    def __init__(self, f, max_retries=MAX_RETRIES, sleep_time=SLEEP_TIME,
+                 max_sleep_time=MAX_SLEEP_TIME, retryable=is_retryable):
         # Just make sure that max_retries and sleep make sense.
         self.max_retries = int(max_retries)
         if(max_retries < 0):
@@ -96,66 +408,50 @@ class run_with_retries_and_rollback(object):
         self.sleep_time = float(sleep_time)
         if(sleep_time < 0):
             raise(ValueError('sleep_time must be greater or equal to 0'))
-        self.exception = Exception('Something bad happened.')
-        self.retries = 0
+        self.max_sleep_time = float(max_sleep_time)
+        if(max_sleep_time < 0):
+            raise(ValueError('max_sleep_time must be greater or equal to 0'))
+        self.retryable = retryable
         self.f = f
         self.__name__ = f.__name__
+        self.__module__ = f.__module__
+        self.__doc__ = f.__doc__
+        self.name = '%s.%s' % (f.__module__, f.__name__)
         return
     
     def __repr__(self):
         return(self.f.__doc__)
     
     def __call__(self, *args, **kwargs):
-        # Have we tried already the maximum number of times?
-        if(self.retries >= self.max_retries):
-            msg = 'Call to %s.%s with args %s and kwargs %s failed %d times.'
-            logutils.logger.critical(msg % (self.f.__module__, 
-                                            self.f.__name__, 
-                                            str(args),
-                                            str(kwargs),
-                                            self.retries))
-            raise(self.exception)
-        
-        try:
-            result = self.f(*args, **kwargs)
-        except Exception, e:
-            # Ops! that did not work Save the exception we got, increase 
-            # self.retries rollback, sleep a bit, then retry.
-            self.exception = e
-            self.retries += 1
-            elixir.session.rollback()
-            time.sleep(self.sleep_time)
-            self(*args, **kwargs)
-        return(result)
-    
-    
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        retries = 0
+        while(True):
+            _count(self.name, 'attempts')
+            try:
+                return(self.f(*args, **kwargs))
+            except Exception, e:
+                # Keep hold of the exception: a rollback() failing and
+                # handling its own error would replace it in sys.exc_info().
+                (t, v, tb) = sys.exc_info()
+                elixir.session.rollback()
+                if(not self.retryable(e)):
+                    raise t, v, tb
+                if(getattr(_LOCAL, 'deferred', False)):
+                    # Our caller retries (see deferred_retries()).
+                    raise t, v, tb
+                if(retries >= self.max_retries):
+                    _count(self.name, 'give_ups')
+                    msg = 'Call to %s with args %s and kwargs %s failed %d ' + \
+                          'times: %s'
+                    logutils.logger.critical(msg % (self.name, 
+                                                    str(args),
+                                                    str(kwargs),
+                                                    retries + 1,
+                                                    e))
+                    raise t, v, tb
+            
+            # Ops! that did not work. Sleep a bit, then retry.
+            retries += 1
+            _count(self.name, 'retries')
+            logutils.logger.warning('Retrying %s (%d/%d): %s' \
+                                    % (self.name, retries, self.max_retries, e))
+            time.sleep(backoff(retries, self.sleep_time, self.max_sleep_time))
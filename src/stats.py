@@ -0,0 +1,269 @@
+"""
+In-process latency statistics.
+
+Functions decorated with timed() record how long each call takes in a
+per-function latency histogram, together with the number of database round
+trips (statements sent to the database) made during the call. A snapshot of
+all the histograms is written as JSON to a local stats file when the process
+exits and whenever it receives the configured signal (SIGUSR1 by default),
+e.g.
+    kill -USR1 <pid of cl2sd.py>
+
+Statistics are off unless the [Stats] section of the configuration file says
+otherwise (or enable() is called). When they are off, timed() functions do
+nothing but call the function they wrap: no clock reads, no bookkeeping and no
+string formatting.
+"""
+import atexit
+import functools
+import json
+import os
+import signal
+import threading
+import time
+
+import config
+import logutils
+
+
+
+
+# Constants
+# Histogram bucket i counts calls that took less than 2**i microseconds (the
+# last one counts all the others).
+BUCKETS = 32
+# Percentiles reported by snapshot().
+PERCENTILES = (50, 90, 99)
+
+# Are we collecting statistics?
+ENABLED = config.STATS_ENABLED
+# {name: Histogram} of all the timed() functions called so far.
+_HISTOGRAMS = {}
+_LOCK = threading.Lock()
+# Per thread stack of the timed() calls in progress, to charge database round
+# trips to.
+_CALLS = threading.local()
+# Round trips made outside of timed() calls.
+_UNTIMED = [0, ]
+
+
+
+
+class Histogram(object):
+    """
+    Latency histogram with power of two microsecond buckets.
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'round_trips', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = 0.
+        self.round_trips = 0
+        self.buckets = [0, ] * BUCKETS
+        return
+
+    def add(self, seconds, round_trips=0):
+        """
+        Record a call that took `seconds` and made `round_trips` database round
+        trips.
+        """
+        self.count += 1
+        self.total += seconds
+        if(self.min is None or seconds < self.min):
+            self.min = seconds
+        if(seconds > self.max):
+            self.max = seconds
+        self.round_trips += round_trips
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[min(bucket, BUCKETS - 1)] += 1
+        return
+
+    def percentile(self, p):
+        """
+        Return an upper bound, in seconds, on the `p`th percentile latency.
+        """
+        if(not self.count):
+            return(0.)
+        target = self.count * p / 100.
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if(seen >= target):
+                return(min(2 ** i / 1e6, self.max))
+        return(self.max)
+
+    def snapshot(self):
+        """
+        Return the histogram as a JSON friendly dictionary. Times are in
+        microseconds.
+        """
+        res = {'count': self.count,
+               'total_us': self.total * 1e6,
+               'mean_us': self.total * 1e6 / max(self.count, 1),
+               'min_us': (self.min or 0.) * 1e6,
+               'max_us': self.max * 1e6,
+               'db_round_trips': self.round_trips,
+               'buckets': self.buckets[:max([i + 1 for (i, n)
+                                             in enumerate(self.buckets)
+                                             if n] or [0])]}
+        for p in PERCENTILES:
+            res['p%d_us' % (p)] = self.percentile(p) * 1e6
+        return(res)
+
+
+
+
+def timed(f):
+    """
+    Decorator
+
+    Record the latency and database round trips of each call to `f` in the
+    histogram called after its module and name (e.g. JobQueue.pop), if
+    statistics are enabled. Works for methods too.
+    """
+    name = '%s.%s' % (f.__module__.split('.')[-1], f.__name__)
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if(not ENABLED):
+            return(f(*args, **kwargs))
+
+        calls = getattr(_CALLS, 'stack', None)
+        if(calls is None):
+            calls = _CALLS.stack = []
+        calls.append(0)
+        t0 = time.time()
+        try:
+            return(f(*args, **kwargs))
+        finally:
+            elapsed = time.time() - t0
+            round_trips = calls.pop()
+            if(calls):
+                # Our caller made these round trips as well.
+                calls[-1] += round_trips
+            with _LOCK:
+                histogram = _HISTOGRAMS.get(name)
+                if(histogram is None):
+                    histogram = _HISTOGRAMS[name] = Histogram()
+                histogram.add(elapsed, round_trips)
+    return(wrapper)
+
+
+def count_round_trip(*args):
+    """
+    Charge a database round trip to the innermost timed() call in progress in
+    this thread. Meant to be registered as a before_cursor_execute engine event
+    listener (see instrument_engine()).
+    """
+    if(not ENABLED):
+        return
+    calls = getattr(_CALLS, 'stack', None)
+    if(calls):
+        calls[-1] += 1
+    else:
+        with _LOCK:
+            _UNTIMED[0] += 1
+    return
+
+
+def instrument_engine(engine):
+    """
+    Count the statements `engine` sends to the database.
+    """
+    import sqlalchemy.event
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', count_round_trip)
+    return
+
+
+def snapshot():
+    """
+    Return all the histograms collected so far as a JSON friendly dictionary.
+    """
+    with _LOCK:
+        return({'pid': os.getpid(),
+                'time': time.time(),
+                'untimed_db_round_trips': _UNTIMED[0],
+                'timers': dict([(name, h.snapshot())
+                                for (name, h) in _HISTOGRAMS.items()])})
+
+
+def reset():
+    """
+    Throw away all the statistics collected so far.
+    """
+    with _LOCK:
+        _HISTOGRAMS.clear()
+        _UNTIMED[0] = 0
+    return
+
+
+def dump(path=None):
+    """
+    Write a snapshot() to the file `path` (config.STATS_FILE by default, where
+    %(pid)d is replaced by the id of this process) and return its name. Do
+    nothing and return None if no statistics were collected.
+    """
+    if(path is None):
+        path = config.STATS_FILE % {'pid': os.getpid()}
+    data = snapshot()
+    if(not data['timers'] and not data['untimed_db_round_trips']):
+        return
+
+    # Write the new file next to the old one and swap them, so that readers
+    # never see a half written file.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmp_path, 'w')
+    try:
+        json.dump(data, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+    return(path)
+
+
+def _dump_on_signal(signum, frame):
+    try:
+        logutils.logger.info('Statistics written to %s' % (dump()))
+    except Exception, e:
+        logutils.logger.critical('Exception writing statistics: %s' % (e))
+    return
+
+
+def enable(install_handlers=True):
+    """
+    Start collecting statistics. Unless `install_handlers` is False, also
+    arrange for them to be written to disk at exit and on config.STATS_SIGNAL.
+    """
+    global ENABLED
+    ENABLED = True
+    if(install_handlers):
+        atexit.register(dump)
+        signum = getattr(signal, config.STATS_SIGNAL, None)
+        if(signum is None):
+            logutils.logger.critical('Unknown signal %s: statistics will only'
+                                     ' be written at exit.'
+                                     % (config.STATS_SIGNAL))
+        else:
+            try:
+                signal.signal(signum, _dump_on_signal)
+            except ValueError:
+                # Not the main thread: no signal handlers for us.
+                pass
+    return
+
+
+def disable():
+    """
+    Stop collecting statistics.
+    """
+    global ENABLED
+    ENABLED = False
+    return
+
+
+
+
+if(ENABLED):
+    enable()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Compare the memory footprint and speed of the ClassAd attribute store with the
+original one, which kept up to three instance variables (original case,
+lowercase and uppercase) per ClassAd attribute plus a list of attribute names.
+
+Usage
+    bench_classad.py [repetitions]
+"""
+import os
+import sys
+import timeit
+
+from cl2s import ClassAd
+from cl2s.CL2SObject import CL2SObject
+
+from test_jobqueue import CLASS_AD
+
+
+
+# Constants
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADS = {'single': open(os.path.join(HERE, 'job_ad_single.txt')).read(),
+       'cluster': open(os.path.join(HERE, 'job_ad_cluster.txt')).read(),
+       'huge_environment': CLASS_AD.encode('utf-8')}
+# Turn off GetEnv so that the numbers do not depend on os.environ.
+ADS = dict([(k, v.replace('GetEnv = true', 'GetEnv = false'))
+            for (k, v) in ADS.items()])
+# Synthetic 100 attribute ad.
+ADS['synthetic_100'] = ''.join(['Attribute%03d = %d\n' % (i, i)
+                                for i in range(100)])
+
+
+
+
+class LegacyClassAd(CL2SObject):
+    """
+    The original ClassAd attribute store.
+    """
+    def __init__(self, ad):
+        self._ad = ad
+        parsed = ClassAd._classad_to_dict(ad)
+        self._ad_attributes = parsed.keys()
+        for (k, v) in parsed.items():
+            setattr(self, k, v)
+        if(not hasattr(self, 'environment')):
+            self.Environment = {}
+        if(getattr(self, 'getenv', False)):
+            self.Environment.update(os.environ)
+            self.getenv = False
+        if(not hasattr(self, 'owner')):
+            self.Owner = os.environ.get('USER', 'unknown')
+        return
+
+    def __repr__(self):
+        d = dict([(k, getattr(self, k)) for k in self._ad_attributes])
+        return(ClassAd._dict_to_classad(d))
+
+    def __setattr__(self, name, value):
+        if(name.startswith('_')):
+            return(CL2SObject.__setattr__(self, name, value))
+        if(name not in self._ad_attributes):
+            self._ad_attributes.append(name)
+        if(not hasattr(self, name.lower())):
+            CL2SObject.__setattr__(self, name.lower(), value)
+        if(not hasattr(self, name.upper())):
+            CL2SObject.__setattr__(self, name.upper(), value)
+        return(CL2SObject.__setattr__(self, name, value))
+
+
+
+
+def footprint(ad):
+    """
+    Bytes used by the instance and its attribute bookkeeping, including the
+    attribute name copies it made (values and the attribute names found in the
+    ad text are the same for both implementations and are not counted).
+    """
+    if(isinstance(ad, LegacyClassAd)):
+        (attrs, names) = (ad.__dict__, ad._ad_attributes)
+    else:
+        (attrs, names) = (ad._attrs, ad._names)
+    size = sys.getsizeof(ad) + sys.getsizeof(attrs) + sys.getsizeof(names)
+    size += sum([sys.getsizeof(k) for k in attrs if k not in names])
+    return(size)
+
+
+def bench(cls, text, repetitions):
+    """
+    Return the best time in microseconds to build a `cls` instance from `text`,
+    set every one of its attributes once and turn it back into text.
+    """
+    def run():
+        ad = cls(text)
+        for (name, value) in ClassAd._classad_to_dict(text).items():
+            setattr(ad, name, value)
+        repr(ad)
+    timer = timeit.Timer(run)
+    return(min(timer.repeat(3, repetitions)) / repetitions * 1e6)
+
+
+def main(repetitions=1000):
+    header = '%-18s %6s %10s %10s %10s %10s'
+    row = '%-18s %6d %10d %10d %10.1f %10.1f'
+    print(header % ('ad', 'attrs', 'old bytes', 'new bytes', 'old us',
+                    'new us'))
+    for name in sorted(ADS):
+        text = ADS[name]
+        old = LegacyClassAd(text)
+        new = ClassAd.ClassAd(text)
+        print(row % (name, len(new._attrs), footprint(old), footprint(new),
+                     bench(LegacyClassAd, text, repetitions),
+                     bench(ClassAd.ClassAd, text, repetitions)))
+    return
+
+
+
+
+if(__name__ == '__main__'):
+    main(*[int(arg) for arg in sys.argv[1:2]])
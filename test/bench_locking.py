@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Measure how often concurrent job queue clients run into "database is locked"
+errors on a throwaway SQLite database, with the SQLAlchemy default engine
+(what CL2S used to do) and with the engine tuned as per the [Engine] section of
+the configuration file (WAL, busy timeout etc., see ormutils.create_engine()).
+
+Each client pushes jobs, claims them and deletes them, just like submit
+commands and job hooks do, each in its own process. Lock errors are the 
+database retries and give-ups recorded by 
+ormutils.run_with_retries_and_rollback.
+
+Usage
+    bench_locking.py [clients [jobs per client]]
+"""
+import logging
+import os
+import shutil
+import sys
+import multiprocessing
+import tempfile
+import time
+
+import elixir
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import logutils
+from cl2s import ormutils
+
+
+
+# Constants
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "j9am%04d"\nMyType = "Job"\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+
+
+def client(n, results):
+    failed = 0
+    try:
+        for i in range(n):
+            JobQueue.push(Job(CLASS_AD % (i)))
+            queued = JobQueue.claim()
+            if(queued is not None):
+                JobQueue.delete_by_id(queued.job_id)
+    except Exception, e:
+        failed = 1
+    stats = ormutils.retry_stats().values()
+    results.put((sum([s['attempts'] for s in stats]),
+                 sum([s['retries'] + s['give_ups'] for s in stats]),
+                 failed))
+    return
+
+
+def bench(tuned, clients, n):
+    """
+    Run `clients` concurrent client processes each processing `n` jobs and 
+    return (seconds, database calls, lock errors, failed clients).
+    """
+    tmp_dir = tempfile.mkdtemp()
+    old_bind = elixir.metadata.bind
+    url = 'sqlite:///%s' % (os.path.join(tmp_dir, 'cl2s.sqlite'))
+    elixir.metadata.bind = ormutils.create_engine(url, tuned)
+    elixir.setup_all()
+    elixir.create_all()
+    elixir.session.remove()
+    ormutils.reset_retry_stats()
+    try:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client, args=(n, results))
+                     for i in range(clients)]
+        t0 = time.time()
+        for process in processes:
+            process.start()
+        totals = [sum(column) 
+                  for column in zip(*[results.get() for p in processes])]
+        for process in processes:
+            process.join()
+        elapsed = time.time() - t0
+    finally:
+        elixir.metadata.bind = old_bind
+        shutil.rmtree(tmp_dir)
+    return([elapsed, ] + totals)
+
+
+def main(clients=16, n=50):
+    header = '%-8s %8s %10s %8s %10s %8s'
+    row = '%-8s %8.2f %10d %8d %9.2f%% %8d'
+    print(header % ('engine', 'seconds', 'attempts', 'locked', 'lock rate',
+                    'failed'))
+    for (name, tuned) in (('default', False), ('tuned', True)):
+        (elapsed, attempts, locked, failed) = bench(tuned, clients, n)
+        print(row % (name, elapsed, attempts, locked,
+                     100. * locked / max(attempts, 1), failed))
+    return
+
+
+
+
+if(__name__ == '__main__'):
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+Non-interactive microbenchmarks for the ClassAd and job queue primitives.
+
+Every benchmark is run `repeat` times and each run times `number` calls (or
+queue operations). Per call times of all the runs are reported: the best one is
+the figure to compare, the median tells how noisy the machine was. Queue
+benchmarks use a throwaway SQLite database created with the [Engine] settings
+of the configuration file; the real job queue is never touched.
+
+Results can be written as JSON and compared with those of an earlier run.
+
+Usage
+    benchmarks.py [-repeat r] [-number n] [-output file] [-compare file]
+                  [pattern ...]
+
+Options
+-repeat r
+    Run each benchmark r times (default 5).
+-number n
+    Time n calls per run (default 1000 for ClassAd benchmarks, a tenth of that
+    for queue ones).
+-output file
+    Write the results as JSON to file.
+-compare file
+    Show the speedup with respect to the results in file (as written by
+    -output).
+pattern
+    Only run the benchmarks whose name contains any of these.
+"""
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import elixir
+
+from cl2s import ClassAd
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s.JobTemplate import JobTemplate
+from cl2s import ormutils
+
+from test_jobqueue import CLASS_AD
+
+
+
+# Constants
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADS = {'single': open(os.path.join(HERE, 'job_ad_single.txt')).read(),
+       'cluster': open(os.path.join(HERE, 'job_ad_cluster.txt')).read(),
+       'huge_environment': CLASS_AD.encode('utf-8')}
+# Turn off GetEnv so that the numbers do not depend on os.environ.
+ADS = dict([(k, v.replace('GetEnv = true', 'GetEnv = false'))
+            for (k, v) in ADS.items()])
+# The Environment of the huge_environment ad, as it appears in the ad.
+ENVIRONMENT = ClassAd.extract_attributes(ADS['huge_environment'],
+                                         ['Environment'])['Environment']
+ENVIRONMENT_TEXT = ClassAd._dict_to_classad_environment(ENVIRONMENT)
+
+
+
+
+def classad_benchmarks():
+    """
+    Return the [(name, function), ] list of the ClassAd benchmarks.
+    """
+    res = []
+    for name in sorted(ADS):
+        text = ADS[name]
+        parsed = ClassAd._classad_to_dict(text)
+        res += [('_classad_to_dict/%s' % (name),
+                 lambda text=text: ClassAd._classad_to_dict(text)),
+                ('_dict_to_classad/%s' % (name),
+                 lambda parsed=parsed: ClassAd._dict_to_classad(parsed)),
+                ('ClassAd.__init__/%s' % (name),
+                 lambda text=text: ClassAd.ClassAd(text)),
+                ('Job.__init__/%s' % (name),
+                 lambda text=text: Job(text))]
+    template = JobTemplate(ADS['cluster'])
+    res += [('JobTemplate.instance/cluster',
+             lambda: template.instance(7))]
+    res += [('environment/parse',
+             lambda: ClassAd._classad_environment_to_dict(ENVIRONMENT_TEXT)),
+            ('environment/serialize',
+             lambda: ClassAd._dict_to_classad_environment(ENVIRONMENT))]
+    return(res)
+
+
+def time_calls(f, repeat, number):
+    """
+    Return the list of the `repeat` per call times (in seconds) of `number`
+    calls to `f`.
+    """
+    return([t / number for t in timeit.Timer(f).repeat(repeat, number)])
+
+
+
+
+class ThrowawayQueue(object):
+    """
+    Context manager binding the job queue to a brand new SQLite database for
+    the duration of the block.
+    """
+    def __enter__(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_bind = elixir.metadata.bind
+        elixir.metadata.bind = ormutils.create_engine(
+            'sqlite:///%s' % (os.path.join(self.tmp_dir, 'cl2s.sqlite')))
+        elixir.setup_all()
+        elixir.create_all()
+        return(self)
+
+    def __exit__(self, *exc_info):
+        elixir.session.remove()
+        elixir.metadata.bind = self.old_bind
+        shutil.rmtree(self.tmp_dir)
+        return(False)
+
+
+def _jobs(number):
+    text = ADS['huge_environment']
+    return([Job(text.replace('j9am01070', 'j9am0%04d' % (i)))
+            for i in range(number)])
+
+
+def _time_each(f, items):
+    # Per call time of f(item) for each of items.
+    t0 = time.time()
+    for item in items:
+        f(item)
+    return((time.time() - t0) / max(len(items), 1))
+
+
+def bench_push(number):
+    jobs = _jobs(number)
+    with ThrowawayQueue():
+        return(_time_each(JobQueue.push, jobs))
+
+
+def bench_push_many(number):
+    jobs = _jobs(number)
+    with ThrowawayQueue():
+        t0 = time.time()
+        JobQueue.push_many(jobs)
+        return((time.time() - t0) / number)
+
+
+def bench_push_cluster(number):
+    template = JobTemplate(ADS['huge_environment'].replace(
+        'j9am01070', 'j9am$(Process)') + 'Queue %d\n' % (number))
+    with ThrowawayQueue():
+        t0 = time.time()
+        JobQueue.push_cluster(template)
+        return((time.time() - t0) / number)
+
+
+def bench_pop(number):
+    with ThrowawayQueue():
+        JobQueue.push_many(_jobs(number))
+        return(_time_each(lambda i: JobQueue.pop(), range(number)))
+
+
+def bench_claim(number):
+    with ThrowawayQueue():
+        JobQueue.push_many(_jobs(number))
+        return(_time_each(lambda i: JobQueue.claim(), range(number)))
+
+
+def bench_delete(number):
+    with ThrowawayQueue():
+        JobQueue.push_many(_jobs(number))
+        jobs = JobQueue.pop_batch(number)
+        return(_time_each(JobQueue.delete, jobs))
+
+
+def bench_reinsert(number):
+    with ThrowawayQueue():
+        JobQueue.push_many(_jobs(number))
+        jobs = JobQueue.pop_batch(number)
+        return(_time_each(JobQueue.reinsert, jobs))
+
+
+def queue_benchmarks():
+    """
+    Return the [(name, function), ] list of the job queue benchmarks. Each
+    function takes the number of operations to time and returns the time per
+    operation.
+    """
+    return([('JobQueue.push', bench_push),
+            ('JobQueue.push_many', bench_push_many),
+            ('JobQueue.push_cluster', bench_push_cluster),
+            ('JobQueue.pop', bench_pop),
+            ('JobQueue.claim', bench_claim),
+            ('JobQueue.delete', bench_delete),
+            ('JobQueue.reinsert', bench_reinsert)])
+
+
+
+
+def summarize(times):
+    """
+    Turn the list of per call `times` (in seconds) into a dictionary of
+    microsecond figures.
+    """
+    times = sorted(times)
+    return({'best_us': times[0] * 1e6,
+            'median_us': times[len(times) / 2] * 1e6,
+            'runs_us': [t * 1e6 for t in times]})
+
+
+def run(patterns=(), repeat=5, number=None):
+    """
+    Run the benchmarks whose names contain any of `patterns` (all of them by
+    default) and return their results, keyed by benchmark name.
+    """
+    def wanted(name):
+        return(not patterns or [p for p in patterns if p in name])
+
+    results = {}
+    for (name, f) in classad_benchmarks():
+        if(wanted(name)):
+            results[name] = summarize(time_calls(f, repeat, number or 1000))
+    for (name, f) in queue_benchmarks():
+        if(wanted(name)):
+            results[name] = summarize([f(number or 100)
+                                       for i in range(repeat)])
+    return(results)
+
+
+def report(results, baseline=None):
+    """
+    Print `results` as a table, with the speedup with respect to `baseline` 
+    (results of an earlier run) if given.
+    """
+    columns = ['benchmark', 'best us', 'median us']
+    if(baseline):
+        columns.append('speedup')
+    print(('%-36s' + ' %12s' * (len(columns) - 1)) % tuple(columns))
+    for name in sorted(results):
+        line = '%-36s %12.1f %12.1f' % (name, 
+                                        results[name]['best_us'], 
+                                        results[name]['median_us'])
+        if(baseline and name in baseline):
+            line += ' %11.2fx' % (baseline[name]['best_us'] / 
+                                  results[name]['best_us'])
+        elif(baseline):
+            line += ' %12s' % ('-')
+        print(line)
+    return
+
+
+
+
+if(__name__ == '__main__'):
+    import argparse
+
+
+
+    parser = argparse.ArgumentParser(description='CL2S microbenchmarks.')
+    parser.add_argument('-repeat', '--repeat', '-r',
+                        type=int,
+                        default=5,
+                        dest='repeat',
+                        help='Number of runs per benchmark.')
+    parser.add_argument('-number', '--number', '-n',
+                        type=int,
+                        default=None,
+                        dest='number',
+                        help='Number of calls per run.')
+    parser.add_argument('-output', '--output', '-o',
+                        default=None,
+                        dest='output',
+                        help='Write the results as JSON to this file.')
+    parser.add_argument('-compare', '--compare', '-c',
+                        default=None,
+                        dest='compare',
+                        help='Compare with the JSON results in this file.')
+    parser.add_argument('patterns',
+                        nargs='*',
+                        help='Only run benchmarks whose name contains these.')
+    args = parser.parse_args()
+
+    baseline = None
+    if(args.compare):
+        baseline = json.load(open(args.compare))['results']
+
+    results = run(args.patterns, args.repeat, args.number)
+    report(results, baseline)
+
+    if(args.output):
+        meta = {'time': time.time(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'repeat': args.repeat,
+                'number': args.number}
+        f = open(args.output, 'w')
+        json.dump({'meta': meta, 'results': results}, f, indent=1,
+                  sort_keys=True)
+        f.close()
+    sys.exit(0)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+import ConfigParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import elixir
+
+from cl2s import config
+
+
+
+# Where the scripts are.
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 
+                       'bin')
+
+
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Base class of the tests that need a database: each test runs on a brand
+    new SQLite database in the throwaway directory self.tmp_dir, which goes
+    away with it. Subclasses extending setUp() and tearDown() call these
+    first and last respectively.
+    """
+    # Whether to create the tables of the elixir entities.
+    create_tables = True
+
+    def bind(self, url):
+        """
+        Return what to bind the elixir metadata to for the database `url`.
+        """
+        return(url)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_bind = elixir.metadata.bind
+        elixir.metadata.bind = self.bind('sqlite:///%s' \
+                                         % (os.path.join(self.tmp_dir,
+                                                         'cl2s.sqlite')))
+        elixir.setup_all()
+        if(self.create_tables):
+            elixir.create_all()
+        return
+
+    def tearDown(self):
+        elixir.session.remove()
+        elixir.metadata.bind = self.old_bind
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def run_script(self, name, *args):
+        """
+        Run the script bin/`name` with arguments `args` on our database, with a
+        config file of its own pointing to it. Return its (exit code, output).
+        """
+        home = os.path.join(self.tmp_dir, 'home')
+        if(not os.path.isdir(home)):
+            os.mkdir(home)
+        parser = ConfigParser.RawConfigParser()
+        for section in config.config.sections():
+            parser.add_section(section)
+            for (option, value) in config.config.items(section):
+                parser.set(section, option, value)
+        parser.set('Database', 'flavour', 'sqlite')
+        parser.set('Database', 'database', 
+                   os.path.join(self.tmp_dir, 'cl2s.sqlite'))
+        f = open(os.path.join(home, '.cl2src'), 'w')
+        parser.write(f)
+        f.close()
+
+        env = dict(os.environ, HOME=home)
+        process = subprocess.Popen([sys.executable, 
+                                    os.path.join(BIN_DIR, name)] + list(args),
+                                   env=env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        return((process.returncode, output))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import logging
+import os
+import unittest
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import affinity
+from cl2s import config
+from cl2s import fetchd
+from cl2s import hooks
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "%s"\nMyType = "Job"\n'
+SLOT_AD = 'MyType = "Machine"\nName = "slot1@localhost"\nCL2S_Datasets = "%s"\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestAffinity(DatabaseTestCase):
+    """
+    Dataset affinity on a throwaway SQLite job queue.
+    """
+    def setUp(self):
+        super(TestAffinity, self).setUp()
+        self.old_cache_file = config.AFFINITY_CACHE_FILE
+        config.AFFINITY_CACHE_FILE = os.path.join(self.tmp_dir, 'datasets')
+        return
+
+    def tearDown(self):
+        config.AFFINITY_CACHE_FILE = self.old_cache_file
+        super(TestAffinity, self).tearDown()
+        return
+
+    def push(self, *datasets):
+        JobQueue.push_many([Job(CLASS_AD % (d)) for d in datasets])
+        return
+
+    def test_claim(self):
+        self.push('a', 'b', 'c', 'b')
+        self.assertEqual(JobQueue.claim(['c', 'x']).dataset, 'c')
+        self.assertEqual(JobQueue.claim(['b']).dataset, 'b')
+        # Nothing for x: plain FIFO.
+        self.assertEqual(JobQueue.claim(['x']).dataset, 'a')
+        self.assertEqual(JobQueue.pop().CL2S_DATASET, 'b')
+        self.assertEqual(JobQueue.claim(['b']), None)
+        return
+
+    def test_cache(self):
+        path = config.AFFINITY_CACHE_FILE
+        self.assertEqual(affinity.recent_datasets(path), [])
+        for dataset in ('a', 'b', 'c', 'a'):
+            affinity.record(dataset, path, size=2)
+        self.assertEqual(affinity.recent_datasets(path), ['a', 'c'])
+        self.assertEqual(affinity.slot_datasets(SLOT_AD % ('x, c')),
+                         ['x', 'c'])
+        self.assertEqual(affinity.slot_datasets('MyType = "Machine"\n'), [])
+        self.assertEqual(affinity.datasets(SLOT_AD % ('x, c')),
+                         ['x', 'c', 'a'])
+        return
+
+    def test_fetch_job(self):
+        self.push('a', 'b', 'c', 'b', 'a')
+
+        # The slot advertises c. Then there is no more c: plain FIFO, but 
+        # after that we go back to the datasets we have seen recently, 
+        # skipping the queue.
+        self.assertTrue('"c"' in hooks.fetch_job(SLOT_AD % ('c')))
+        self.assertTrue('"a"' in hooks.fetch_job(SLOT_AD % ('')))
+        self.assertEqual(affinity.recent_datasets(), ['a', 'c'])
+        self.assertTrue('"a"' in hooks.fetch_job(SLOT_AD % ('')))
+        self.assertTrue('"b"' in hooks.fetch_job(SLOT_AD % ('')))
+        self.assertEqual(JobQueue.claim(['a', 'c']).dataset, 'b')
+        return
+
+    def test_prefetch_buffer(self):
+        self.push('a', 'b', 'c')
+        buffer = fetchd.PrefetchBuffer(3, 3600)
+        self.assertEqual(buffer.claim(['c']).dataset, 'c')
+        self.assertEqual(buffer.claim(['x']).dataset, 'a')
+        self.assertEqual(len(buffer), 1)
+        buffer.release()
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+import logging
+import threading
+import time
+import unittest
+
+import sqlalchemy.exc
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import asyncqueue
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "%s"\n'
+N = 300
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+def locked():
+    return(sqlalchemy.exc.OperationalError('UPDATE job_queue', {},
+                                           Exception('database is locked')))
+
+
+class TestAsyncJobQueue(DatabaseTestCase):
+    """
+    AsyncJobQueue on a throwaway SQLite job queue.
+    """
+    def setUp(self):
+        super(TestAsyncJobQueue, self).setUp()
+        self.queue = asyncqueue.AsyncJobQueue(max_workers=4, sleep_time=0.05)
+        return
+
+    def tearDown(self):
+        self.queue.shutdown()
+        super(TestAsyncJobQueue, self).tearDown()
+        return
+
+    def test_concurrent_submissions(self):
+        # Hundreds of submissions from a single thread, none of them waited
+        # for before the last one is made.
+        jobs = [Job(CLASS_AD % ('d%d' % (i % 10))) for i in range(N)]
+        futures = [self.queue.push(job) for job in jobs[:N-100]]
+        futures.append(self.queue.push_many(jobs[N-100:]))
+        for future in futures:
+            future.result(60)
+        self.assertEqual(self.queue.length().result(), N)
+
+        popped = [self.queue.pop() for i in range(10)]
+        popped = [future.result() for future in popped]
+        self.assertEqual(len(set([job.CL2S_JOB_ID for job in popped])), 10)
+        for future in [self.queue.delete(job) for job in popped[:5]] + \
+                      [self.queue.reinsert(job) for job in popped[5:]]:
+            future.result()
+        self.assertEqual(JobQueue.counts(), (N - 5, 0))
+        return
+
+    def test_push_many_retries(self):
+        # The second chunk of each push_many() fails once: it alone is
+        # retried, for lists and generators alike.
+        insert_rows = JobQueue._insert_rows
+        calls = []
+        def flaky(rows):
+            calls.append(len(rows))
+            if(len(calls) in (2, 6)):
+                raise(locked())
+            return(insert_rows(rows))
+        JobQueue._insert_rows = flaky
+        try:
+            jobs = [Job(CLASS_AD % ('d%d' % (i))) for i in range(30)]
+            self.assertEqual(self.queue.push_many(jobs, 10).result(10), 30)
+            jobs = (Job(CLASS_AD % ('d%d' % (i))) for i in range(20))
+            self.assertEqual(self.queue.push_many(jobs, 10).result(10), 20)
+        finally:
+            JobQueue._insert_rows = insert_rows
+        self.assertEqual(calls, [10] * 7)
+        self.assertEqual(JobQueue.length(), 50)
+        return
+
+    def test_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0]                                # [now, at most]
+        def work():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return
+        for future in [self.queue.submit(work) for i in range(40)]:
+            future.result()
+        self.assertEqual(running[1], 4)
+        return
+
+    def test_retries(self):
+        queue = asyncqueue.AsyncJobQueue(max_workers=1)
+        calls = []
+        def flaky():
+            calls.append(time.time())
+            if(len(calls) < 3):
+                raise(locked())
+            return(time.time())
+        backoff = asyncqueue.ormutils.backoff
+        asyncqueue.ormutils.backoff = lambda *args: 0.2
+        try:
+            slow = queue.submit(flaky)
+            # The worker does not sleep on the retries of flaky().
+            fast = queue.submit(time.time)
+            self.assertTrue(fast.result(10) < slow.result(10))
+            self.assertEqual(len(calls), 3)
+            self.assertTrue(calls[2] - calls[0] >= 0.4)
+
+            # Errors that are not worth a retry are handed to the caller.
+            error = ValueError('not a number')
+            def fail():
+                raise(error)
+            failed = queue.submit(fail)
+            try:
+                failed.result()
+                self.fail('result() did not raise')
+            except ValueError, e:
+                self.assertTrue(e is error)
+                self.assertEqual(str(e), 'not a number')
+            self.assertTrue(failed.exception() is error)
+        finally:
+            asyncqueue.ormutils.backoff = backoff
+            queue.shutdown()
+        self.assertRaises(RuntimeError, queue.submit, time.time)
+        return
+
+    def test_callbacks(self):
+        done = threading.Event()
+        results = []
+        def callback(future):
+            results.append(future.result())
+            done.set()
+            return
+        self.queue.length().add_done_callback(callback)
+        done.wait(10)
+        self.assertEqual(results, [0])
+
+        # Late callbacks are called right away.
+        future = self.queue.length()
+        future.result()
+        future.add_done_callback(callback)
+        self.assertEqual(results, [0, 0])
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
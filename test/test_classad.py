@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+import os
+import unittest
+
+from cl2s.ClassAd import ClassAd, Expression, _classad_to_dict
+from cl2s.ClassAd import extract_attributes
+from cl2s.Job import Job
+
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SINGLE_AD = open(os.path.join(HERE, 'job_ad_single.txt')).read()
+
+
+class TestClassAd(unittest.TestCase):
+    def test_case_insensitive(self):
+        ad = ClassAd(SINGLE_AD)
+        self.assertEqual(ad.Owner, 'fpierfed')
+        self.assertEqual(ad.owner, 'fpierfed')
+        self.assertEqual(ad.OWNER, 'fpierfed')
+
+        ad.OWNER = 'someone'
+        self.assertEqual(ad.Owner, 'someone')
+        self.assertTrue('Owner = "someone"' in repr(ad))
+        self.assertFalse('OWNER' in repr(ad))
+        self.assertFalse(hasattr(ad, 'NoSuchAttribute'))
+        return
+
+    def test_no_instance_dict(self):
+        ad = Job(SINGLE_AD)
+        self.assertFalse(hasattr(ad, '__dict__'))
+        ad.CL2S_Extra = 1
+        self.assertEqual(ad.cl2s_extra, 1)
+        del(ad.cl2s_EXTRA)
+        self.assertFalse(hasattr(ad, 'CL2S_Extra'))
+        return
+
+    def test_getenv(self):
+        # GetEnv is optional and turned off once the environment is expanded.
+        ad = ClassAd(SINGLE_AD.replace('GetEnv = true\n', ''))
+        self.assertEqual(ad.Environment, {})
+        ad = ClassAd(SINGLE_AD)
+        self.assertEqual(ad.GetEnv, False)
+        self.assertTrue(ad.Environment)
+        return
+
+    def test_literals(self):
+        d = _classad_to_dict('A = "text"\nB = TRUE\nC = false\nD = -42\n'
+                             'E = 1.5e3\nF = .5\nG = ImageSize / 1024\n'
+                             'H = "say \\"hi\\""\nI = "a" && "b"\nJ = ""\n')
+        self.assertEqual(d, {'A': u'text', 'B': True, 'C': False, 'D': -42,
+                             'E': 1500., 'F': .5, 'G': u'ImageSize / 1024',
+                             'H': u'say "hi"', 'I': u'"a" && "b"', 'J': u''})
+        self.assertTrue(isinstance(d['D'], int))
+        self.assertTrue(isinstance(d['G'], Expression))
+        self.assertTrue(isinstance(d['I'], Expression))
+        self.assertFalse(isinstance(d['A'], Expression))
+        return
+
+    def test_lines(self):
+        d = _classad_to_dict('# A comment = "not an attribute"\n'
+                             '  +Custom = "x = 1 # not a comment"  \n'
+                             '\n'
+                             'Args = "a" \\\n   "b"\n'
+                             'QueueTime = 7\n'
+                             'Queue 10\n')
+        self.assertEqual(d, {'Custom': u'x = 1 # not a comment',
+                             'Args': u'"a" "b"',
+                             'QueueTime': 7,
+                             'CL2S_INSTANCES': 10})
+        self.assertRaises(Exception, _classad_to_dict, 'A = 1\nnonsense\n')
+        return
+
+    def test_expression_round_trip(self):
+        ad = ClassAd(SINGLE_AD + 'Requirements = (TARGET.Arch == "X86_64")\n')
+        self.assertTrue('Requirements = (TARGET.Arch == "X86_64")\n' in repr(ad))
+        ad.Note = u'say "hi"'
+        self.assertEqual(ClassAd(repr(ad)).Note, u'say "hi"')
+        return
+
+    def test_extract_attributes(self):
+        job = Job(SINGLE_AD)
+        text = repr(job) + '-----\nCL2S_JOB_ID = "slot"\n'
+        end = text.index('-----')
+        self.assertEqual(extract_attributes(text, ['cl2s_job_id', 'Owner', 
+                                                   'Nope'], endpos=end),
+                         {'cl2s_job_id': job.CL2S_JOB_ID, 'Owner': job.Owner})
+        self.assertEqual(extract_attributes(text, ['Environment'])
+                         ['Environment'], job.Environment)
+        self.assertEqual(extract_attributes('A = 1 \\\n + 2\nB = 3\n', ['a']),
+                         {'a': Expression(u'1 + 2')})
+        return
+
+    def test_round_trip(self):
+        job = Job(SINGLE_AD)
+        copy = Job(repr(job))
+        self.assertEqual(copy.CL2S_JOB_ID, job.CL2S_JOB_ID)
+        self.assertEqual(copy.Environment, job.Environment)
+        self.assertEqual(copy._names, job._names)
+        return
+
+    def test_order(self):
+        text = 'Zeta = 1\nAlpha = 2\nMid = 3\nBeta = 4\n'
+        self.assertEqual(_classad_to_dict(text).keys(), 
+                         ['Zeta', 'Alpha', 'Mid', 'Beta'])
+        ad = ClassAd(text)
+        ad.Last = 5
+        lines = repr(ad).splitlines()
+        self.assertEqual(lines[:4], 
+                         ['Zeta = 1', 'Alpha = 2', 'Mid = 3', 'Beta = 4'])
+        self.assertEqual(lines[-1], 'Last = 5')
+        return
+
+    def test_escapes(self):
+        d = _classad_to_dict('A = "say \\"hi\\""\nB = "C:\\\\tmp\\\\"\n'
+                             'C = "a\\\\\\"b"\n')
+        self.assertEqual(d, {'A': u'say "hi"', 'B': u'C:\\tmp\\', 
+                             'C': u'a\\"b'})
+        ad = ClassAd('A = 1\n')
+        for value in d.values():
+            ad.Note = value
+            self.assertEqual(ClassAd(repr(ad)).Note, value)
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
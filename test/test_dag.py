@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import logging
+import os
+import time
+import unittest
+
+from cl2s import Dag
+from cl2s import JobQueue
+from cl2s import hooks
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+SUBMIT = 'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "%s"\nQueue\n'
+# A diamond: A before B and C, both before D.
+DIAMOND = '''# Diamond
+JOB A a.sub
+JOB B b.sub
+Job C c.sub
+JOB D d.sub
+PARENT A CHILD B C
+PARENT B C CHILD D
+parent A child B
+'''
+# Many nodes sharing a submit file.
+SHARED = 'Cmd = "/bin/echo"\nArguments = "$(x) $(Process)"\nOwner = "fpierfed"\nInputDataset = "$(dataset)"\nQueue\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestDag(DatabaseTestCase):
+    """
+    DAG parsing and execution on a throwaway SQLite database.
+    """
+    def setUp(self):
+        super(TestDag, self).setUp()
+        for name in 'abcd':
+            f = open(os.path.join(self.tmp_dir, '%s.sub' % (name)), 'w')
+            f.write(SUBMIT % (name.upper()))
+            f.close()
+        return
+
+    def _write(self, name, text):
+        path = os.path.join(self.tmp_dir, name)
+        f = open(path, 'w')
+        f.write(text)
+        f.close()
+        return(path)
+
+    def _queued(self):
+        # Pop everything in the queue: {dataset (i.e. node name): job id}.
+        return(dict([(j.CL2S_DATASET, j.CL2S_JOB_ID)
+                     for j in JobQueue.pop_batch(100)]))
+
+    def test_parse(self):
+        dag = Dag.DAG(DIAMOND, self.tmp_dir)
+        nodes = dict([(n.name, n) for n in dag.nodes])
+        self.assertEqual([n.name for n in dag.roots], ['A'])
+        self.assertEqual(sorted([n.name for n in nodes['A'].children]),
+                         ['B', 'C'])
+        self.assertEqual(sorted([n.name for n in nodes['D'].parents]),
+                         ['B', 'C'])
+        self.assertEqual(nodes['B'].job.CL2S_DATASET, 'B')
+
+        self.assertRaises(ValueError, Dag.DAG, DIAMOND + 'PARENT D CHILD A\n',
+                          self.tmp_dir)
+        self.assertRaises(ValueError, Dag.DAG, DIAMOND + 'PARENT D CHILD E\n',
+                          self.tmp_dir)
+        self.assertRaises(ValueError, Dag.DAG, DIAMOND + 'VARS A x=1\n',
+                          self.tmp_dir)
+
+        dag = Dag.DAG(DIAMOND + 'VARS A x="a \\"b\\" \\\\c" Y="$(job)"\n',
+                      self.tmp_dir)
+        nodes = dict([(n.name, n) for n in dag.nodes])
+        self.assertEqual(nodes['A'].vars, {'x': ('x', 'a "b" \\c'),
+                                           'y': ('Y', 'A')})
+
+        # Submit files are only read when needed.
+        dag = Dag.DAG(DIAMOND + 'JOB E missing.sub\n', self.tmp_dir)
+        self.assertRaises(IOError, dag.load)
+        return
+
+    def test_vars(self):
+        self._write('shared.sub', SHARED)
+        dag = Dag.DAG('JOB A shared.sub\nJOB B shared.sub\nJOB C shared.sub\n'
+                      'VARS A x="1" dataset="$(JOB)"\n'
+                      'VARS B x="2 3" dataset="$(JOB)"\n'
+                      'PARENT A CHILD B C\n', self.tmp_dir)
+        dag.load()
+        nodes = dict([(n.name, n) for n in dag.nodes])
+        self.assertEqual(nodes['A'].job.Arguments, '1 0')
+        self.assertEqual(nodes['A'].job.CL2S_DATASET, 'A')
+        self.assertEqual(nodes['B'].job.Arguments, '2 3 0')
+        self.assertEqual(nodes['C'].job.Arguments, ' 0')
+        self.assertEqual(nodes['C'].job.CL2S_DATASET, '')
+        # A and B share a template, C (no VARS) has its own.
+        self.assertTrue(nodes['A']._template is nodes['B']._template)
+        self.assertFalse(nodes['A']._template is nodes['C']._template)
+        return
+
+    def test_cache(self):
+        path = self._write('shared.sub', SHARED)
+        ads = Dag.load_ads([path, path])
+        self.assertEqual(ads.keys(), [path])
+        self.assertTrue(Dag.load_ads([path])[path] is ads[path])
+
+        # Modified files are parsed again.
+        self._write('shared.sub', SHARED.replace('echo', 'true'))
+        mtime = os.stat(path).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+        self.assertEqual(Dag.load_ads([path])[path][0].Cmd, '/bin/true')
+        return
+
+    def test_pool(self):
+        paths = [os.path.join(self.tmp_dir, '%s.sub' % (n)) for n in 'abcd']
+        ads = Dag.load_ads(paths, processes=2)
+        self.assertEqual(sorted([ad.InputDataset 
+                                 for (ad, statement) in ads.values()]),
+                         ['A', 'B', 'C', 'D'])
+        self.assertEqual([statement for (ad, statement) in ads.values()],
+                         ['Queue'] * 4)
+        return
+
+    def test_large(self):
+        # 100k nodes, one submit file: a binary tree.
+        n = 100000
+        self._write('shared.sub', SHARED)
+        lines = ['JOB N%d shared.sub' % (i) for i in xrange(n)]
+        lines += ['VARS N%d x="%d" dataset="d%d"' % (i, i, i % 100)
+                  for i in xrange(n)]
+        lines += ['PARENT N%d CHILD N%d' % ((i - 1) // 2, i)
+                  for i in xrange(1, n)]
+        text = '\n'.join(lines)
+
+        t0 = time.time()
+        dag = Dag.DAG(text, self.tmp_dir)
+        arguments = set([job.Arguments for (node, job, ad) in dag.instances()])
+        self.assertLess(time.time() - t0, 20.)
+        self.assertEqual(len(arguments), n)
+        self.assertEqual(len(dag.roots), 1)
+        return
+
+    def test_run(self):
+        dag = Dag.DAG(DIAMOND, self.tmp_dir)
+        dag_id = Dag.submit(dag)
+        self.assertEqual(Dag.status(dag_id), {'queued': 1, 'waiting': 3})
+
+        queued = self._queued()
+        self.assertEqual(queued.keys(), ['A'])
+        self.assertEqual(Dag.complete(queued['A']), ['B', 'C'])
+        # Only the first report counts.
+        self.assertEqual(Dag.complete(queued['A']), [])
+
+        queued = self._queued()
+        self.assertEqual(sorted(queued), ['B', 'C'])
+        self.assertEqual(Dag.complete(queued['B']), [])
+        self.assertEqual(self._queued(), {})
+        self.assertEqual(Dag.complete(queued['C']), ['D'])
+
+        queued = self._queued()
+        self.assertEqual(queued.keys(), ['D'])
+        self.assertEqual(Dag.complete(queued['D']), [])
+        self.assertEqual(Dag.status(dag_id), {'done': 4})
+
+        # Jobs that are not DAG nodes are none of our business.
+        self.assertEqual(Dag.complete(u'not a node'), [])
+        return
+
+    def test_job_exit(self):
+        Dag.submit(Dag.DAG(DIAMOND, self.tmp_dir))
+        job_id = self._queued()['A']
+
+        # Evicted: nothing happens.
+        ad = 'CL2S_JOB_ID = "%s"\nExitCode = %d\n'
+        hooks.job_exit('evict', ad % (job_id, 0))
+        self.assertEqual(self._queued(), {})
+
+        # Failed: the children never run.
+        hooks.job_exit('exit', ad % (job_id, 1))
+        self.assertEqual(self._queued(), {})
+        hooks.job_exit('exit', ad % (job_id, 0))
+        self.assertEqual(self._queued(), {})
+        # A is still claimed: leaving the queue is not up to the DAG.
+        self.assertEqual(JobQueue.counts(), (0, 1))
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
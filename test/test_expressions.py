@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+import logging
+import os
+import timeit
+import unittest
+
+from cl2s.ClassAd import ClassAd
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import config
+from cl2s import expressions
+from cl2s import hooks
+from cl2s import logutils
+from cl2s.expressions import ERROR, UNDEFINED, evaluate
+
+from dbtestcase import DatabaseTestCase
+from test_jobqueue import CLASS_AD
+
+
+
+SLOT_AD = '''MyType = "Machine"
+Name = "slot1@localhost"
+Arch = "X86_64"
+OpSys = "LINUX"
+Disk = 1000000
+Memory = %d
+HasFileTransfer = true
+'''
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestExpressions(unittest.TestCase):
+    """
+    ClassAd expression evaluation.
+    """
+    def test_literals_and_operators(self):
+        self.assertEqual(evaluate('1 + 2 * 3'), 7)
+        self.assertEqual(evaluate('(1 + 2) * 3'), 9)
+        self.assertEqual(evaluate('-7 / 2'), -3)
+        self.assertEqual(evaluate('-7 % 2'), -1)
+        self.assertEqual(evaluate('7 / 2.'), 3.5)
+        self.assertEqual(evaluate('1 / 0'), ERROR)
+        self.assertEqual(evaluate('"a" + 1'), ERROR)
+        self.assertEqual(evaluate('"ABC" == "abc"'), True)
+        self.assertEqual(evaluate('"ABC" =?= "abc"'), False)
+        self.assertEqual(evaluate('3 >= 2 && !(1 > 2)'), True)
+        self.assertEqual(evaluate('1 < 2 ? "yes" : "no"'), 'yes')
+        self.assertEqual(evaluate('ceiling(2.1) + floor(2.9) + round(2.5)'), 8)
+        self.assertEqual(evaluate('strcat("a", 1, true)'), 'a1true')
+        self.assertEqual(evaluate('1 +'), ERROR)
+        return
+
+    def test_undefined(self):
+        self.assertEqual(evaluate('Missing'), UNDEFINED)
+        self.assertEqual(evaluate('Missing + 1'), UNDEFINED)
+        self.assertEqual(evaluate('Missing == 1'), UNDEFINED)
+        self.assertEqual(evaluate('Missing =?= undefined'), True)
+        self.assertEqual(evaluate('Missing =!= undefined'), False)
+        self.assertEqual(evaluate('Missing isnt undefined'), False)
+        self.assertEqual(evaluate('false && Missing'), False)
+        self.assertEqual(evaluate('true && Missing'), UNDEFINED)
+        self.assertEqual(evaluate('true || Missing'), True)
+        self.assertEqual(evaluate('Missing || false'), UNDEFINED)
+        self.assertEqual(evaluate('isUndefined(Missing)'), True)
+        self.assertEqual(evaluate('ifThenElse(Missing, 1, 2)'), UNDEFINED)
+        self.assertEqual(evaluate('ceiling(Missing)'), UNDEFINED)
+        return
+
+    def test_scopes(self):
+        my = {'A': 1, 'B': 2}
+        target = {'a': 10, 'C': 30}
+        self.assertEqual(evaluate('A + C', my, target), 31)
+        self.assertEqual(evaluate('MY.a + TARGET.A + other.c', my, target), 41)
+        self.assertEqual(evaluate('TARGET.B', my, target), UNDEFINED)
+        return
+
+    def test_nested_expressions(self):
+        ad = ClassAd(CLASS_AD)
+        # RequestMemory = ceiling(ifThenElse(JobVMMemory =!= undefined,
+        #                                    JobVMMemory, ImageSize / 1024.))
+        self.assertEqual(evaluate(ad.RequestMemory, ad), 0)
+        ad.ImageSize = 4097
+        self.assertEqual(evaluate('RequestMemory', ad), 5)
+        # Attributes referenced by target expressions are looked up in the
+        # target first.
+        ad.Disk = 7
+        self.assertEqual(evaluate('TARGET.DiskUsage', {'Disk': 1}, ad), 0)
+        cycle = {'A': expressions.ClassAd.Expression(u'B'),
+                 'B': expressions.ClassAd.Expression(u'A')}
+        self.assertEqual(evaluate('A', cycle), ERROR)
+        return
+
+    def test_matches(self):
+        job = Job(CLASS_AD)
+        job.ImageSize = 2048 * 1024
+        self.assertTrue(expressions.matches(job, ClassAd(SLOT_AD % (4096))))
+        self.assertFalse(expressions.matches(job, ClassAd(SLOT_AD % (1024))))
+        self.assertFalse(expressions.matches(job, {'MyType': 'Machine'}))
+        self.assertTrue(expressions.matches(Job('Cmd = "/bin/true"\n'), {}))
+        return
+
+    def test_lazy(self):
+        self.assertEqual(expressions.references(
+            'ceiling(ifThenElse(JobVMMemory =!= undefined, MY.JobVMMemory, '
+            'ImageSize / 1024)) <= TARGET.Memory && Disk isnt error'),
+            set(['jobvmmemory', 'imagesize', 'memory', 'disk']))
+        self.assertEqual(expressions.references('Memory >='), set())
+
+        job = Job(CLASS_AD)
+        job.ImageSize = 2048 * 1024
+        text = unicode(job)
+        for memory in (1024, 4096):
+            lazy = expressions.LazyAd(text)
+            slot = expressions.LazyAd(SLOT_AD % (memory))
+            self.assertEqual(expressions.matches(lazy, slot),
+                             expressions.matches(job, 
+                                                 ClassAd(SLOT_AD % (memory))))
+        # Only what Requirements refers to, directly or not, was looked at.
+        self.assertEqual(sorted(slot._attrs),
+                         ['arch', 'disk', 'diskusage', 'hasfiletransfer',
+                          'imagesize', 'jobvmmemory', 'memory', 'opsys',
+                          'requestmemory'])
+        self.assertEqual(evaluate('RequestMemory', expressions.LazyAd(text)),
+                         2048)
+        self.assertFalse('environment' in lazy._attrs)
+        return
+
+    def test_cache(self):
+        text = 'TARGET.Memory * 1024 >= ImageSize'
+        f = expressions.compile_expression(text)
+        self.assertTrue(expressions.compile_expression(text) is f)
+        # So are the attributes it refers to.
+        names = expressions.references(text)
+        self.assertEqual(names, set(['memory', 'imagesize']))
+        self.assertTrue(expressions.references(text) is names)
+
+        job = Job(CLASS_AD)
+        slot = ClassAd(SLOT_AD % (4096))
+        seconds = min(timeit.repeat(lambda: expressions.matches(job, slot),
+                                    number=1000, repeat=3)) / 1000
+        self.assertTrue(seconds < 1e-3, seconds)
+        return
+
+
+class TestFetchMatching(DatabaseTestCase):
+    """
+    The job fetch hook only hands out jobs that fit the slot.
+    """
+    def setUp(self):
+        super(TestFetchMatching, self).setUp()
+        self.old_cache_file = config.AFFINITY_CACHE_FILE
+        config.AFFINITY_CACHE_FILE = os.path.join(self.tmp_dir, 'datasets')
+        return
+
+    def tearDown(self):
+        config.AFFINITY_CACHE_FILE = self.old_cache_file
+        super(TestFetchMatching, self).tearDown()
+        return
+
+    def test_fetch_job(self):
+        big = Job(CLASS_AD.replace('j9am01070', 'big'))
+        big.ImageSize = 8192 * 1024
+        small = Job(CLASS_AD.replace('j9am01070', 'small'))
+        JobQueue.push_many([big, small])
+
+        job_ad = hooks.fetch_job(SLOT_AD % (4096))
+        self.assertEqual(Job(job_ad).CL2S_JOB_ID, small.CL2S_JOB_ID)
+        self.assertEqual(hooks.fetch_job(SLOT_AD % (4096)), None)
+
+        # The big one went back in the queue.
+        job_ad = hooks.fetch_job(SLOT_AD % (16384))
+        self.assertEqual(Job(job_ad).CL2S_JOB_ID, big.CL2S_JOB_ID)
+        return
+
+    def test_fetch_job_lazy(self):
+        # Matching never builds Job instances.
+        JobQueue.push(Job(CLASS_AD))
+        old_load_job = JobQueue._load_job
+        def load_job(*args):
+            raise(AssertionError('Job instance built'))
+        JobQueue._load_job = load_job
+        try:
+            job_ad = hooks.fetch_job(SLOT_AD % (4096))
+        finally:
+            JobQueue._load_job = old_load_job
+        self.assertEqual(Job(job_ad).CL2S_DATASET, 'j9am01070')
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
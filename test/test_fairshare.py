@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import logging
+import unittest
+
+import elixir
+import sqlalchemy
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import config
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "%s"\nInputDataset = "%s.%d"\nMyType = "Job"\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestFairShare(DatabaseTestCase):
+    """
+    Fair-share claims on a throwaway SQLite job queue.
+    """
+    def setUp(self):
+        super(TestFairShare, self).setUp()
+        self.old_enabled = config.FAIRSHARE_ENABLED
+        config.FAIRSHARE_ENABLED = True
+        return
+
+    def tearDown(self):
+        config.FAIRSHARE_ENABLED = self.old_enabled
+        super(TestFairShare, self).tearDown()
+        return
+
+    def push(self, owner, n):
+        JobQueue.push_many([Job(CLASS_AD % (owner, owner, i))
+                            for i in range(n)])
+        return
+
+    def shares(self):
+        return(dict([(s['owner'], (s['idle'], s['claimed'], s['recent_usage']))
+                     for s in JobQueue.shares()]))
+
+    def test_claim(self):
+        self.push('alice', 5)
+        self.push('bob', 2)
+        self.assertEqual([JobQueue.pop().CL2S_DATASET for i in range(7)],
+                         ['alice.0', 'bob.0', 'alice.1', 'bob.1', 
+                          'alice.2', 'alice.3', 'alice.4'])
+        self.assertEqual(JobQueue.pop(), None)
+
+        # Plain FIFO without fair-share.
+        config.FAIRSHARE_ENABLED = False
+        self.push('alice', 2)
+        self.push('bob', 1)
+        self.assertEqual([JobQueue.pop().CL2S_DATASET for i in range(3)],
+                         ['alice.0', 'alice.1', 'bob.0'])
+        return
+
+    def test_claim_batch(self):
+        self.push('alice', 5)
+        self.push('bob', 2)
+        JobQueue.pop()
+        # bob's turn: his two Jobs, topped up with alice's.
+        self.assertEqual([j.CL2S_DATASET for j in JobQueue.pop_batch(3)],
+                         ['alice.1', 'bob.0', 'bob.1'])
+        return
+
+    def test_counters(self):
+        self.push('alice', 3)
+        self.push('bob', 1)
+        self.assertEqual(self.shares(), {'alice': (3, 0, 0.), 
+                                         'bob': (1, 0, 0.)})
+
+        a = JobQueue.claim()
+        b = JobQueue.claim()
+        self.assertEqual(self.shares(), {'alice': (2, 1, 1.), 
+                                         'bob': (0, 1, 1.)})
+        # Rejected Jobs are not charged for.
+        JobQueue.reinsert_by_id(b.job_id)
+        JobQueue.release([a.job_id, b.job_id])
+        self.assertEqual(self.shares(), {'alice': (3, 0, 0.), 
+                                         'bob': (1, 0, 0.)})
+
+        a = JobQueue.claim()
+        JobQueue.delete_by_id(a.job_id)
+        JobQueue.delete_by_id(JobQueue.claim_batch(3)[-1].job_id)
+        # The batch went to bob first and was topped up with alice's Jobs.
+        self.assertEqual(self.shares(), {'alice': (0, 2, 3.), 
+                                         'bob': (0, 0, 1.)})
+        shares = JobQueue.shares()
+        self.assertEqual(shares[0]['owner'], 'bob')
+        self.assertAlmostEqual(shares[0]['share'], .25)
+        return
+
+    def test_decay_and_reconcile(self):
+        self.push('alice', 4)
+        JobQueue.pop_batch(4)
+        last_decay = JobQueue.OwnerShare.query.get(u'alice').last_decay
+        elixir.session.remove()
+        self.assertEqual(JobQueue.decay_usage(10., last_decay + 20.), 1)
+        self.assertEqual(self.shares()['alice'], (0, 4, 1.))
+        self.assertEqual(JobQueue.decay_usage(10., last_decay + 20.), 0)
+
+        table = JobQueue.OwnerShare.table
+        elixir.metadata.bind.execute(table.update().values(idle=7, claimed=0))
+        elixir.metadata.bind.execute(table.delete())
+        self.assertEqual(JobQueue.reconcile_counters(), 5)
+        self.assertEqual(self.shares()['alice'], (0, 4, 0.))
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import logging
+import os
+import threading
+import unittest
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import config
+from cl2s import fetchd
+from cl2s import hookclient
+from cl2s import hooks
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "j9am%04d"\nMyType = "Job"\n'
+SLOT_AD = 'MyType = "Machine"\nName = "slot1@localhost"\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestFetchDaemon(DatabaseTestCase):
+    """
+    Talk to a node daemon serving a throwaway SQLite job queue.
+    """
+    def setUp(self):
+        super(TestFetchDaemon, self).setUp()
+        self.old_cache_file = config.AFFINITY_CACHE_FILE
+        config.AFFINITY_CACHE_FILE = os.path.join(self.tmp_dir, 'datasets')
+
+        self.path = os.path.join(self.tmp_dir, 'cl2sd.sock')
+        self.server = fetchd.FetchDaemon(self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        config.AFFINITY_CACHE_FILE = self.old_cache_file
+        super(TestFetchDaemon, self).tearDown()
+        return
+
+    def test_fetch_and_accept(self):
+        job = Job(CLASS_AD % (1))
+        JobQueue.push(job)
+
+        job_ad = hookclient.fetch(SLOT_AD, self.path)
+        self.assertEqual(Job(job_ad).CL2S_JOB_ID, job.CL2S_JOB_ID)
+        self.assertEqual(hookclient.fetch(SLOT_AD, self.path), '')
+
+        hookclient.reply('accept', job_ad + hooks.SEPARATOR + SLOT_AD, self.path)
+        self.assertEqual(JobQueue.length(), 0)
+        return
+
+    def test_fetch_and_reject(self):
+        JobQueue.push(Job(CLASS_AD % (1)))
+
+        job_ad = hookclient.fetch(SLOT_AD, self.path)
+        hookclient.reply('reject', job_ad + hooks.SEPARATOR + SLOT_AD, self.path)
+        self.assertEqual(hookclient.fetch(SLOT_AD, self.path), job_ad)
+        return
+
+    def test_prefetch_buffer(self):
+        JobQueue.push_many(Job(CLASS_AD % (i)) for i in range(10))
+
+        buffer = fetchd.PrefetchBuffer(4, 3600)
+        self.assertEqual(buffer.claim().job.CL2S_DATASET, 'j9am0000')
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(len(JobQueue.pop_batch(100)), 6)
+
+        # Unused claims go back to the queue.
+        buffer.release()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual([j.CL2S_DATASET for j in JobQueue.pop_batch(100)],
+                         ['j9am0001', 'j9am0002', 'j9am0003'])
+
+        # And so do the expired ones.
+        JobQueue.push(Job(CLASS_AD % (10)))
+        buffer.ttl = 0
+        self.assertEqual(buffer.claim().job.CL2S_DATASET, 'j9am0010')
+        self.assertEqual(buffer.claim(), None)
+        return
+
+    def test_errors(self):
+        self.assertRaises(hookclient.DaemonError,
+                          hookclient.reply, 'accept', 'garbage', self.path)
+        self.assertRaises(hookclient.DaemonUnavailable,
+                          hookclient.fetch, SLOT_AD,
+                          os.path.join(self.tmp_dir, 'nobody.sock'))
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
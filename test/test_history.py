@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+import datetime
+import gzip
+import logging
+import os
+import unittest
+
+import elixir
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import history
+from cl2s import hooks
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "%s"\n'
+EXIT_AD = 'CL2S_JOB_ID = "%s"\nOwner = "fpierfed"\nCL2S_DATASET = "j9am01"\nJobStartDate = 1300000000\nRemoteWallClockTime = 12.5\nExitBySignal = %s\nExitCode = %d\nExitSignal = 9\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestHistory(DatabaseTestCase):
+    """
+    Job history on a throwaway SQLite database.
+    """
+    def test_job_exit(self):
+        JobQueue.push(Job(CLASS_AD % ('j9am01')))
+        job = JobQueue.pop()
+        JobQueue.delete(job)
+        hooks.job_exit('evict', EXIT_AD % (job.CL2S_JOB_ID, 'false', 0))
+        hooks.job_exit('exit', EXIT_AD % (job.CL2S_JOB_ID, 'false', 3))
+        hooks.job_exit('exit', EXIT_AD % (job.CL2S_JOB_ID, 'true', 0))
+        # Only live work in the queue.
+        self.assertEqual(JobQueue.length(), 0)
+
+        today = datetime.datetime.utcnow().date()
+        self.assertEqual(history.counts(), [(today, {'exit': 2, 'evict': 1})])
+        table = history._table(today)
+        rows = elixir.metadata.bind.execute(
+            table.select().order_by(table.c.id)).fetchall()
+        self.assertEqual([(r.reason, r.exit_code, r.exit_signal) 
+                          for r in rows],
+                         [('evict', None, None), ('exit', 3, None), 
+                          ('exit', None, 9)])
+        self.assertEqual(rows[0].job_id, job.CL2S_JOB_ID)
+        self.assertEqual(rows[0].dataset, 'j9am01')
+        self.assertEqual(rows[0].runtime, 12.5)
+        self.assertEqual(rows[0].started, 
+                         datetime.datetime(2011, 3, 13, 7, 6, 40))
+        return
+
+    def test_script(self):
+        # cl2s_history.py on its own, with a config file of its own pointing
+        # to our database.
+        exited = datetime.datetime.utcnow() - datetime.timedelta(days=3)
+        history.record(u'1.0', u'exit', exit_code=0, exited=exited)
+        history.record(u'1.1', u'evict')
+        archive_dir = os.path.join(self.tmp_dir, 'archive')
+        (code, output) = self.run_script('cl2s_history.py', '-archive', 
+                                         '-keep', '1', '-dir', archive_dir)
+        self.assertEqual(code, 0, output)
+        self.assertEqual(output.splitlines()[1].split(),
+                         [datetime.datetime.utcnow().date().isoformat(), 
+                          '0', '1', '0', '0'])
+        self.assertEqual(os.listdir(archive_dir), 
+                         ['job_history_%s.tsv.gz' 
+                          % (exited.strftime('%Y%m%d'))])
+        return
+
+    def test_archive(self):
+        today = datetime.date(2011, 3, 20)
+        for d in (10, 12, 19, 20):
+            exited = datetime.datetime(2011, 3, d, 12)
+            for i in range(d):
+                history.record(u'%d.%d' % (d, i), u'exit', exit_code=i, 
+                               owner=u'fpierfed', exited=exited)
+        self.assertRaises(ValueError, history.archive, self.tmp_dir, 0)
+
+        archive_dir = os.path.join(self.tmp_dir, 'archive')
+        paths = history.archive(archive_dir, keep=2, today=today)
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ['job_history_20110310.tsv.gz', 
+                          'job_history_20110312.tsv.gz'])
+        self.assertEqual(history.days(), [datetime.date(2011, 3, 19), today])
+
+        f = gzip.open(paths[0])
+        lines = f.read().splitlines()
+        f.close()
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(lines[0].split('\t'), list(history.COLUMNS))
+        self.assertEqual(lines[1].split('\t'), 
+                         ['10.0', 'exit', '0', '\\N', 'fpierfed', '\\N', '\\N',
+                          '2011-03-10 12:00:00', '\\N'])
+
+        # Days are written again, never overwritten.
+        history.record(u'x', u'exit', exited=datetime.datetime(2011, 3, 10))
+        paths = history.archive(archive_dir, keep=2, today=today)
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ['job_history_20110310.1.tsv.gz'])
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
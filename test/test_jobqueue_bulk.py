@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+import logging
+import unittest
+
+import elixir
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "j9am%04d"\nMyType = "Job"\n'
+N = 250
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestJobQueueBulk(DatabaseTestCase):
+    """
+    Bulk operations on a throwaway SQLite job queue.
+    """
+    def test_push_many(self):
+        jobs = (Job(CLASS_AD % (i)) for i in range(N))
+        self.assertEqual(JobQueue.push_many(jobs, chunk_size=100), N)
+        self.assertEqual(JobQueue.length(), N)
+
+        # Jobs come out in submission order.
+        for i in range(N):
+            self.assertEqual(JobQueue.pop().CL2S_DATASET, 'j9am%04d' % (i))
+        self.assertEqual(JobQueue.pop(), None)
+        return
+
+    def test_pop_batch_and_release(self):
+        JobQueue.push_many(Job(CLASS_AD % (i)) for i in range(25))
+
+        batch = JobQueue.pop_batch(10)
+        self.assertEqual([j.CL2S_DATASET for j in batch],
+                         ['j9am%04d' % (i) for i in range(10)])
+        self.assertEqual(len(JobQueue.pop_batch(100)), 15)
+        self.assertEqual(JobQueue.pop_batch(10), [])
+
+        # Releasing puts jobs back in the queue.
+        self.assertEqual(JobQueue.release([j.CL2S_JOB_ID for j in batch]), 10)
+        self.assertEqual(len(JobQueue.pop_batch(100)), 10)
+        return
+
+    def test_claim(self):
+        job = Job(CLASS_AD % (0) + 'Requirements = Memory > 1024\n')
+        JobQueue.push(job)
+
+        # The stored text comes back as is and the Job is loaded on demand.
+        queued = JobQueue.claim()
+        self.assertEqual(queued.job_id, job.CL2S_JOB_ID)
+        self.assertEqual(queued.class_ad, unicode(job))
+        self.assertEqual(queued.job.CL2S_JOB_ID, job.CL2S_JOB_ID)
+        self.assertEqual(queued.job.requirements, job.Requirements)
+        self.assertEqual(unicode(queued.job), unicode(job))
+        self.assertEqual(JobQueue.claim(), None)
+        return
+
+    def test_delete_and_reinsert_by_id(self):
+        job = Job(CLASS_AD % (0))
+        JobQueue.push(job)
+
+        self.assertEqual(JobQueue.claim().job_id, job.CL2S_JOB_ID)
+        JobQueue.reinsert_by_id(job.CL2S_JOB_ID)
+        self.assertEqual(JobQueue.claim().job_id, job.CL2S_JOB_ID)
+        JobQueue.delete_by_id(job.CL2S_JOB_ID)
+        self.assertEqual(JobQueue.length(), 0)
+        self.assertRaises(Exception, JobQueue.delete_by_id, job.CL2S_JOB_ID)
+
+        # Entries that are not busy.
+        JobQueue.push(job)
+        JobQueue.reinsert_by_id(job.CL2S_JOB_ID)
+        self.assertEqual(JobQueue.counts(), (1, 0))
+        JobQueue.delete_by_id(job.CL2S_JOB_ID)
+        self.assertEqual(JobQueue.counts(), (0, 0))
+        return
+
+    def test_counts(self):
+        JobQueue.push_many(Job(CLASS_AD % (i % 2)) for i in range(5))
+        JobQueue.push(Job(CLASS_AD % (9)))
+        (first, second) = JobQueue.claim_batch(2)
+        JobQueue.delete_by_id(first.job_id)
+
+        self.assertEqual(JobQueue.counts(), (4, 1))
+        self.assertEqual(JobQueue.length(), 5)
+        self.assertEqual(JobQueue.counts(owner=u'fpierfed'), (4, 1))
+        self.assertEqual(JobQueue.counts(dataset=u'j9am0000'), (2, 0))
+        self.assertEqual(JobQueue.counts(dataset=u'j9am0001'), (1, 1))
+        self.assertEqual(JobQueue.counts(dataset=u'j9am0009'), (1, 0))
+        self.assertEqual(JobQueue.counts(dataset=u'nope'), (0, 0))
+        self.assertRaises(ValueError, JobQueue.counts, u'fpierfed', u'nope')
+
+        # Counters can always be rebuilt from the queue.
+        table = JobQueue.DatasetCount.table
+        elixir.metadata.bind.execute(table.update().values(idle=42))
+        elixir.metadata.bind.execute(JobQueue.OwnerShare.table.delete())
+        self.assertEqual(JobQueue.reconcile_counters(), 4)
+        self.assertEqual(JobQueue.counts(), (4, 1))
+        self.assertEqual(JobQueue.counts(dataset=u'j9am0001'), (1, 1))
+        return
+
+    def test_job_state(self):
+        ad = CLASS_AD % (0) + 'Environment = "A=1 B=two"\nRank = 1.5\n' + \
+             'Requirements = (Memory >= 1024) && (Arch == "X86_64")\n'
+        job = Job(ad)
+        JobQueue.push(job)
+        entry = JobQueue.JobQueueEntry.query.first()
+
+        # Data only, no pickles, readable with SQL.
+        self.assertTrue(isinstance(entry.job_state, unicode))
+        self.assertEqual(entry.job_state[0], '[')
+        self.assertEqual(elixir.metadata.bind.execute(
+            'SELECT job_state FROM job_queue').scalar(), entry.job_state)
+        loaded = JobQueue.pop()
+        self.assertEqual(loaded.__getstate__(), job.__getstate__())
+        self.assertEqual(loaded.Environment, {'A': '1', 'B': 'two'})
+        self.assertEqual(loaded.GetEnv, False)
+        self.assertEqual(loaded.Rank, 1.5)
+        self.assertEqual(type(loaded.Requirements), 
+                         type(job.Requirements))
+        self.assertEqual(str(loaded), str(job))
+
+        # Anything else is parsed from the ClassAd text.
+        loaded = JobQueue._load_job(ad, "cos\nsystem\n(S'true'\ntR.")
+        self.assertEqual(loaded.Environment, {'A': '1', 'B': 'two'})
+        self.assertEqual(loaded.CL2S_DATASET, 'j9am0000')
+        return
+
+    def test_push_many_empty(self):
+        self.assertEqual(JobQueue.push_many([]), 0)
+        self.assertEqual(JobQueue.length(), 0)
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
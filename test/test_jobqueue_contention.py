@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+import logging
+import threading
+import unittest
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "j9am%04d"\nMyType = "Job"\n'
+N = 200
+POPPERS = 16
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestJobQueueContention(DatabaseTestCase):
+    """
+    Hammer a throwaway SQLite job queue with many concurrent poppers and make
+    sure that no job is ever handed out twice.
+    """
+    def test_concurrent_pop(self):
+        job_ids = set()
+        for i in range(N):
+            job = Job(CLASS_AD % (i))
+            JobQueue.push(job)
+            job_ids.add(job.CL2S_JOB_ID)
+
+        popped = []
+        errors = []
+        def popper():
+            try:
+                while(True):
+                    job = JobQueue.pop()
+                    if(job is None):
+                        break
+                    popped.append(job.CL2S_JOB_ID)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=popper) for i in range(POPPERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(popped), N)
+        self.assertEqual(set(popped), job_ids)
+        self.assertEqual(JobQueue.pop(), None)
+        return
+
+    def test_concurrent_pop_batch(self):
+        job_ids = set()
+        for i in range(N):
+            job = Job(CLASS_AD % (i))
+            JobQueue.push(job)
+            job_ids.add(job.CL2S_JOB_ID)
+
+        popped = []
+        errors = []
+        def popper():
+            try:
+                while(True):
+                    jobs = JobQueue.pop_batch(7)
+                    if(not jobs):
+                        break
+                    popped.extend([job.CL2S_JOB_ID for job in jobs])
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=popper) for i in range(POPPERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(popped), N)
+        self.assertEqual(set(popped), job_ids)
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
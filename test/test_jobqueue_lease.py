@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import datetime
+import logging
+import unittest
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import config
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "j9am%04d"\nMyType = "Job"\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestJobQueueLease(DatabaseTestCase):
+    """
+    Claim leases on a throwaway SQLite job queue.
+    """
+    def setUp(self):
+        super(TestJobQueueLease, self).setUp()
+        self.old_config = (config.QUEUE_LEASE, config.QUEUE_SWEEP_INTERVAL)
+        JobQueue.push_many(Job(CLASS_AD % (i)) for i in range(3))
+        return
+
+    def tearDown(self):
+        (config.QUEUE_LEASE, config.QUEUE_SWEEP_INTERVAL) = self.old_config
+        super(TestJobQueueLease, self).tearDown()
+        return
+
+    def test_expire_leases(self):
+        config.QUEUE_SWEEP_INTERVAL = 3600.
+        first = JobQueue.claim()
+        batch = JobQueue.claim_batch(2)
+        JobQueue.reinsert_by_id(batch[0].job_id)
+        self.assertEqual(JobQueue.expire_leases(), 0)
+
+        # Nobody said anything about first and batch[1] for too long.
+        later = datetime.datetime.now() + \
+                datetime.timedelta(seconds=config.QUEUE_LEASE + 1)
+        usage = JobQueue.shares()[0]['recent_usage']
+        self.assertEqual(JobQueue.expire_leases(later), 2)
+        self.assertEqual(JobQueue.expire_leases(later), 0)
+        # Their owner stays charged for them.
+        self.assertEqual(JobQueue.shares()[0]['recent_usage'], usage)
+        self.assertEqual(usage, 2.)
+        self.assertEqual(sorted([j.CL2S_JOB_ID for j in JobQueue.pop_batch(5)]),
+                         sorted([first.job_id] + 
+                                [queued.job_id for queued in batch]))
+
+        shares = JobQueue.shares()
+        self.assertEqual((shares[0]['idle'], shares[0]['claimed']), (0, 3))
+        return
+
+    def test_release(self):
+        batch = JobQueue.claim_batch(2)
+        job_ids = [queued.job_id for queued in batch]
+
+        # Only busy entries are put back, and counted, once.
+        self.assertEqual(JobQueue.release(job_ids + [u'not queued']), 2)
+        self.assertEqual(JobQueue.release(job_ids), 0)
+        later = datetime.datetime.now() + \
+                datetime.timedelta(seconds=config.QUEUE_LEASE + 1)
+        self.assertEqual(JobQueue.expire_leases(later), 0)
+        self.assertEqual(JobQueue.counts(), (3, 0))
+        shares = JobQueue.shares()
+        self.assertEqual(shares[0]['recent_usage'], 0.)
+        return
+
+    def test_claim_sweeps(self):
+        # Leases that expire right away, looked for at every claim.
+        config.QUEUE_LEASE = -1.
+        config.QUEUE_SWEEP_INTERVAL = 0.
+        first = JobQueue.claim()
+        self.assertEqual(JobQueue.claim().job_id, first.job_id)
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import logging
+import unittest
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "%s"\nMyType = "Job"\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestJobQueuePriority(DatabaseTestCase):
+    """
+    Priorities on a throwaway SQLite job queue.
+    """
+    def push(self, *priorities):
+        jobs = []
+        for (i, priority) in enumerate(priorities):
+            job = Job(CLASS_AD % ('%s.%d' % (priority, i)))
+            if(priority is not None):
+                job.JobPrio = priority
+            jobs.append(job)
+        JobQueue.push_many(jobs)
+        return
+
+    def test_priority(self):
+        job = Job(CLASS_AD % ('a'))
+        self.assertEqual(JobQueue._priority(job), 0)
+        job.JobPrio = 5
+        self.assertEqual(JobQueue._priority(job), 5)
+        job.JobPrio = JobQueue.expressions.ClassAd.Expression(u'2 + 3 * 4')
+        self.assertEqual(JobQueue._priority(job), 14)
+        job.JobPrio = 'high'
+        self.assertEqual(JobQueue._priority(job), 0)
+        return
+
+    def test_pop(self):
+        self.push(None, 10, -1, 10, 0, 5)
+        self.assertEqual([JobQueue.pop().CL2S_DATASET for i in range(6)],
+                         ['10.1', '10.3', '5.5', 'None.0', '0.4', '-1.2'])
+        self.assertEqual(JobQueue.pop(), None)
+        return
+
+    def test_pop_batch(self):
+        self.push(0, 3, 1, 3)
+        self.assertEqual([j.CL2S_DATASET for j in JobQueue.pop_batch(3)],
+                         ['3.1', '3.3', '1.2'])
+        return
+
+    def test_reprioritize(self):
+        self.push(0, 0, 0, 0)
+        first = JobQueue.claim()
+        JobQueue.reinsert_by_id(first.job_id)
+
+        self.assertEqual(JobQueue.reprioritize(delta=1, 
+                                               datasets=[u'0.2', u'0.3']), 2)
+        self.assertEqual(JobQueue.reprioritize(priority=2, 
+                                               job_ids=[first.job_id]), 1)
+        self.assertEqual(JobQueue.reprioritize(priority=9, job_ids=[]), 0)
+        self.assertRaises(ValueError, JobQueue.reprioritize)
+        self.assertEqual([JobQueue.pop().CL2S_DATASET for i in range(4)],
+                         ['0.0', '0.2', '0.3', '0.1'])
+
+        self.assertEqual(JobQueue.reprioritize(delta=-3), 4)
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
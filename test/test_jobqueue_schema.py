@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import cPickle
+import logging
+import unittest
+
+import elixir
+import sqlalchemy
+from sqlalchemy.engine import reflection
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import logutils
+from cl2s import ormutils
+
+from dbtestcase import DatabaseTestCase
+from test_jobqueue import CLASS_AD
+
+
+
+# The job_queue table as created by the very first CL2S releases.
+LEGACY_SCHEMA = '''CREATE TABLE job_queue (
+                       job_id VARCHAR(255) NOT NULL,
+                       date_added DATETIME,
+                       class_ad TEXT,
+                       dataset VARCHAR(255),
+                       busy BOOLEAN,
+                       PRIMARY KEY (job_id))'''
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestJobQueueSchema(DatabaseTestCase):
+    """
+    Indexes and in place upgrades of a throwaway SQLite job queue.
+    """
+    # Tables are created (or upgraded) by the tests.
+    create_tables = False
+
+    def _query_plan(self, sql, **params):
+        plan = elixir.metadata.bind.execute(
+            sqlalchemy.text('EXPLAIN QUERY PLAN ' + sql), **params)
+        return(' '.join([list(row)[-1] for row in plan]))
+
+    def test_claim_uses_index(self):
+        ormutils.upgrade_schema()
+        plan = self._query_plan(JobQueue.SELECT_OLDEST % {'filter': ''}, 
+                                idle=False)
+        self.assertTrue('ix_job_queue_priority' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+        return
+
+    def test_affinity_claim_uses_index(self):
+        ormutils.upgrade_schema()
+        (where, params) = JobQueue._filter(['j9am01070'])
+        plan = self._query_plan(JobQueue.SELECT_OLDEST % {'filter': where},
+                                idle=False, **params)
+        self.assertTrue('ix_job_queue_dataset_priority' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+        return
+
+    def test_lease_sweep_uses_index(self):
+        ormutils.upgrade_schema()
+        plan = self._query_plan('SELECT job_id FROM job_queue ' +
+                                'WHERE busy = :busy AND lease_expires < :now',
+                                busy=True, now='2011-09-20 12:00:00')
+        self.assertTrue('ix_job_queue_lease' in plan, plan)
+        return
+
+    def test_upgrade_in_place(self):
+        engine = elixir.metadata.bind
+        engine.execute(LEGACY_SCHEMA)
+        engine.execute("INSERT INTO job_queue VALUES ('1', '2011-09-20 12:00:00', 'MyType = \"Job\"', 'j9am01070', 0)")
+
+        # An index of ours that has been superseded since.
+        engine.execute('CREATE INDEX ix_job_queue_claim ON job_queue (busy, date_added)')
+
+        changes = ormutils.upgrade_schema()
+        self.assertTrue('DROP INDEX ix_job_queue_claim' in changes, changes)
+        indexes = reflection.Inspector.from_engine(engine).get_indexes('job_queue')
+        names = [i['name'] for i in indexes]
+        self.assertTrue('ix_job_queue_priority' in names)
+        self.assertFalse('ix_job_queue_claim' in names)
+        self.assertEqual(engine.execute('SELECT COUNT(*) FROM job_queue').scalar(), 1)
+
+        # Entries queued before the upgrade have no pre-parsed Job.
+        self.assertEqual(JobQueue.pop().MyType, 'Job')
+
+        # Nothing left to do the second time around.
+        self.assertEqual(ormutils.upgrade_schema(), [])
+        return
+
+    def test_upgrade_job_state(self):
+        # Older versions stored pre-parsed Jobs as binary, pickled even 
+        # earlier on.
+        engine = elixir.metadata.bind
+        engine.execute(LEGACY_SCHEMA)
+        engine.execute('ALTER TABLE job_queue ADD COLUMN job_state BLOB')
+        job = Job(CLASS_AD)
+        for (job_id, state) in ((u'1', buffer(str(JobQueue._dump_job(job)))),
+                                (u'2', buffer(cPickle.dumps(job, 2)))):
+            engine.execute(sqlalchemy.text("INSERT INTO job_queue VALUES (:job_id, '2011-09-20 12:00:00', :class_ad, 'j9am01070', 0, :state)"),
+                           job_id=job_id, class_ad=unicode(job), state=state)
+        ormutils.upgrade_schema()
+        JobQueue.reconcile_counters()
+
+        for job_id in (u'1', u'2'):
+            queued = JobQueue.claim()
+            self.assertEqual(queued.job_id, job_id)
+            self.assertEqual(queued.job.__getstate__()[1], 
+                             job.__getstate__()[1])
+        return
+
+    def test_upgrade_counters(self):
+        # jobqueue-init.py on a queue that predates the counters.
+        engine = elixir.metadata.bind
+        engine.execute(LEGACY_SCHEMA)
+        for (job_id, owner, dataset, busy) in ((1, 'fpierfed', 'j9am01', 0),
+                                               (2, 'fpierfed', 'j9am01', 1),
+                                               (3, 'someone', 'j9am02', 0)):
+            engine.execute("INSERT INTO job_queue VALUES ('%d', '2011-09-20 12:00:00', 'MyType = \"Job\"\nOwner = \"%s\"\n', '%s', %d)" % (job_id, owner, dataset, busy))
+        (code, output) = self.run_script('jobqueue-init.py')
+        self.assertEqual(code, 0, output)
+
+        self.assertEqual(JobQueue.length(), 3)
+        self.assertEqual(JobQueue.counts(), (2, 1))
+        self.assertEqual(JobQueue.counts(owner=u'fpierfed'), (1, 1))
+        self.assertEqual(JobQueue.counts(owner=u'someone'), (1, 0))
+        self.assertEqual(JobQueue.counts(dataset=u'j9am01'), (1, 1))
+
+        # Counters stay right from then on.
+        JobQueue.delete_by_id(u'2')
+        JobQueue.delete_by_id(u'1')
+        self.assertEqual(JobQueue.counts(dataset=u'j9am01'), (0, 0))
+        self.assertEqual(JobQueue.counts(owner=u'fpierfed'), (0, 0))
+        self.assertEqual(JobQueue.length(), 1)
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cl2s.ClassAd import ClassAd
+from cl2s.Job import Job
+from cl2s.JobTemplate import JobTemplate
+from cl2s import JobQueue
+from cl2s import logutils
+
+from dbtestcase import DatabaseTestCase
+
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLUSTER_AD = open(os.path.join(HERE, 'job_ad_cluster.txt')).read()
+CLUSTER_AD = CLUSTER_AD.replace('GetEnv = true', 'GetEnv = false')
+CLUSTER_AD = CLUSTER_AD.replace('Queue 10', '''Environment = "N=$(Process) A=b"
+Args = $(Process)
+Rank = "x$(Process)" + 1
+Queue 10''')
+N = 100000
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class TestJobTemplate(unittest.TestCase):
+    """
+    Job cluster expansion.
+    """
+    def test_instances(self):
+        ad = ClassAd(CLUSTER_AD)
+        template = JobTemplate(ad)
+        self.assertEqual(len(template), 10)
+
+        # Instances are what parsing the ad with $(Process) replaced would give
+        # (but for their ids).
+        ad.CL2S_INSTANCES = 1
+        text = unicode(ad)
+        ids = set()
+        for (i, (job, class_ad)) in enumerate(template.instances()):
+            expected = Job(text.replace('$(Process)', str(i)))
+            self.assertEqual(job.CL2S_JOB_ID,
+                             '%s.%d' % (template.cluster_id, i))
+            ids.add(job.CL2S_JOB_ID)
+            del(expected.CL2S_JOB_ID)
+            attrs = dict(job._attrs)
+            del(attrs['cl2s_job_id'])
+            self.assertEqual(attrs, expected._attrs)
+            self.assertEqual(Job(class_ad)._attrs, job._attrs)
+        self.assertEqual(len(ids), 10)
+
+        self.assertEqual(job.Arguments, 'j9am9070_asn.fits')
+        self.assertEqual(job.CL2S_DATASET, 'j9am9070')
+        self.assertEqual(job.Environment, {'N': '9', 'A': 'b'})
+        self.assertEqual(job.Args, 9)
+        self.assertEqual(job.Rank, '"x9" + 1')
+        return
+
+    def test_queue_statements(self):
+        ad = u'''Cmd = "/bin/echo"
+JobUniverse = 5
+Owner = "fpierfed"
+Base = "run$(Cluster)"
+Arguments = "$(Base) $(d) $(args) $(Step) $(ItemIndex) $(Process) $(Nope)"
+InputDataset = "$(d)"
+Queue 2 d, args from (
+    j9am01 -v
+    j9am02
+)
+'''
+        template = JobTemplate(ad, cluster_id=u'42')
+        self.assertEqual(len(template), 4)
+        jobs = [job for (job, class_ad) in template.instances()]
+        self.assertEqual([j.Arguments for j in jobs],
+                         ['run42 j9am01 -v 0 0 0 ', 'run42 j9am01 -v 1 0 1 ',
+                          'run42 j9am02  0 1 2 ', 'run42 j9am02  1 1 3 '])
+        self.assertEqual([j.CL2S_DATASET for j in jobs],
+                         ['j9am01', 'j9am01', 'j9am02', 'j9am02'])
+        self.assertEqual(jobs[-1].CL2S_JOB_ID, '42.3')
+
+        # Values with (escaped) quotes go through the parser.
+        template = JobTemplate(ad.replace('j9am01 -v', 'j9am01 \\"-v\\"'))
+        self.assertEqual(template.instance(0)[0].Arguments,
+                         'run%s j9am01 "-v" 0 0 0 ' % (template.cluster_id))
+        return
+
+    def test_large_queue_from(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            f = open(os.path.join(tmp_dir, 'items'), 'w')
+            f.write(''.join(['%05d, %d\n' % (i, i) for i in range(N)]))
+            f.close()
+            ad = CLUSTER_AD.replace('j9am$(Process)', 'j9am$(d)')
+            ad = ad.replace('Queue 10', 'Queue d, n from items')
+
+            t0 = time.time()
+            template = JobTemplate(ad, basedir=tmp_dir)
+            n = 0
+            for (job, class_ad) in template.instances():
+                n += 1
+            seconds = time.time() - t0
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(n, N)
+        self.assertEqual(job.CL2S_DATASET, 'j9am%05d070' % (N - 1))
+        self.assertEqual(job.Args, N - 1)
+        self.assertTrue(seconds < 10., seconds)
+        return
+
+    def test_lazy(self):
+        template = JobTemplate(CLUSTER_AD.replace('Queue 10', 'Queue 1000000000'))
+        jobs = list(itertools.islice(template.instances(start=5), 2))
+        self.assertEqual([j.CL2S_DATASET for (j, class_ad) in jobs],
+                         ['j9am5070', 'j9am6070'])
+        return
+
+
+class TestPushCluster(DatabaseTestCase):
+    """
+    Queueing a cluster through its template.
+    """
+    def test_push_cluster(self):
+        template = JobTemplate(CLUSTER_AD.replace('Queue 10', 'Queue 25'))
+        self.assertEqual(JobQueue.push_cluster(template, chunk_size=7), 25)
+        self.assertEqual(JobQueue.counts(owner=u'fpierfed'), (25, 0))
+
+        jobs = JobQueue.pop_batch(100)
+        self.assertEqual(sorted([j.CL2S_DATASET for j in jobs]),
+                         sorted(['j9am%d070' % (i) for i in range(25)]))
+        self.assertEqual(jobs[0].Owner, 'fpierfed')
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+from cl2s import macros
+
+
+
+class TestMacros(unittest.TestCase):
+    """
+    condor_submit macro expansion.
+    """
+    def test_expand(self):
+        definitions = {'a': u'x$(B)', 'b': u'y', 'c': u'$(c)'}
+        self.assertEqual(macros.expand(u'$(A)-$(Process)-$(Missing)-$$(A)',
+                                       definitions, keep=('process', )),
+                         u'xy-$(Process)--$$(A)')
+        self.assertRaises(ValueError, macros.expand, u'$(C)', definitions)
+        return
+
+    def test_fill(self):
+        compiled = macros.compile_text(u'100% $(A) $(b) $(a)')
+        self.assertEqual(compiled[1], ['a', 'b', 'a'])
+        self.assertEqual(macros.fill(compiled, {'a': u'1', 'b': u'2'}),
+                         u'100% 1 2 1')
+        self.assertEqual(macros.fill_all(compiled,
+                                         {'a': [u'1', u'3'], 'b': [u'2', u'4']},
+                                         2),
+                         [u'100% 1 2 1', u'100% 3 4 3'])
+        self.assertEqual(macros.fill_all(macros.compile_text(u'plain'), {}, 2),
+                         [u'plain', u'plain'])
+        return
+
+
+class TestQueue(unittest.TestCase):
+    """
+    condor_submit queue statements.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for name in ('a.fits', 'b.fits', 'c.txt'):
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+        os.mkdir(os.path.join(self.tmp_dir, 'd.fits'))
+        f = open(os.path.join(self.tmp_dir, 'items'), 'w')
+        f.write('# dataset, arguments\nj9am01 -v -x\n\nj9am02,-q\nj9am03\n')
+        f.close()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def test_split_queue(self):
+        text = 'A = 1\nQueue 2 in (\n  a\n  b\n)\nB = 2\n'
+        self.assertEqual(macros.split_queue(text),
+                         ('A = 1\n\nB = 2\n', 'Queue 2 in (\n  a\n  b\n)'))
+        self.assertEqual(macros.split_queue('A = 1\n'), ('A = 1\n', None))
+        self.assertRaises(ValueError, macros.split_queue, 'queue in (a\n')
+
+        # Macros named queue are not queue statements.
+        text = 'Queue = 3\nqueue=4\nA = $(queue)\nQueue in (\n  a\n)\n'
+        self.assertEqual(macros.split_queue(text),
+                         ('Queue = 3\nqueue=4\nA = $(queue)\n\n', 
+                          'Queue in (\n  a\n)'))
+        # Only one queue statement.
+        self.assertRaises(ValueError, macros.split_queue, 
+                          'A = 1\nQueue 2\nA = 2\nQueue\n')
+        return
+
+    def test_parse_queue(self):
+        self.assertEqual(macros.parse_queue('Queue'), (1, [], [()]))
+        self.assertEqual(macros.parse_queue('queue 10'), (10, [], [()]))
+        self.assertEqual(macros.parse_queue('queue 2 in (a, b c)'),
+                         (2, ['Item'], [(u'a', ), (u'b', ), (u'c', )]))
+        self.assertEqual(macros.parse_queue('queue x,y from (\n1 2 3\n4\n)'),
+                         (1, ['x', 'y'], [(u'1', u'2 3'), (u'4', u'')]))
+        self.assertEqual(macros.parse_queue('queue d, args from items',
+                                            self.tmp_dir),
+                         (1, ['d', 'args'], [(u'j9am01', u'-v -x'),
+                                             (u'j9am02', u'-q'),
+                                             (u'j9am03', u'')]))
+        self.assertEqual(macros.parse_queue('queue f matching *.fits',
+                                            self.tmp_dir),
+                         (1, ['f'], [('a.fits', ), ('b.fits', ),
+                                     ('d.fits', )]))
+        self.assertEqual(macros.parse_queue('queue matching files *.fits c*',
+                                            self.tmp_dir)[2],
+                         [('a.fits', ), ('b.fits', ), ('c.txt', )])
+        self.assertEqual(macros.parse_queue('queue matching dirs *',
+                                            self.tmp_dir)[2],
+                         [('d.fits', )])
+        self.assertRaises(ValueError, macros.parse_queue, 'queue x')
+        self.assertRaises(ValueError, macros.parse_queue, 'queue x,y in (a)')
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
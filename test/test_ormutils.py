@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import elixir
+import sqlalchemy.exc
+
+from cl2s import config
+from cl2s import logutils
+from cl2s import ormutils
+
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+def locked():
+    return(sqlalchemy.exc.OperationalError('UPDATE job_queue', {},
+                                           Exception('database is locked')))
+
+
+class Flaky(object):
+    """
+    Callable failing with `error` the first `failures` times it is called.
+    """
+    def __init__(self, failures, error=locked):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+        self.__name__ = 'flaky'
+        return
+
+    def __call__(self):
+        self.calls += 1
+        if(self.calls <= self.failures):
+            raise(self.error())
+        return(self.calls)
+
+
+class TestRetries(unittest.TestCase):
+    """
+    The run_with_retries_and_rollback decorator.
+    """
+    def setUp(self):
+        ormutils.reset_retry_stats()
+        return
+
+    def decorate(self, f, max_retries=3):
+        return(ormutils.run_with_retries_and_rollback(f, max_retries, 0.))
+
+    def test_retry_returns_result(self):
+        f = self.decorate(Flaky(2))
+        self.assertEqual(f(), 3)
+        self.assertEqual(ormutils.retry_stats()[f.name],
+                         {'attempts': 3, 'retries': 2, 'give_ups': 0})
+        return
+
+    def test_give_up(self):
+        flaky = Flaky(10)
+        f = self.decorate(flaky, 2)
+        self.assertRaises(sqlalchemy.exc.OperationalError, f)
+        self.assertEqual(flaky.calls, 3)
+        self.assertEqual(ormutils.retry_stats()[f.name]['give_ups'], 1)
+
+        # Retry budgets are per call, not per decorated function.
+        flaky.calls = 8
+        self.assertEqual(f(), 11)
+        return
+
+    def test_not_retryable(self):
+        flaky = Flaky(1, lambda: ValueError('not found'))
+        f = self.decorate(flaky)
+        self.assertRaises(ValueError, f)
+        self.assertEqual(flaky.calls, 1)
+        return
+
+    def test_rollback_clears_exception(self):
+        error = ValueError('not found')
+        def rollback():
+            sys.exc_clear()
+            return
+        old_rollback = elixir.session.rollback
+        elixir.session.rollback = rollback
+        try:
+            f = self.decorate(Flaky(1, lambda: error))
+            try:
+                f()
+            except Exception, e:
+                self.assertTrue(e is error)
+            else:
+                self.fail('no exception raised')
+        finally:
+            elixir.session.rollback = old_rollback
+        return
+
+    def test_deferred_retries(self):
+        flaky = Flaky(1)
+        f = self.decorate(flaky)
+        with ormutils.deferred_retries():
+            self.assertRaises(sqlalchemy.exc.OperationalError, f)
+        self.assertEqual(flaky.calls, 1)
+        self.assertEqual(ormutils.retry_stats()[f.name]['give_ups'], 0)
+        self.assertEqual(f(), 2)
+        return
+
+    def test_is_retryable(self):
+        self.assertTrue(ormutils.is_retryable(locked()))
+        self.assertTrue(ormutils.is_retryable(sqlalchemy.exc.TimeoutError()))
+        integrity = sqlalchemy.exc.IntegrityError('INSERT', {},
+                                                  Exception('duplicate'))
+        self.assertFalse(ormutils.is_retryable(integrity))
+        deadlock = sqlalchemy.exc.ProgrammingError('UPDATE', {},
+                                                   Exception('Deadlock found'))
+        self.assertTrue(ormutils.is_retryable(deadlock))
+        self.assertFalse(ormutils.is_retryable(Exception('locked')))
+        # SQLite reports schema and programming errors as OperationalError.
+        for message in ('no such table: owner_share', 'no such column: x',
+                        'near "SELEC": syntax error'):
+            error = sqlalchemy.exc.OperationalError('SELECT', {}, 
+                                                    Exception(message))
+            self.assertFalse(ormutils.is_retryable(error))
+        return
+
+    def test_missing_table_not_retried(self):
+        flaky = Flaky(10, lambda: sqlalchemy.exc.OperationalError(
+            'SELECT', {}, Exception('no such table: owner_share')))
+        f = self.decorate(flaky)
+        self.assertRaises(sqlalchemy.exc.OperationalError, f)
+        self.assertEqual(flaky.calls, 1)
+        return
+
+
+
+class TestEngine(unittest.TestCase):
+    """
+    Engines created by ormutils.create_engine().
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.url = 'sqlite:///%s' % (os.path.join(self.tmp_dir, 'cl2s.sqlite'))
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def test_sqlite_pragmas(self):
+        engine = ormutils.create_engine(self.url)
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar().upper(),
+                         config.ENGINE_SQLITE_JOURNAL_MODE.upper())
+        # SQLite connections are not pooled: this is a brand new connection,
+        # and busy_timeout (unlike journal_mode) is not stored in the file.
+        self.assertEqual(engine.execute('PRAGMA busy_timeout').scalar(),
+                         config.ENGINE_SQLITE_BUSY_TIMEOUT)
+        return
+
+    def test_untuned(self):
+        engine = ormutils.create_engine(self.url, tuned=False)
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(),
+                         'delete')
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()
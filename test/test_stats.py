@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import unittest
+
+from cl2s.Job import Job
+from cl2s import JobQueue
+from cl2s import logutils
+from cl2s import ormutils
+from cl2s import stats
+
+from dbtestcase import DatabaseTestCase
+
+
+
+CLASS_AD = u'Cmd = "/bin/true"\nJobUniverse = 5\nGetEnv = false\nOwner = "fpierfed"\nInputDataset = "j9am%04d"\nMyType = "Job"\n'
+
+
+logutils.logger.setLevel(logging.CRITICAL)
+
+
+class Unprintable(object):
+    def __str__(self):
+        raise(AssertionError('Formatted while logging is off.'))
+
+
+class TestStats(DatabaseTestCase):
+    """
+    Latency statistics of job queue operations on a throwaway SQLite database.
+    """
+    def bind(self, url):
+        return(ormutils.create_engine(url))
+
+    def setUp(self):
+        super(TestStats, self).setUp()
+        stats.reset()
+        stats.enable(install_handlers=False)
+        return
+
+    def tearDown(self):
+        stats.disable()
+        stats.reset()
+        super(TestStats, self).tearDown()
+        return
+
+    def test_timers(self):
+        for i in range(10):
+            JobQueue.push(Job(CLASS_AD % (i)))
+        for i in range(10):
+            JobQueue.delete(JobQueue.pop())
+        self.assertEqual(JobQueue.length(), 0)
+
+        timers = stats.snapshot()['timers']
+        for name in ('JobQueue.push', 'JobQueue.pop', 'JobQueue.claim',
+                     'JobQueue.delete', 'JobQueue.length'):
+            self.assertTrue(name in timers, name)
+        self.assertEqual(timers['JobQueue.push']['count'], 10)
+        self.assertTrue(timers['ClassAd.__init__']['count'] >= 10)
+        self.assertTrue(timers['ClassAd.__repr__']['count'] >= 10)
+
+        pop = timers['JobQueue.pop']
+        self.assertTrue(0 < pop['min_us'] <= pop['p50_us'] <= pop['max_us'])
+        self.assertEqual(sum(pop['buckets']), 10)
+        # claim() round trips count towards pop() as well.
+        self.assertTrue(pop['db_round_trips'] >= 10)
+        self.assertEqual(pop['db_round_trips'],
+                         timers['JobQueue.claim']['db_round_trips'])
+        return
+
+    def test_disabled(self):
+        stats.disable()
+        JobQueue.push(Job(CLASS_AD % (0)))
+        self.assertEqual(stats.snapshot()['timers'], {})
+        self.assertEqual(stats.dump(os.path.join(self.tmp_dir, 'x')), None)
+
+        # Nothing gets formatted for the logger either.
+        logutils.logit(lambda x: x)(Unprintable())
+        return
+
+    def test_dump(self):
+        JobQueue.length()
+        path = stats.dump(os.path.join(self.tmp_dir, 'stats.json'))
+        data = json.load(open(path))
+        self.assertEqual(data['pid'], os.getpid())
+        self.assertEqual(data['timers']['JobQueue.length']['count'], 1)
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    unittest.main()